@@ -29,6 +29,9 @@ class Fortune(Module):
     async def on_load(self):
         self.timeouts = {}
 
+    def memory_breakdown(self):
+        return dict(getattr(self, 'timeouts', {}))
+
     async def on_command(self, cmd, channel, who, text):
         if not channel:
             return
@@ -1,19 +1,30 @@
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlsplit, urlunsplit
 from html.parser import HTMLParser
+from collections import OrderedDict
+import asyncio
+import codecs
 import logging
-import socket
+import pickle
 import re
+import socket
 import fnmatch
 import ipaddress
+import time
+import weakref
+from typing import AsyncIterable, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
 import aiohttp
-from omnibot import Module
+from aiohttp.abc import AbstractResolver
+from omnibot import Message, Module
 
 
 identity = lambda x: x
-url_re = re.compile("\S+://\S+")
 local_networks = ['127.0.0.0/8', '10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', '169.254.0.0/16']
 log = logging.getLogger(__name__)
 
+# how much of a page to look through for a <meta> charset, when the headers don't give one
+SNIFF_BYTES = 1024
+META_CHARSET_RE = re.compile(br'<meta[^>]+charset\s*=\s*["\']?([A-Za-z0-9_.:-]+)', re.I)
+
 
 class LinkbotError(Exception):
     '''
@@ -42,7 +53,323 @@ class HTMLTitleParser(HTMLParser):
 
     def handle_data(self, data):
         if not self.title_end and self.title_start:
-            self.title = data
+            # the title may arrive in pieces when the page is fed a chunk at a time
+            self.title = (self.title or "") + data
+
+
+def find_charset(charset: Optional[str]) -> Optional[str]:
+    "Gets the name of a charset if Python knows it, or None."
+    if not charset:
+        return None
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return None
+
+
+def sniff_charset(head: bytes) -> Optional[str]:
+    "Finds the charset that the start of an HTML document declares in a <meta> tag, if any."
+    match = META_CHARSET_RE.search(head)
+    if match is None:
+        return None
+    return find_charset(match.group(1).decode('ascii'))
+
+
+async def read_title(chunks: AsyncIterable[bytes], charset: Optional[str] = None,
+                     max_bytes: int = None) -> Optional[str]:
+    '''
+    Reads an HTML document a chunk at a time until its title has been read, or ``max_bytes``
+    have been read, returning the title if there is one (and it wasn't cut off).
+
+    If ``charset`` isn't given, it's taken from a <meta> tag near the start of the document, or
+    is UTF-8 if there isn't one.
+    '''
+    parser = HTMLTitleParser()
+    decoder = None
+    head = b''
+    read = 0
+    charset = find_charset(charset)
+    async for chunk in chunks:
+        if max_bytes is not None:
+            chunk = chunk[:max_bytes - read]
+        read += len(chunk)
+        if decoder is None:
+            # hold on to the start of the document until the charset is known
+            head += chunk
+            if charset is None and len(head) < SNIFF_BYTES and read != max_bytes:
+                continue
+            decoder = codecs.getincrementaldecoder(charset or sniff_charset(head) or 'utf-8')
+            decoder = decoder(errors='replace')
+            chunk, head = head, b''
+        parser.feed(decoder.decode(chunk))
+        if parser.title_end or read == max_bytes:
+            break
+    if decoder is None:
+        # the whole document was shorter than SNIFF_BYTES
+        decoder = codecs.getincrementaldecoder(charset or sniff_charset(head) or 'utf-8')
+        decoder = decoder(errors='replace')
+    parser.feed(decoder.decode(head, final=True))
+    parser.close()
+    if read == max_bytes and not parser.title_end:
+        # the title may have been cut off
+        return None
+    return parser.title
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url: str) -> str:
+    '''
+    Normalizes a URL so that different ways of writing the same one are cached together: the
+    scheme and host are lowercased, default ports and fragments are dropped, and an empty path
+    becomes /.
+    '''
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if ':' in netloc:
+        netloc = '[{}]'.format(netloc)
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += ':{}'.format(parts.port)
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo += ':' + parts.password
+        netloc = userinfo + '@' + netloc
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+class TitleCache:
+    '''
+    A least-recently-used cache of page titles, which expire after ``ttl`` seconds. Pages with no
+    title (None) are cached too, for ``negative_ttl`` seconds, so that failing links aren't
+    fetched again straight away.
+    '''
+
+    def __init__(self, size: int, ttl: float, negative_ttl: float,
+                 clock: Callable[[], float] = time.time) -> None:
+        self._entries = OrderedDict()
+        self._size = size
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._clock = clock
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Tuple[bool, Optional[str]]:
+        '''
+        Looks up a title, returning whether it was cached, and the title.
+        '''
+        entry = self._entries.get(key)
+        if entry is not None:
+            title, expires = entry
+            if expires > self._clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, title
+            del self._entries[key]
+        self.misses += 1
+        return False, None
+
+    def put(self, key: str, title: Optional[str]) -> None:
+        ttl = self._ttl if title is not None else self._negative_ttl
+        self._entries[key] = (title, self._clock() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def items(self) -> List[Tuple[str, Optional[str], float]]:
+        "The entries that haven't expired, as (key, title, expiry time), least recent first."
+        now = self._clock()
+        return [(key, title, expires) for key, (title, expires) in self._entries.items()
+                if expires > now]
+
+    def update(self, items: List[Tuple[str, Optional[str], float]]) -> None:
+        "Adds entries from items()."
+        now = self._clock()
+        for key, title, expires in items:
+            if expires > now:
+                self._entries[key] = (title, expires)
+                self._entries.move_to_end(key)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+
+# A function that looks up a host's addresses, giving (address, TTL in seconds or None) pairs.
+Lookup = Callable[[str], Awaitable[Sequence[Tuple[str, Optional[float]]]]]
+
+
+async def getaddrinfo_lookup(host: str) -> List[Tuple[str, Optional[float]]]:
+    '''
+    Looks up a host's IPv4 and IPv6 addresses with the event loop's resolver, which doesn't give
+    TTLs.
+    '''
+    loop = asyncio.get_event_loop()
+    infos = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    addresses = OrderedDict((info[4][0], None) for info in infos)
+    return list(addresses.items())
+
+
+class HostResolver:
+    '''
+    Resolves host names to addresses without blocking, caching the results.
+
+    Addresses are cached for their TTL, or ``ttl`` seconds if the lookup doesn't give one (and
+    for no more than ``ttl`` seconds either way). Failed lookups are cached for ``negative_ttl``
+    seconds. Concurrent lookups of the same host share one lookup. ``lookup`` does the actual
+    resolving, so that tests can replace it.
+    '''
+
+    def __init__(self, lookup: Lookup = getaddrinfo_lookup, ttl: float = 300.0,
+                 negative_ttl: float = 30.0, size: int = 4096,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self._lookup = lookup
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._size = size
+        self._clock = clock
+        self._cache = OrderedDict()
+        self._pending = {}
+
+    async def resolve(self, host: str) -> List[str]:
+        '''
+        Gets a host's addresses, raising OSError if it can't be resolved.
+        '''
+        host = host.lower()
+        try:
+            # addresses resolve to themselves
+            return [str(ipaddress.ip_address(host))]
+        except ValueError:
+            pass
+        entry = self._cache.get(host)
+        if entry is not None:
+            addresses, expires = entry
+            if expires > self._clock():
+                self._cache.move_to_end(host)
+                if addresses is None:
+                    raise OSError("could not resolve {}".format(host))
+                return addresses
+            del self._cache[host]
+        pending = self._pending.get(host)
+        if pending is None:
+            pending = asyncio.ensure_future(self._resolve(host))
+            self._pending[host] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(host, None))
+        # shielded, so that one waiter being cancelled doesn't cancel the lookup for the others
+        return await asyncio.shield(pending)
+
+    async def _resolve(self, host: str) -> List[str]:
+        try:
+            results = await self._lookup(host)
+        except (OSError, UnicodeError) as ex:
+            log.debug("could not resolve %s: %s", host, ex)
+            self._store(host, None, self._negative_ttl)
+            raise OSError("could not resolve {}".format(host))
+        addresses = [address for address, _ in results]
+        if not addresses:
+            self._store(host, None, self._negative_ttl)
+            raise OSError("could not resolve {}".format(host))
+        ttls = [ttl for _, ttl in results if ttl is not None]
+        self._store(host, addresses, min(ttls + [self._ttl]))
+        return addresses
+
+    def _store(self, host: str, addresses: Optional[List[str]], ttl: float) -> None:
+        self._cache[host] = (addresses, self._clock() + ttl)
+        self._cache.move_to_end(host)
+        while len(self._cache) > self._size:
+            self._cache.popitem(last=False)
+
+
+class SafeResolver(AbstractResolver):
+    '''
+    Lets aiohttp connect through a HostResolver, to only the addresses that ``allowed`` allows.
+
+    Links are checked before they're fetched, but this checks every connection again, including
+    ones to hosts that a link redirects to, and makes sure the address that was checked is the one
+    that is connected to.
+    '''
+
+    def __init__(self, resolver: HostResolver, allowed: Callable[[str], bool]) -> None:
+        self._resolver = resolver
+        self._allowed = allowed
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        results = []
+        for address in await self._resolver.resolve(host):
+            ip = ipaddress.ip_address(address)
+            address_family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+            if family not in (socket.AF_UNSPEC, address_family) or not self._allowed(address):
+                continue
+            results.append({
+                'hostname': host,
+                'host': address,
+                'port': port,
+                'family': address_family,
+                'proto': 0,
+                'flags': socket.AI_NUMERICHOST,
+            })
+        if not results:
+            raise OSError("no addresses of {} may be connected to".format(host))
+        return results
+
+    async def close(self):
+        pass
+
+
+class SharedState:
+    '''
+    What every Linkbot on an event loop shares: the fetches that are under way, the limits on how
+    many pages are fetched at once, and the title caches. There's one event loop per process, so
+    a link pasted on several servers is only fetched once.
+
+    Fetches and titles are keyed by the rules that decide whether a link may be fetched as well
+    as by the link, so that an instance is never answered by a fetch that another, laxer
+    instance made. Instances with the same max_fetches share one limit, and instances with the
+    same cache settings share one cache.
+    '''
+
+    def __init__(self) -> None:
+        self.in_flight = {}  # type: Dict[Tuple, asyncio.Future]
+        self._limits = {}  # type: Dict[int, asyncio.Semaphore]
+        self._caches = {}  # type: Dict[Tuple[int, float, float], TitleCache]
+
+    def limit(self, fetches: int) -> asyncio.Semaphore:
+        limit = self._limits.get(fetches)
+        if limit is None:
+            limit = self._limits[fetches] = asyncio.Semaphore(fetches)
+        return limit
+
+    def cache(self, size: int, ttl: float, negative_ttl: float) -> TitleCache:
+        settings = (size, ttl, negative_ttl)
+        cache = self._caches.get(settings)
+        if cache is None:
+            cache = self._caches[settings] = TitleCache(size, ttl, negative_ttl)
+        return cache
+
+
+_shared_state = weakref.WeakKeyDictionary()
+
+
+def shared_state(loop) -> SharedState:
+    "Gets the state shared by every Linkbot on an event loop."
+    shared = _shared_state.get(loop)
+    if shared is None:
+        shared = _shared_state[loop] = SharedState()
+    return shared
+
+
+def read_cache(path) -> List[Tuple[Tuple, Optional[str], float]]:
+    with open(path, 'rb') as fp:
+        return pickle.load(fp)
+
+
+def cache_entries(items) -> List[Tuple[Tuple, Optional[str], float]]:
+    "Drops cache entries from before titles were cached by the rules they were fetched under."
+    return [item for item in items if isinstance(item[0], tuple)]
 
 
 class Linkbot(Module):
@@ -50,88 +377,263 @@ class Linkbot(Module):
         'blacklist': [],
         'max_urls': 1,
         'follow_local_urls': False,
+        # the most pages to fetch at once
+        'max_fetches': 8,
+        # the most of a page to read looking for its title, in bytes
+        'max_bytes': 256 * 1024,
+        # HTTP connection pool
+        'connections': 100,
+        'connections_per_host': 4,
+        'keepalive': 30.0,
+        # timeouts, in seconds
+        'connect_timeout': 5.0,
+        'read_timeout': 10.0,
+        'deadline': 10.0,
+        # title cache; times are in seconds. If cache_file is set, the cache is saved there (in
+        # the module's data directory) when the module is unloaded.
+        'cache_size': 4096,
+        'cache_ttl': 6 * 60 * 60,
+        'negative_ttl': 5 * 60,
+        'cache_file': None,
+        # how long to cache DNS lookups for, at most, in seconds
+        'dns_ttl': 5 * 60,
+        'dns_negative_ttl': 30,
     }
 
-    async def on_message(self, channel, who, text):
-        global url_re
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = None
+        self.shared = shared_state(self.loop)
+        self.fetches = self.shared.limit(self.args['max_fetches'])
+        self.own_fetches = set()
+        self.resolver = HostResolver(
+            ttl=self.args['dns_ttl'], negative_ttl=self.args['dns_negative_ttl']
+        )
+        self.cache = self.shared.cache(
+            self.args['cache_size'], self.args['cache_ttl'], self.args['negative_ttl']
+        )
+
+    @property
+    def fetch_rules(self) -> Tuple:
+        "The arguments that decide which links may be fetched, for telling fetches apart."
+        return tuple(sorted(self.args['blacklist'])), bool(self.args['follow_local_urls'])
+
+    def memory_shared(self):
+        return (self.shared,)
+
+    def stats(self):
+        # the cache is shared with the other Linkbots in this process, so these count theirs too
+        return {
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses,
+            'cache_entries': len(self.cache),
+        }
+
+    async def export_state(self):
+        return self.cache.items()
+
+    async def import_state(self, state):
+        self.cache.update(cache_entries(state))
+
+    async def on_load(self):
+        if self.args['cache_file'] and not self.state_adopted:
+            path = self.data_dir() / self.args['cache_file']
+            if path.exists():
+                try:
+                    self.cache.update(cache_entries(await self.run_in_thread(read_cache, path)))
+                except Exception:
+                    log.exception("Could not read title cache %s", path)
+        # one session for the life of the module, so that connections to popular hosts are
+        # kept open and reused between links
+        connector = aiohttp.TCPConnector(
+            limit=self.args['connections'],
+            limit_per_host=self.args['connections_per_host'],
+            keepalive_timeout=self.args['keepalive'],
+            resolver=SafeResolver(self.resolver, self.is_allowed_address),
+            use_dns_cache=False,
+        )
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self.args['connect_timeout'],
+            sock_read=self.args['read_timeout'],
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def on_unload(self):
+        # fetches made with this session are cancelled, so that any other Linkbots waiting for
+        # them make them again themselves
+        for fetch in list(self.own_fetches):
+            fetch.cancel()
+        if self.session is not None:
+            session, self.session = self.session, None
+            await session.close()
+        if self.args['cache_file'] and not self.state_exported:
+            path = self.data_dir() / self.args['cache_file']
+            data = pickle.dumps(self.cache.items())
+            await self.run_in_thread(path.write_bytes, data)
+
+    async def handle_message(self, message: Message):
+        channel = message.channel
+        who = message.sender
         if not channel or not who:
             return
-        matches = url_re.findall(text)
-        urls = filter(self.is_valid_url, matches)
+        # every link is fetched at once, and the first max_urls titles are posted in the order
+        # the links were pasted
+        titles = await asyncio.gather(
+            *[self.cached_title(url) for url in message.urls], return_exceptions=True
+        )
         count = 0
-        for url in urls:
+        for title in titles:
             if count >= self.args['max_urls']:
                 break
+            if isinstance(title, LinkbotError):
+                self.server.send_message(channel, "{}: {}".format(who, title.chan_message))
+                continue
+            elif isinstance(title, BaseException):
+                raise title
+            if not title:
+                continue
+            if len(title) > 512:
+                title = title[0:512]
+            self.server.send_message(channel, title)
+            count += 1
+
+    async def cached_title(self, url):
+        '''
+        Gets the title of a URL from the cache, or fetches it if it isn't cached (and is valid).
+        '''
+        try:
+            hostname = urlparse(url).hostname
+            # titles are cached by the rules they were fetched under too, so that changing the
+            # rules doesn't post titles of links that the new rules wouldn't fetch
+            key = (self.fetch_rules, normalize_url(url))
+        except ValueError:
+            return None
+        # links that can be turned down without resolving their host are turned down before
+        # the cache is looked at
+        if not hostname or not self.is_allowed_host(hostname):
+            return None
+        cached, title = self.cache.get(key)
+        if cached:
+            return title
+        if not await self.is_valid_url(url):
+            return None
+        title = await self._shared_fetch(key, url)
+        self.cache.put(key, title)
+        return title
+
+    async def _shared_fetch(self, fetch_key, url):
+        "Fetches a title, or waits for the same fetch if another Linkbot is already making it."
+        in_flight = self.shared.in_flight
+        while True:
+            fetch = in_flight.get(fetch_key)
+            if fetch is None:
+                fetch = asyncio.ensure_future(self._fetch_limited(url))
+                in_flight[fetch_key] = fetch
+                self.own_fetches.add(fetch)
+
+                def done(_, fetch=fetch):
+                    self.own_fetches.discard(fetch)
+                    if in_flight.get(fetch_key) is fetch:
+                        del in_flight[fetch_key]
+
+                fetch.add_done_callback(done)
             try:
-                title = await self.get_title(url)
-            except LinkbotError as ex:
-                self.server.send_message(channel, "{}: {}".format(who, ex.chan_message))
-            else:
-                if not title:
+                # shielded, so that the fetch carries on for anyone else waiting for it if this
+                # is cancelled
+                return await asyncio.shield(fetch)
+            except asyncio.CancelledError:
+                # the Linkbot that was making the fetch was unloaded, so it's made again
+                if fetch.cancelled() and self.session is not None:
                     continue
-                if len(title) > 512:
-                    title = title[0:512]
-                self.server.send_message(channel, title)
-                count += 1
+                raise
+
+    async def _fetch_limited(self, url):
+        async with self.fetches:
+            return await self.get_title(url)
 
     async def get_title(self, url):
         """
         Given a URL, attempts to get its title. If the URL does not match the content-type of text/*, None is
         returned.
+
+        Only as much of the page is downloaded as it takes to find the title, up to max_bytes, and
+        giving up after deadline seconds.
         :returns: either a title, or None if the title couldn't be found.
         """
-        # Get the request
         try:
             log.debug("getting title for %s", url)
-            async with aiohttp.ClientSession() as session:
-                async with session.head(url) as resp:
-                    await resp.text()
-                    headers = resp.headers
-                    status = resp.status
-                if status != 200:
-                    log.debug("invalid status code: %s", status)
-                    raise LinkbotError("{} error".format(status))
-                elif not fnmatch.fnmatch(headers['content-type'], 'text/*'):
-                    log.debug("invalid content-type: %s", headers['content-type'])
-                    return None
-                async with session.get(url) as resp:
-                    text = await resp.text()
+            title = await asyncio.wait_for(self._fetch_title(url), self.args['deadline'])
+        except asyncio.TimeoutError:
+            log.debug("timed out getting title for %s", url)
+            return None
         except Exception as ex:
             log.debug("invalid URL: %s", ex)
             return None
-        title_parser = HTMLTitleParser()
-        title_parser.feed(text)
-        return title_parser.title.strip()
+        if title is None:
+            return None
+        return title.strip()
+
+    async def _fetch_title(self, url):
+        async with self.session.get(url) as resp:
+            if resp.status != 200:
+                log.debug("invalid status code: %s", resp.status)
+                return None
+            elif not fnmatch.fnmatch(resp.content_type, 'text/*'):
+                log.debug("invalid content-type: %s", resp.content_type)
+                return None
+            # leaving the response early closes the connection rather than reading the rest of
+            # the page, which is cheaper than downloading what's left of a big page
+            return await read_title(
+                resp.content.iter_chunked(8192), resp.charset, self.args['max_bytes']
+            )
 
-    def is_valid_url(self, url):
+    async def is_valid_url(self, url):
         """
         Makes URL request to the given address. If they match the blacklist, or if their hosts resolve to an item in
         the blacklist, they are not followed. Also, if the URL does not parse, it is not followed.
+
+        Every address that the host resolves to (IPv4 and IPv6) must be allowed.
         """
-        global local_networks
         # make sure URL is valid
         try: url_parts = urlparse(url)
         except ValueError: return False # bad URL
 
         # make sure hostname is valid
-        location = url_parts.netloc
-        if not location: return False  # not a valid hostname
+        hostname = url_parts.hostname
+        if not hostname: return False  # not a valid hostname
 
         # make sure hostname isn't blacklisted
-        hostname = location if ':' in location else location.split(':')[0]
-        if hostname in self.args['blacklist']: return False  # blacklisted
+        if not self.is_allowed_host(hostname): return False
 
         # make sure address is valid
-        try: addr = socket.gethostbyname(hostname)
-        except socket.gaierror: return False  # bad hostname
+        try: addresses = await self.resolver.resolve(hostname)
+        except OSError: return False  # bad hostname
+
+        return all(map(self.is_allowed_address, addresses))
 
-        # make sure IP is not blacklisted
-        if addr in self.args['blacklist']: return False  # blacklisted
+    def is_allowed_host(self, hostname):
+        """
+        Whether links may be followed to a host, as far as can be told without resolving it: it
+        mustn't be blacklisted, and if it's an address, the address must be allowed.
+        """
+        if hostname in self.args['blacklist']: return False  # blacklisted
+        try: ipaddress.ip_address(hostname)
+        except ValueError: return True  # a name, which is checked once it's resolved
+        return self.is_allowed_address(hostname)
+
+    def is_allowed_address(self, address):
+        """
+        Whether links may be followed to an address: it mustn't be blacklisted, and it must be
+        global unless local URLs are followed.
+        """
+        if address in self.args['blacklist']: return False  # blacklisted
 
         # make sure IP is not in local network if desired
         if not self.args['follow_local_urls']:
-            ip = ipaddress.ip_address(addr)
-            if not ip.is_global: log.warning("Linkbot tried to resolve non-global IP address: %s", addr)
+            ip = ipaddress.ip_address(address)
+            if ip.version == 6 and ip.ipv4_mapped is not None:
+                ip = ip.ipv4_mapped
+            if not ip.is_global: log.warning("Linkbot tried to resolve non-global IP address: %s", address)
             return ip.is_global
         else:
             # good URL
@@ -139,7 +641,6 @@ class Linkbot(Module):
 
 
 # TODO
-# * ipv6 support
 # * advanced pattern matching for links
 # * max title length parameter
 
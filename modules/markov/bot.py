@@ -1,3 +1,4 @@
+import asyncio
 from collections import defaultdict
 import functools
 import itertools
@@ -5,14 +6,27 @@ import logging
 from pathlib import Path
 import pickle
 import random
-from typing import Optional, MutableMapping, Mapping
-from omnibot import Module
-from .chain import MarkovChain
+from typing import Optional, MutableMapping, Mapping, Union
+from omnibot import Message, Module
+from .chain import MarkovChain, MergedChain, VOCABULARY, ngram_words
 
 
 log = logging.getLogger(__name__)
 
 
+def read_chains(path: Path) -> MutableMapping[str, MutableMapping[str, MarkovChain]]:
+    with open(path, "rb") as fp:
+        return pickle.load(fp)
+
+
+def _adopt_chain(chain) -> MarkovChain:
+    if isinstance(chain, MarkovChain):
+        return chain
+    adopted = MarkovChain(chance=chain._chance, listen=chain._listen)
+    adopted.merge(chain)
+    return adopted
+
+
 class Markov(Module):
     default_args = {
         "chainfile": "markov.pickle",
@@ -21,13 +35,16 @@ class Markov(Module):
         "reply_chance": 0.01,
     }
 
+    state_version = 1
+
+    # chain files can be large, so they're read while the server connects
+    preload = False
+
     chains: MutableMapping[str, MutableMapping[str, MarkovChain]]
-    all_chains: MutableMapping[str, MarkovChain]
 
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.chains = defaultdict(functools.partial(defaultdict, MarkovChain))
-        self.all_chains = defaultdict(MarkovChain)
         self.__save_task = None
 
     @property
@@ -46,52 +63,80 @@ class Markov(Module):
     def chainfile(self) -> Path:
         return self.data_dir() / Path(self.args['chainfile'])
 
+    def channel_chain(self, channel: str) -> MergedChain:
+        "A view of every chain in a channel, as though they were one."
+        return MergedChain(self.chains[channel])
+
+    def memory_breakdown(self):
+        return dict(self.chains)
+
+    def memory_shared(self):
+        return (VOCABULARY,)
+
+    async def export_state(self):
+        return {"chains": self.chains}
+
+    async def import_state(self, state):
+        # the chains may be instances of the MarkovChain class from before the module was
+        # executed again, so they are copied into this one, and into its vocabulary
+        self.chains = defaultdict(functools.partial(defaultdict, MarkovChain))
+        for channel, chains in state["chains"].items():
+            for who, chain in chains.items():
+                self.chains[channel][who] = _adopt_chain(chain)
+
     async def on_load(self):
+        if self.state_adopted:
+            log.debug("Adopted chains from the previous instance")
+            self.__save_task = self.loop.create_task(self.save_periodically())
+            return
         path = self.chainfile
         log.debug("Loading markov chain file %s", path)
         if not path.exists():
             log.info("Markov chain file %s does not exist, it will be created", path)
         else:
-            with open(path, "rb") as fp:
-                self.chains = pickle.load(fp)
-        log.debug("Building allchains")
-        self.all_chains = defaultdict(MarkovChain)
-        for channel, chains in self.chains.items():
-            for chain in chains.values():
-                self.all_chains[channel].merge(chain)
+            self.chains = await self.run_in_thread(read_chains, path)
         log.debug("Registering save handler")
-        self.__save_task = self.loop.call_later(self.save_every, self.save)
+        self.__save_task = self.loop.create_task(self.save_periodically())
 
     async def on_unload(self):
         if self.__save_task is not None:
             self.__save_task.cancel()
-        self.save(shutdown=True)
+            self.__save_task = None
+        if not self.state_exported:
+            await self.save()
 
-    def save(self, shutdown: bool = False):
+    async def save_periodically(self):
+        while True:
+            await asyncio.sleep(self.save_every)
+            try:
+                await self.save()
+            except Exception:
+                log.exception("Could not save markov chain file %s", self.chainfile)
+
+    async def save(self):
         path = self.chainfile
         log.debug("Saving markov chain file %s", path)
-        with open(path, "wb") as fp:
-            pickle.dump(self.chains, fp)
-        if shutdown:
-            self.__save_task = None
-        else:
-            self.__save_task = self.loop.call_later(self.save_every, self.save)
-
-    async def on_message(self, channel: Optional[str], who: Optional[str], text: str):
+        # chains are pickled on the event loop so that they can't change while they're being
+        # pickled; only the write happens on another thread
+        data = pickle.dumps(self.chains)
+        await self.run_in_thread(path.write_bytes, data)
+
+    async def handle_message(self, message: Message):
+        channel = message.channel
+        who = message.sender
         if None in (channel, who):
             return
-        words = text.split(" ")
 
         # handle command
-        if words and words[0] == "!markov":
-            await self.on_command("!markov", channel, who, text)
+        if message.command == "!markov":
+            await self.on_command("!markov", channel, who, message.message)
             return
 
         chain = self.chains[channel][who]
         if chain.listen == False:
             return
-        chain.train(text, self.order)
-        self.all_chains[channel].train(text, self.order)
+        words = message.view(ngram_words)
+        chain.train_words(words, self.order)
         chance = self.reply_chance if chain.chance is None else chain.chance
         if chance == 0.0:
             return
@@ -112,8 +157,7 @@ class Markov(Module):
         if command == "force":
             self.interject(channel, who)
         elif command == "all":
-            allchain = self.all_chains[channel]
-            self.interject(channel, who, allchain)
+            self.interject(channel, who, self.channel_chain(channel))
         elif command in ("emulate", "mock"):
             if len(parts) < 3:
                 return
@@ -124,7 +168,7 @@ class Markov(Module):
                     break
         elif command == "status":
             my_total = self.chains[channel][who].total_weight()
-            all_total = self.all_chains[channel].total_weight()
+            all_total = self.channel_chain(channel).total_weight()
             if all_total == 0:
                 return
             status = (my_total / all_total) * 100.0
@@ -149,7 +193,9 @@ class Markov(Module):
             except ValueError:
                 self.server.send_message(who, error_message)
 
-    def interject(self, channel: str, who: str, chain: MarkovChain = None) -> None:
+    def interject(
+        self, channel: str, who: str, chain: Union[MarkovChain, MergedChain] = None
+    ) -> None:
         if chain is None:
             if who not in self.chains[channel]:
                 return
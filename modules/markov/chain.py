@@ -1,8 +1,13 @@
+from array import array
 from collections import defaultdict, namedtuple
 import itertools
 import random
 import re
-from typing import Any, Optional, Sequence, List, Tuple, MutableMapping, Mapping
+import threading
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, Optional, Sequence, List, Tuple, MutableMapping,
+    Mapping, Union,
+)
 
 
 def window(seq, n):
@@ -29,24 +34,193 @@ NGRAM_BREAK = re.compile(
     re.X,
 )
 
+def ngram_words(text: str) -> Sequence[str]:
+    "Splits text into the words and punctuation that chains are trained on."
+    return tuple(match.group(0) for match in NGRAM_RE.finditer(text))
+
+
 Link = MutableMapping[Optional[str], int]
 Ngram = Tuple[Optional[str]]
 
+# N-grams are stored as their word ids packed into one integer, ID_BITS bits per word, and the
+# words that follow an n-gram are either one (id << ID_BITS | count) integer, which is by far the
+# most common case, or an array of alternating ids and counts.
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+Successors = Union[int, array]
+
+
+def pack(ids: Iterable[int]) -> int:
+    "Packs a sequence of word ids into one integer."
+    key = 0
+    for id in ids:
+        key = key << ID_BITS | id
+    return key
+
+
+def unpack(key: int) -> Tuple[int, ...]:
+    "Unpacks an integer made by pack. Ids are never 0, so the number of ids is unambiguous."
+    ids = []
+    while key:
+        ids.append(key & ID_MASK)
+        key >>= ID_BITS
+    return tuple(reversed(ids))
+
+
+def successors(value: Successors) -> Iterator[Tuple[int, int]]:
+    "The (word id, count) pairs stored for an n-gram."
+    if isinstance(value, int):
+        yield value >> ID_BITS, value & ID_MASK
+    else:
+        yield from zip(value[::2], value[1::2])
+
+
+class Vocabulary:
+    """
+    Interns the words that chains are made of as integer ids, so that each word is stored once no
+    matter how many chains and n-grams use it.
+
+    Id 0 is never used, and None (the end of a sentence) is always 1. Words are never forgotten,
+    even when no chain uses them any more. Words can be added from any thread, since chains are
+    unpickled into the shared vocabulary off the event loop.
+    """
+
+    def __init__(self, words: Iterable[Optional[str]] = ()) -> None:
+        self._words = [None, None]
+        self._ids = {None: 1}
+        self._lock = threading.Lock()
+        self._translation = None
+        for word in words:
+            self.id(word)
+
+    def __len__(self) -> int:
+        return len(self._words) - 1
+
+    def id(self, word: Optional[str]) -> int:
+        "Gets the id of a word, adding it if it's new."
+        id = self._ids.get(word)
+        if id is None:
+            with self._lock:
+                id = self._ids.get(word)
+                if id is None:
+                    self._words.append(word)
+                    id = self._ids[word] = len(self._words) - 1
+        return id
+
+    def find(self, word: Optional[str]) -> Optional[int]:
+        "Gets the id of a word, or None if it hasn't been added."
+        return self._ids.get(word)
+
+    def word(self, id: int) -> Optional[str]:
+        return self._words[id]
+
+    def translation(self, target: "Vocabulary") -> Optional[array]:
+        """
+        Maps the ids of this vocabulary to the ids of the same words in another, adding any that
+        it's missing; or None if they're the same vocabulary.
+        """
+        if target is self:
+            return None
+        cached = self._translation
+        if cached is None or cached[0] is not target or len(cached[1]) != len(self._words):
+            ids = array("I", [0])
+            ids.extend(map(target.id, self._words[1:]))
+            self._translation = cached = (target, ids)
+        return cached[1]
+
+    def __getstate__(self):
+        return {"words": self._words[2:]}
+
+    def __setstate__(self, state):
+        self.__init__(state["words"])
+
+
+# The vocabulary shared by every chain that isn't given one.
+VOCABULARY = Vocabulary()
+
+
+def walk_sentence(
+    vocabulary: Vocabulary,
+    key: int,
+    choose_id: Callable[[int], Optional[int]],
+    contains: Callable[[int], bool],
+    max_length: int = None,
+) -> str:
+    """
+    Makes a sentence starting from the n-gram with the given key, choosing each next word with
+    ``choose_id`` until the sentence ends or reaches an n-gram that ``contains`` says isn't known.
+    """
+    ids = unpack(key)
+    # shifting the oldest word out of a key keeps its length, since no id is 0
+    mask = (1 << ID_BITS * len(ids)) - 1
+    word_of = vocabulary.word
+    words = list(filter(bool, map(word_of, ids)))
+    while True:
+        if max_length is not None and len(words) >= max_length:
+            break
+        id = choose_id(key)
+        word = None if id is None else word_of(id)
+        if word is None:
+            break
+        words += [word]
+        if NGRAM_BREAK.match(word):
+            break
+        key = (key << ID_BITS | id) & mask
+        if not contains(key):
+            break
+    sentence = ""
+    for i, word in enumerate(words):
+        if i != 0 and not NGRAM_BREAK.match(word) and not word.startswith(","):
+            sentence += " "
+        sentence += str(word)
+    return sentence
+
 
 class MarkovChain:
+    """
+    A markov chain of words, counting how often each word follows each n-gram.
+
+    Words are stored as ids from a Vocabulary that's shared between chains, and the n-grams and
+    counts as packed integers and arrays, which takes a fraction of the memory of tuples and dicts
+    of strings. ``links`` still gives the chain in words.
+
+    Every n-gram is also kept in a list, so that one can be chosen at random without copying the
+    chain's keys, and so are the n-grams that sentences have started with, which is where
+    make_sentence starts.
+    """
+
     def __init__(
         self,
-        links: MutableMapping[Ngram, Link] = None,
+        links: Mapping[Ngram, Link] = None,
         chance: Optional[float] = None,
         listen: Optional[bool] = None,
+        vocabulary: Vocabulary = None,
     ):
-        self._links = links or {}
+        self._vocabulary = vocabulary or VOCABULARY
+        self._links = {}  # type: Dict[int, Successors]
+        self._keys = []  # type: List[int]
+        self._starts = []  # type: List[int]
+        self._start_set = set()
         self._chance = chance
         self._listen = listen
+        if links:
+            self._merge_words(links)
 
     @property
-    def links(self) -> MutableMapping[Ngram, Link]:
-        return self._links
+    def vocabulary(self) -> Vocabulary:
+        return self._vocabulary
+
+    @property
+    def links(self) -> Mapping[Ngram, Link]:
+        """
+        The words that follow each n-gram and their counts, in words. This is built each time it
+        is asked for, so it's slow for large chains.
+        """
+        word = self._vocabulary.word
+        return {
+            tuple(map(word, unpack(key))): {word(id): count for id, count in successors(value)}
+            for key, value in self._links.items()
+        }
 
     @property
     def chance(self) -> Optional[float]:
@@ -54,7 +228,7 @@ class MarkovChain:
 
     @chance.setter
     def chance(self, chance: Optional[float]):
-        self.chance = chance
+        self._chance = chance
 
     @property
     def listen(self) -> bool:
@@ -64,82 +238,225 @@ class MarkovChain:
 
     @listen.setter
     def listen(self, listen: Optional[bool]):
-        self.listen = listen
+        self._listen = listen
 
-    def update_weight(self, words: Ngram, link: Optional[str], weight: int = None):
-        weight = weight or 1
-        if words not in self.links:
-            self.links[words] = {link: weight}
-        elif link not in self.links[words]:
-            self.links[words][link] = weight
+    def __len__(self) -> int:
+        "The number of n-grams in this chain."
+        return len(self._links)
+
+    def _add(self, key: int, id: int, weight: int) -> None:
+        value = self._links.get(key)
+        if value is None:
+            self._links[key] = id << ID_BITS | weight
+            self._keys.append(key)
+        elif isinstance(value, int):
+            if value >> ID_BITS == id:
+                self._links[key] = value + weight
+            else:
+                self._links[key] = array("I", (value >> ID_BITS, value & ID_MASK, id, weight))
         else:
-            self.links[words][link] += weight
+            try:
+                index = value[::2].index(id) * 2 + 1
+            except ValueError:
+                value.extend((id, weight))
+            else:
+                value[index] += weight
+
+    def _add_start(self, key: int) -> None:
+        if key not in self._start_set:
+            self._start_set.add(key)
+            self._starts.append(key)
+
+    def update_weight(self, words: Ngram, link: Optional[str], weight: int = None):
+        vocabulary_id = self._vocabulary.id
+        self._add(pack(map(vocabulary_id, words)), vocabulary_id(link), weight or 1)
+
+    def _key(self, ngram: Ngram) -> Optional[int]:
+        "The key of an n-gram, or None if one of its words isn't in the vocabulary."
+        ids = [self._vocabulary.find(word) for word in ngram]
+        if None in ids:
+            return None
+        return pack(ids)
+
+    def _choose_id(self, key: int) -> Optional[int]:
+        value = self._links.get(key)
+        if value is None:
+            return None
+        if isinstance(value, int):
+            return value >> ID_BITS
+        return random.choices(value[::2], value[1::2])[0]
 
     def choose_ngram(self) -> Optional[Ngram]:
         """
         Randomly chooses an n-gram from this chain's list.
         """
-        if len(self.links) == 0:
+        if len(self._links) == 0:
             return None
-        return random.choice(list(self.links.keys()))
+        key = random.choice(self._keys)
+        return tuple(map(self._vocabulary.word, unpack(key)))
 
     def choose_word(self, ngram: Ngram) -> Optional[str]:
-        if ngram not in self.links or len(self.links[ngram]) == 0:
+        key = self._key(ngram)
+        if key is None:
             return None
-        links = self.links[ngram]
-        return random.choices(list(links.keys()), links.values())[0]
+        id = self._choose_id(key)
+        return None if id is None else self._vocabulary.word(id)
 
     def make_sentence(self, max_length: int = None) -> Optional[str]:
-        last_ngram = self.choose_ngram()
-        if last_ngram is None:
+        if len(self._links) == 0:
             return None
-        words = list(filter(bool, last_ngram))
-        while True:
-            if max_length is not None and len(words) >= max_length:
-                break
-            word = self.choose_word(last_ngram)
-            if word is None:
-                break
-            words += [word]
-            if NGRAM_BREAK.match(word):
-                break
-            last_ngram = (*last_ngram[1:], word)
-            if last_ngram not in self.links:
-                break
-        sentence = ""
-        for i, word in enumerate(words):
-            if i != 0 and not NGRAM_BREAK.match(word) and not word.startswith(","):
-                sentence += " "
-            sentence += str(word)
-        return sentence
+        # chains loaded from before starts were recorded start anywhere
+        key = random.choice(self._starts or self._keys)
+        return walk_sentence(
+            self._vocabulary, key, self._choose_id, self._links.__contains__, max_length
+        )
 
     def train(self, text: str, order: int) -> None:
         """
         Trains this markov chain with the given string and order.
         """
-        words = [match.group(0) for match in NGRAM_RE.finditer(text)]
-        while len(words) < order + 1:
-            words += [None]
-        for view in window(words, order + 1):
-            link = view[-1]
-            ngram = view[:-1]
-            self.update_weight(ngram, link)
+        self.train_words(ngram_words(text), order)
 
-    def merge(self, other: 'MarkovChain') -> None:
-        for words, weights in other.links.items():
+    def train_words(self, words: Sequence[str], order: int) -> None:
+        """
+        Trains this markov chain with text that has already been split by ngram_words.
+        """
+        ids = list(map(self._vocabulary.id, words))
+        while len(ids) < order + 1:
+            ids += [1]
+        for i, view in enumerate(window(ids, order + 1)):
+            key = pack(view[:-1])
+            self._add(key, view[-1], 1)
+            # sentences start at the start of the text, and after every break
+            if i == 0 or NGRAM_BREAK.match(words[i - 1]):
+                self._add_start(key)
+
+    def _merge_words(self, links: Mapping[Ngram, Link]) -> None:
+        for words, weights in links.items():
             for link, weight in weights.items():
                 self.update_weight(words, link, weight)
 
+    def _merge_links(
+        self, vocabulary: Vocabulary, links: Mapping[int, Successors], starts: Iterable[int] = ()
+    ) -> None:
+        translation = vocabulary.translation(self._vocabulary)
+
+        def translate(key):
+            return key if translation is None else pack(translation[id] for id in unpack(key))
+
+        for key in starts:
+            self._add_start(translate(key))
+        for key, value in links.items():
+            key = translate(key)
+            if key not in self._links:
+                # new n-grams are copied whole rather than added a word at a time
+                if isinstance(value, int):
+                    if translation is not None:
+                        value = translation[value >> ID_BITS] << ID_BITS | value & ID_MASK
+                else:
+                    value = array("I", value)
+                    if translation is not None:
+                        value[::2] = array("I", (translation[id] for id in value[::2]))
+                self._links[key] = value
+                self._keys.append(key)
+                continue
+            for id, weight in successors(value):
+                self._add(key, id if translation is None else translation[id], weight)
+
+    def merge(self, other: 'MarkovChain') -> None:
+        if hasattr(other, "_vocabulary"):
+            self._merge_links(other._vocabulary, other._links, getattr(other, "_starts", ()))
+        else:
+            # a chain from before words were interned
+            self._merge_words(other.links)
+
     def total_weight(self) -> int:
         total = 0
-        for weights in self.links.values():
-            for weight in weights.values():
-                total += weight
+        for value in self._links.values():
+            if isinstance(value, int):
+                total += value & ID_MASK
+            else:
+                total += sum(value[1::2])
         return total
 
+    def __getstate__(self):
+        return {
+            "vocabulary": self._vocabulary,
+            "links": self._links,
+            "starts": self._starts,
+            "chance": self._chance,
+            "listen": self._listen,
+        }
+
+    def __setstate__(self, state):
+        if "_links" in state:
+            # pickled before words were interned
+            self.__init__(state["_links"], state.get("_chance"), state.get("_listen"))
+            return
+        self.__init__(chance=state["chance"], listen=state["listen"])
+        # the pickled vocabulary is a copy, so the chain is moved into the shared one
+        self._merge_links(state["vocabulary"], state["links"], state.get("starts", ()))
+
     def __repr__(self) -> str:
         return "<MarkovChain(ngrams=%r, chance=%s, listen=%s)>" % (
             self.links,
             self.chance,
             self.listen,
         )
+
+
+class MergedChain:
+    """
+    A read-only view of several chains as though they were merged into one, e.g. every chain of
+    a channel.
+
+    Nothing is copied: the chains are looked at each time the view is used, so it is always up to
+    date and takes no memory of its own, but choosing each word looks at every chain. Chains that
+    don't share the first chain's vocabulary are left out.
+    """
+
+    def __init__(self, chains: Mapping[Any, MarkovChain]) -> None:
+        self._chains = chains
+
+    def _members(self) -> List[MarkovChain]:
+        chains = [chain for chain in self._chains.values() if len(chain) > 0]
+        if not chains:
+            return []
+        vocabulary = chains[0].vocabulary
+        return [chain for chain in chains if chain.vocabulary is vocabulary]
+
+    def total_weight(self) -> int:
+        return sum(chain.total_weight() for chain in self._chains.values())
+
+    def make_sentence(self, max_length: int = None) -> Optional[str]:
+        chains = self._members()
+        if not chains:
+            return None
+        # choosing a chain by how many starts it has, and then one of its starts, is close to
+        # choosing from all of their starts, without gathering them
+        starts = [chain._starts for chain in chains]
+        if not any(starts):
+            starts = [chain._keys for chain in chains]
+        keys = random.choices(starts, list(map(len, starts)))[0]
+        links = [chain._links for chain in chains]
+
+        def choose_id(key):
+            counts = {}
+            for chain_links in links:
+                value = chain_links.get(key)
+                if value is not None:
+                    for id, count in successors(value):
+                        counts[id] = counts.get(id, 0) + count
+            if not counts:
+                return None
+            return random.choices(list(counts), list(counts.values()))[0]
+
+        def contains(key):
+            return any(key in chain_links for chain_links in links)
+
+        return walk_sentence(
+            chains[0].vocabulary, random.choice(keys), choose_id, contains, max_length
+        )
+
+    def __repr__(self) -> str:
+        return "<MergedChain(chains=%d)>" % len(self._chains)
@@ -26,10 +26,8 @@ class Nickserv(Module):
         elif 'Your nickname is not registered' in text:
             self.register()
 
-    def should_handle(self, msg) -> bool:
-        return bool(msg.prefix) \
-                and bool(msg.prefix.nick) \
-                and msg.prefix.nick.lower() == self.args['nickserv'].lower()
+    def route_nicks(self):
+        return (self.args['nickserv'],)
 
     def login(self):
         self.server.send_message(self.args['nickserv'],
@@ -4,10 +4,9 @@ import operator
 from pathlib import Path
 import random
 import sqlite3
-from string import punctuation
 import time
-from typing import Mapping, Optional, Sequence, Tuple
-from omnibot import Module
+from typing import Mapping, Optional, Sequence, Set, Tuple
+from omnibot import Message, Module
 from .game import Game
 
 
@@ -50,6 +49,9 @@ class Wordbot(Module):
         "ignore": [],
     }
 
+    # the wordlist and database can be read while the server connects
+    preload = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._games = {}
@@ -67,11 +69,15 @@ class Wordbot(Module):
         """
         Ensures the current database state and recreates the current state if necessary.
         """
-        self._ensure_database()
-        with open(self.wordlist_path) as fp:
-            self._words = set(map(str.strip, fp))
+        await self.run_in_thread(self._ensure_database)
+        self._words = await self.run_in_thread(self._read_wordlist)
         log.info("loaded %s words", len(self._words))
 
+    def memory_breakdown(self):
+        breakdown = {None: self._words}
+        breakdown.update(self._games)
+        return breakdown
+
     async def on_unload(self):
         """
         Flushes the current state to the database before exiting.
@@ -82,9 +88,9 @@ class Wordbot(Module):
         Handles game creation and restoration.
         """
         if who is None:
-            self.restore_game(channel)
+            await self.restore_game(channel)
 
-    async def on_message(self, channel: Optional[str], who: Optional[str], text: str):
+    async def handle_message(self, message: Message):
         """
         Handle a line of text for Wordbot.
 
@@ -99,29 +105,25 @@ class Wordbot(Module):
 
         Otherwise, the line is stripped, scanned, and checked for winning words.
         """
-        parts = text.split()
+        channel = message.channel
+        who = message.sender
         if who is None or who in self.args["ignore"]:
             return
         elif channel not in self._games:
             return
-        elif len(parts) == 0:
+        elif message.command is None:
             return
-        elif parts[0] == "!wordbot":
-            await self.on_command(parts[0], channel, who, text)
-        elif parts[0][0] == "!" or channel is None:
+        elif message.command == "!wordbot":
+            await self.on_command(message.command, channel, who, message.message)
+        elif message.command[0] == "!" or channel is None:
             # attempt to ignore other commands and definitely ignore private messages
             return
         else:
             game = self._games[channel]
-            parts = set(
-                filter(len, [word.strip(punctuation).lower() for word in parts])
-            )
-            matches = parts & game.words
+            matches = game.words.intersection(message.tokens)
             if not matches:
                 return
-            with self._db() as db:
-                for word in matches:
-                    game.score(db, word, who, text)
+            await self.run_in_thread(self._score, game, matches, who, message.message)
             for word in matches:
                 self.server.send_message(
                     channel, "{}: Congrats! '{}' is good for 1 point.".format(who, word)
@@ -134,7 +136,7 @@ class Wordbot(Module):
         if len(parts) == 1:
             return
         if parts[1] == "leaderboard":
-            leaders = self.leaderboard(channel)
+            leaders = await self.run_in_thread(self.leaderboard, channel)
             lines = []
             for i, (name, score) in enumerate(leaders[:5]):
                 lines += ["{}. {}. {}".format(i + 1, name, score)]
@@ -155,7 +157,29 @@ class Wordbot(Module):
         """
         return sqlite3.connect(self.database_path)
 
-    def restore_game(self, channel: str):
+    def _read_wordlist(self):
+        """
+        Reads the set of words that games choose from.
+        """
+        with open(self.wordlist_path) as fp:
+            return set(map(str.strip, fp))
+
+    def _restore(self, channel: str) -> Optional[Game]:
+        """
+        Reads the current game for a channel from the database.
+        """
+        with self._db() as conn:
+            return Game.restore(conn, channel)
+
+    def _score(self, game: Game, words: Set[str], who: str, line: str):
+        """
+        Scores words that a user has found in a game.
+        """
+        with self._db() as conn:
+            for word in words:
+                game.score(conn, word, who, line)
+
+    async def restore_game(self, channel: str):
         """
         Restores or creates a game for the specified channel.
         """
@@ -163,8 +187,10 @@ class Wordbot(Module):
             # nothing to do since the game is already running and *should* have a callback set up
             return
         else:
-            with self._db() as conn:
-                game = Game.restore(conn, channel)
+            game = await self.run_in_thread(self._restore, channel)
+            if channel in self._games:
+                # restored while we were waiting on the database
+                return
             if game is None:
                 # create a new game
                 self.new_game(channel)
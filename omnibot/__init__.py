@@ -1,3 +1,4 @@
+from .message import *
 from .module import *
 from .server import *
 from .config import *
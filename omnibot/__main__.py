@@ -3,19 +3,27 @@ import asyncio
 import logging
 import pathlib
 import signal
-from omnibot import config_from_yaml, ServerManager
+from omnibot import bot_config_from_yaml, ServerManager
+from omnibot import executor
+from omnibot.memory import MemorySampler
+from omnibot.monitor import Monitor
+from omnibot.profiler import Profiler
+from omnibot.shard import ShardSupervisor
 
 log = logging.getLogger(__name__)
 manager = None
 
 
-def __reload_config(loop, filename: str, manager: ServerManager):
+def __reload_config(loop, filename: str, manager):
     log.info("Reloading configuration")
     try:
         # TODO is there a better way to determine the filetype?
         with open(filename) as fp:
             contents = fp.read()
-        coro = manager.reload(config_from_yaml(contents))
+        config = bot_config_from_yaml(contents)
+        if isinstance(manager, ShardSupervisor) and config.shards != len(manager.shards):
+            log.warning("Changing the number of shards requires a restart")
+        coro = manager.reload(config.servers)
         asyncio.ensure_future(coro, loop=loop)
     except Exception:
         logging.exception("Could not reload configuration")
@@ -25,10 +33,32 @@ async def __main(loop, args):
     global manager
     logging.basicConfig(level=logging.DEBUG)
     with open(args.config) as fp:
-        config = config_from_yaml(fp.read())
-    manager = ServerManager(config, loop=loop)
+        config = bot_config_from_yaml(fp.read())
+    if config.shards > 1:
+        manager = ShardSupervisor(
+            config.servers,
+            config.shards,
+            processes=config.processes,
+            http=config.http,
+            profiler=config.profiler,
+            memory=config.memory,
+            loop=loop,
+        )
+        toggle_profiler = manager.toggle_profiler
+    else:
+        executor.configure_process_pool(config.processes)
+        manager = ServerManager(config.servers, loop=loop)
+        memory = None
+        if config.memory is not None:
+            memory = MemorySampler(manager, config.memory, loop=loop)
+            memory.start()
+        if config.http is not None:
+            await Monitor(manager, config.http, loop=loop, memory=memory).start()
+        toggle_profiler = Profiler(config.profiler, manager, loop=loop).toggle
 
     loop.add_signal_handler(signal.SIGUSR1, __reload_config, loop, args.config, manager)
+    loop.add_signal_handler(signal.SIGUSR2, manager.dump_metrics)
+    loop.add_signal_handler(signal.SIGQUIT, toggle_profiler)
 
     await manager.run()
 
@@ -39,16 +69,19 @@ def parse_args():
     return parser.parse_args()
 
 
-args = parse_args()
-loop = asyncio.get_event_loop()
-try:
-    loop.run_until_complete(__main(loop, args))
-except KeyboardInterrupt:
-    log.info("Caught ctrl-c, attempting graceful exit")
-    tasks = asyncio.gather(*asyncio.Task.all_tasks(loop=loop), return_exceptions=True)
-    tasks.add_done_callback(lambda _: loop.stop())
-    tasks.cancel()
-    loop.run_forever()
-    loop.run_until_complete(manager.shutdown())
-finally:
-    loop.stop()
+# shard processes import this module too, so only run the bot when started directly
+if __name__ == "__main__":
+    args = parse_args()
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(__main(loop, args))
+    except KeyboardInterrupt:
+        log.info("Caught ctrl-c, attempting graceful exit")
+        tasks = asyncio.gather(*asyncio.all_tasks(loop), return_exceptions=True)
+        tasks.add_done_callback(lambda _: loop.stop())
+        tasks.cancel()
+        loop.run_forever()
+        loop.run_until_complete(manager.shutdown())
+    finally:
+        executor.shutdown_process_pool()
+        loop.stop()
@@ -0,0 +1,3 @@
+"""
+Tools for benchmarking omnibot without connecting to a real IRC network.
+"""
@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import yaml
+from ..loader import ModuleLoader
+from .replay import replay
+
+
+log = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="python -m omnibot.bench",
+        description="Benchmark a server's modules by replaying IRC traffic through them",
+    )
+    parser.add_argument("-c", "--config", metavar="CONFIG", default="omnibot.yml")
+    parser.add_argument(
+        "-s", "--server", help="the server whose modules to load (default: the first one)"
+    )
+    parser.add_argument("-m", "--modules", default="modules", help="where to find modules")
+    parser.add_argument(
+        "-i", "--input", help="a file of raw IRC lines to replay, instead of synthetic traffic"
+    )
+    parser.add_argument("-n", "--lines", type=int, default=10000, help="synthetic lines per run")
+    parser.add_argument("--users", type=int, default=50, help="synthetic users")
+    parser.add_argument("--seed", type=int, default=0, help="seed for synthetic traffic")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="timed runs")
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip the extra run that traces memory"
+    )
+    parser.add_argument("--json", metavar="FILE", help="also write the results as JSON")
+    return parser.parse_args()
+
+
+def report(runs, memory) -> str:
+    rates = [run["rate"] for run in runs]
+    lines = [
+        "{} lines, {} runs: {:.0f} lines/s median, {:.0f} best".format(
+            runs[0]["lines"], len(runs), statistics.median(rates), max(rates)
+        ),
+        "",
+        "{:<20} {:>8} {:>6} {:>10} {:>10} {:>10}".format(
+            "module", "calls", "errors", "total s", "p50 ms", "p99 ms"
+        ),
+    ]
+    best = max(runs, key=lambda run: run["rate"])
+    for name, stats in sorted(best["modules"].items(), key=lambda item: -item[1]["seconds"]):
+        lines += [
+            "{:<20} {:>8} {:>6} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                name,
+                stats["calls"],
+                stats["errors"],
+                stats["seconds"],
+                (stats["p50"] or 0.0) * 1e3,
+                (stats["p99"] or 0.0) * 1e3,
+            )
+        ]
+    if memory is not None:
+        lines += [
+            "",
+            "memory: {:.1f} KiB peak, {:.1f} KiB still held after the replay".format(
+                memory["peak"] / 1024, memory["current"] / 1024
+            ),
+        ]
+        for site in memory["sites"]:
+            lines += [
+                "  {:>10.1f} KiB {:>8} blocks  {}".format(
+                    site["size"] / 1024, site["count"], site["site"]
+                )
+            ]
+    return "\n".join(lines)
+
+
+async def main(args):
+    with open(args.config) as fp:
+        config = yaml.safe_load(fp.read()) or {}
+    servers = config.get("server") or {}
+    if not servers:
+        raise SystemExit("no servers are configured in " + args.config)
+    name = args.server or next(iter(servers))
+    if name not in servers:
+        raise SystemExit("no server named {} is configured".format(name))
+    lines = None
+    if args.input:
+        with open(args.input, encoding="utf-8", errors="replace") as fp:
+            lines = [line.rstrip("\r\n") for line in fp if line.strip()]
+
+    loader = ModuleLoader([args.modules])
+    options = dict(lines=lines, count=args.lines, users=args.users, seed=args.seed)
+    runs = []
+    for _ in range(args.repeat):
+        runs.append(await replay(loader, name, servers[name], **options))
+    memory = None
+    if not args.no_memory:
+        memory = (await replay(loader, name, servers[name], trace_memory=True, **options))["memory"]
+    print(report(runs, memory))
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump({"runs": runs, "memory": memory}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parse_args()))
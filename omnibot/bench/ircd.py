@@ -0,0 +1,324 @@
+import asyncio
+from collections import Counter
+import logging
+import time
+from typing import Callable, Mapping, Set
+from irclib.parser import Message as IrcMessage
+
+
+log = logging.getLogger(__name__)
+
+
+# The longest line a client may send, including the trailing CR-LF.
+MAX_LINE_BYTES = 512
+
+
+class Client:
+    """
+    A user of the server: either a socket connection, or a simulated user with no connection.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter = None, burst: float = 0.0) -> None:
+        self.writer = writer
+        self.nick = None
+        self.user = None
+        self.registered = False
+        self.negotiating = False
+        self.channels = set()
+        # flood control
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    @property
+    def simulated(self) -> bool:
+        return self.writer is None
+
+    @property
+    def hostmask(self) -> str:
+        return "{}!{}@{}".format(self.nick, self.user or self.nick, "bench.example.com")
+
+    def send(self, line: str) -> None:
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(line.encode() + b"\r\n")
+
+
+class Ircd:
+    """
+    A small IRC server for testing against, speaking enough of the protocol for asyncirc and the
+    load generator: registration, JOIN, PART, KICK, PRIVMSG, NOTICE, PING, PONG and QUIT.
+
+    Connected clients are held to a flood limit: they may send ``flood_burst`` lines at once,
+    and ``flood_rate`` lines per second after that. Clients that go over the limit are
+    disconnected for excess flood, as a real server would. Simulated users (see ``add_user``) are
+    exempt.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        name: str = "irc.bench.example.com",
+        flood_burst: float = 10.0,
+        flood_rate: float = 1.0,
+    ) -> None:
+        self._host = host
+        self._port = port
+        self._name = name
+        self._flood_burst = flood_burst
+        self._flood_rate = flood_rate
+        self._server = None
+        self._clients = {}
+        self._connections = set()
+        self._channels = {}
+        self._listeners = []
+        self._stats = Counter()
+        self._answer_pings = True
+
+    @property
+    def host(self) -> str:
+        return self._host
+
+    @property
+    def port(self) -> int:
+        "The port being listened on. If it was 0, this is the port that was picked once started."
+        return self._port
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def stats(self) -> Mapping[str, int]:
+        """
+        Counts of what the server has seen: ``lines`` received from connections, ``flood_kills``,
+        and ``overlong`` lines.
+        """
+        return self._stats
+
+    @property
+    def answer_pings(self) -> bool:
+        "Whether PINGs are answered. Turning this off makes connections look stalled to clients."
+        return self._answer_pings
+
+    @answer_pings.setter
+    def answer_pings(self, answer: bool) -> None:
+        self._answer_pings = answer
+
+    def members(self, channel: str) -> Set[Client]:
+        return self._channels.get(channel.lower(), set())
+
+    def add_listener(self, listener: Callable[[Client, IrcMessage], None]) -> None:
+        """
+        Adds a function to be called with every line that a connection sends, after it is handled.
+        """
+        self._listeners.append(listener)
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self._host, self._port)
+        self._port = self._server.sockets[0].getsockname()[1]
+        log.info("Listening on %s:%s", self._host, self._port)
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        for client in list(self._connections):
+            client.writer.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    # Simulated users
+
+    def add_user(self, nick: str) -> Client:
+        """
+        Adds a simulated user, which can join channels and talk without a connection of its own.
+        """
+        client = Client()
+        client.nick = client.user = nick
+        client.registered = True
+        self._clients[nick.lower()] = client
+        return client
+
+    def act(self, client: Client, line: str) -> None:
+        "Handles a line as if a simulated user had sent it."
+        self._handle(client, IrcMessage.parse(line))
+
+    # Connections
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        client = Client(writer, self._flood_burst)
+        self._connections.add(client)
+        try:
+            while not writer.is_closing():
+                try:
+                    line = await reader.readline()
+                except (ConnectionError, ValueError):
+                    break
+                if not line:
+                    break
+                self._stats["lines"] += 1
+                if len(line) > MAX_LINE_BYTES:
+                    self._stats["overlong"] += 1
+                if not self._charge(client):
+                    self._stats["flood_kills"] += 1
+                    self._close(client, "Excess Flood")
+                    break
+                line = line.rstrip(b"\r\n")
+                if not line:
+                    continue
+                message = IrcMessage.parse(line.decode("utf-8", "replace"))
+                self._handle(client, message)
+                for listener in self._listeners:
+                    listener(client, message)
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    break
+        finally:
+            self._remove(client, "Connection closed")
+            self._connections.discard(client)
+            writer.close()
+
+    def _charge(self, client: Client) -> bool:
+        now = time.monotonic()
+        client.tokens = min(
+            self._flood_burst, client.tokens + (now - client.last) * self._flood_rate
+        )
+        client.last = now
+        if client.tokens < 1:
+            return False
+        client.tokens -= 1
+        return True
+
+    def _close(self, client: Client, reason: str) -> None:
+        client.send("ERROR :Closing Link: {} ({})".format(client.nick or "*", reason))
+        self._remove(client, reason)
+        if client.writer is not None:
+            client.writer.close()
+
+    def _remove(self, client: Client, reason: str) -> None:
+        if client.nick is None or self._clients.get(client.nick.lower()) is not client:
+            return
+        peers = set()
+        for channel in client.channels:
+            members = self._channels[channel]
+            members.discard(client)
+            peers |= members
+            if not members:
+                del self._channels[channel]
+        client.channels.clear()
+        for peer in peers:
+            peer.send(":{} QUIT :{}".format(client.hostmask, reason))
+        del self._clients[client.nick.lower()]
+
+    # Commands
+
+    def _numeric(self, client: Client, numeric: str, *params: str) -> None:
+        nick = client.nick or "*"
+        client.send(":{} {} {} {}".format(self._name, numeric, nick, " ".join(params)))
+
+    def _register(self, client: Client) -> None:
+        if client.registered or client.negotiating or not (client.nick and client.user):
+            return
+        client.registered = True
+        self._numeric(client, "001", ":Welcome to the benchmark network " + client.hostmask)
+        self._numeric(client, "376", ":End of /MOTD command.")
+
+    def _handle(self, client: Client, message: IrcMessage) -> None:
+        command = message.command.upper()
+        params = list(message.parameters)
+        if command == "CAP":
+            if params and params[0].upper() == "LS":
+                client.negotiating = True
+                client.send(":{} CAP * LS :".format(self._name))
+            elif params and params[0].upper() == "END":
+                client.negotiating = False
+                self._register(client)
+        elif command == "NICK" and params:
+            nick = params[0]
+            if nick.lower() in self._clients and self._clients[nick.lower()] is not client:
+                self._numeric(client, "433", nick, ":Nickname is already in use")
+                return
+            if client.nick is not None:
+                self._clients.pop(client.nick.lower(), None)
+            client.nick = nick
+            self._clients[nick.lower()] = client
+            self._register(client)
+        elif command == "USER" and params:
+            client.user = params[0]
+            self._register(client)
+        elif command == "PING":
+            if not self._answer_pings:
+                return
+            client.send(":{0} PONG {0} :{1}".format(self._name, params[-1] if params else ""))
+        elif command == "PONG":
+            pass
+        elif command == "QUIT":
+            self._close(client, "Quit: " + (params[0] if params else ""))
+        elif not client.registered:
+            self._numeric(client, "451", ":You have not registered")
+        elif command == "JOIN" and params:
+            for channel in params[0].split(","):
+                self._join(client, channel)
+        elif command == "PART" and params:
+            for channel in params[0].split(","):
+                self._part(client, channel, params[1] if len(params) > 1 else "")
+        elif command == "KICK" and len(params) >= 2:
+            self._kick(client, params[0], params[1], params[2] if len(params) > 2 else "")
+        elif command in ("PRIVMSG", "NOTICE") and len(params) >= 2:
+            self._message(client, command, params[0], params[1])
+        else:
+            self._numeric(client, "421", command, ":Unknown command")
+
+    def _broadcast(self, channel: str, line: str, exclude: Client = None) -> None:
+        for member in self.members(channel):
+            if member is not exclude:
+                member.send(line)
+
+    def _join(self, client: Client, channel: str) -> None:
+        key = channel.lower()
+        if key in client.channels:
+            return
+        self._channels.setdefault(key, set()).add(client)
+        client.channels.add(key)
+        self._broadcast(channel, ":{} JOIN {}".format(client.hostmask, channel))
+        if not client.simulated:
+            names = " ".join(sorted(member.nick for member in self.members(channel)))
+            self._numeric(client, "353", "=", channel, ":" + names)
+            self._numeric(client, "366", channel, ":End of /NAMES list.")
+
+    def _part(self, client: Client, channel: str, reason: str) -> None:
+        key = channel.lower()
+        if key not in client.channels:
+            self._numeric(client, "442", channel, ":You're not on that channel")
+            return
+        self._broadcast(channel, ":{} PART {} :{}".format(client.hostmask, channel, reason))
+        self._leave(client, key)
+
+    def _kick(self, client: Client, channel: str, nick: str, reason: str) -> None:
+        target = self._clients.get(nick.lower())
+        key = channel.lower()
+        if target is None or key not in target.channels:
+            self._numeric(client, "441", nick, channel, ":They aren't on that channel")
+            return
+        self._broadcast(
+            channel, ":{} KICK {} {} :{}".format(client.hostmask, channel, target.nick, reason)
+        )
+        self._leave(target, key)
+
+    def _leave(self, client: Client, key: str) -> None:
+        client.channels.discard(key)
+        members = self._channels.get(key)
+        if members is not None:
+            members.discard(client)
+            if not members:
+                del self._channels[key]
+
+    def _message(self, client: Client, command: str, target: str, text: str) -> None:
+        line = ":{} {} {} :{}".format(client.hostmask, command, target, text)
+        if target.startswith("#"):
+            self._broadcast(target, line, exclude=client)
+        elif target.lower() in self._clients:
+            self._clients[target.lower()].send(line)
+        else:
+            self._numeric(client, "401", target, ":No such nick/channel")
@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import copy
+import logging
+import random
+import tempfile
+import time
+from typing import Any, Mapping, Sequence
+import yaml
+from irclib.parser import Message as IrcMessage
+from ..config import ServerConfig
+from ..metrics import Histogram
+from ..server import ServerManager
+from .ircd import Client, Ircd
+from .replay import make_sentence, make_vocabulary
+
+
+log = logging.getLogger(__name__)
+
+
+class LoadGenerator:
+    """
+    Simulates users talking in channels on an Ircd, and measures how long a bot takes to reply.
+
+    Every user joins ``channels_per_user`` of the given channels, and users say something in one
+    of their channels ``rate`` times a second overall, with the occasional part and rejoin. If a
+    probe is given, a separate user says it in ``probe_channel`` every ``probe_interval``
+    seconds, and the time until ``nick`` next speaks in that channel is recorded as the reply
+    latency.
+    """
+
+    def __init__(
+        self,
+        ircd: Ircd,
+        channels: Sequence[str],
+        users: int = 1000,
+        channels_per_user: int = 3,
+        rate: float = 100.0,
+        seed: int = 0,
+        nick: str = None,
+        probe: str = None,
+        probe_channel: str = None,
+        probe_interval: float = 1.0,
+        probe_timeout: float = 10.0,
+    ) -> None:
+        self._ircd = ircd
+        self._channels = list(channels)
+        self._rng = random.Random(seed)
+        self._vocabulary = make_vocabulary(self._rng)
+        self._rate = rate
+        self._nick = nick
+        self._probe = probe
+        self._probe_channel = probe_channel or self._channels[0]
+        self._probe_interval = probe_interval
+        self._probe_timeout = probe_timeout
+        self._probe_started = None
+        self._latency = Histogram()
+        self._timeouts = 0
+        self._sent = 0
+        self._users = []
+        for n in range(users):
+            client = ircd.add_user("user{}".format(n))
+            count = min(channels_per_user, len(self._channels))
+            for channel in self._rng.sample(self._channels, count):
+                ircd.act(client, "JOIN " + channel)
+            self._users.append(client)
+        self._prober = None
+        if probe is not None:
+            self._prober = ircd.add_user("prober")
+            ircd.act(self._prober, "JOIN " + self._probe_channel)
+            ircd.add_listener(self._on_line)
+
+    @property
+    def latency(self) -> Histogram:
+        "Time from sending a probe to the bot's reply."
+        return self._latency
+
+    @property
+    def timeouts(self) -> int:
+        "The number of probes that got no reply in time."
+        return self._timeouts
+
+    @property
+    def sent(self) -> int:
+        "The number of messages that simulated users have sent."
+        return self._sent
+
+    def _on_line(self, client: Client, message: IrcMessage) -> None:
+        if self._probe_started is None or message.command != "PRIVMSG":
+            return
+        if client.nick != self._nick:
+            return
+        if message.parameters[0].lower() != self._probe_channel.lower():
+            return
+        self._latency.record(time.perf_counter() - self._probe_started)
+        self._probe_started = None
+
+    def _step(self, count: int) -> None:
+        for _ in range(count):
+            client = self._rng.choice(self._users)
+            if not client.channels:
+                self._ircd.act(client, "JOIN " + self._rng.choice(self._channels))
+                continue
+            channel = self._rng.choice(sorted(client.channels))
+            if self._rng.random() < 0.02:
+                self._ircd.act(client, "PART {} :brb".format(channel))
+                self._ircd.act(client, "JOIN " + channel)
+            else:
+                text = make_sentence(self._rng, self._vocabulary)
+                self._ircd.act(client, "PRIVMSG {} :{}".format(channel, text))
+                self._sent += 1
+
+    def _send_probe(self) -> None:
+        if self._probe_started is not None:
+            if time.perf_counter() - self._probe_started < self._probe_timeout:
+                return
+            self._timeouts += 1
+        self._probe_started = time.perf_counter()
+        self._ircd.act(self._prober, "PRIVMSG {} :{}".format(self._probe_channel, self._probe))
+
+    async def run(self, duration: float, tick: float = 0.01) -> None:
+        """
+        Generates load for the given number of seconds.
+        """
+        start = last_probe = time.perf_counter()
+        owed = 0.0
+        now = start
+        while now - start < duration:
+            await asyncio.sleep(tick)
+            elapsed = time.perf_counter() - now
+            now += elapsed
+            owed += elapsed * self._rate
+            self._step(int(owed))
+            owed -= int(owed)
+            if self._prober is not None and now - last_probe >= self._probe_interval:
+                last_probe = now
+                self._send_probe()
+
+
+def local_server_config(
+    name: str, obj: Mapping[str, Any], ircd: Ircd, data: str, reload_all: bool = False
+) -> ServerConfig:
+    """
+    Makes a server's configuration point at a local Ircd, keeping module data in a scratch
+    directory. With ``reload_all``, every module is reloaded when this configuration is applied.
+    """
+    obj = copy.deepcopy(dict(obj))
+    obj.update(address=ircd.host, port=ircd.port, ssl=False, data=data)
+    if reload_all:
+        for module in (obj.get("modules") or {}).values():
+            module["always_reload"] = True
+    return ServerConfig(name=name, **obj)
+
+
+async def wait_ready(manager: ServerManager, timeout: float) -> float:
+    "Waits for every server to become ready, returning how long that took."
+    start = time.perf_counter()
+    while not all(server.ready for server in manager.servers.values()):
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError("servers were not ready after {}s".format(timeout))
+        await asyncio.sleep(0.01)
+    return time.perf_counter() - start
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="python -m omnibot.bench.loadgen",
+        description="Run a server's modules against a local IRC server under simulated load",
+    )
+    parser.add_argument("-c", "--config", metavar="CONFIG", default="omnibot.yml")
+    parser.add_argument(
+        "-s", "--server", help="the server whose modules to load (default: the first one)"
+    )
+    parser.add_argument("-u", "--users", type=int, default=2000, help="simulated users")
+    parser.add_argument(
+        "--extra-channels", type=int, default=200, help="channels to add besides the bot's"
+    )
+    parser.add_argument("--rate", type=float, default=200.0, help="messages per second")
+    parser.add_argument("-d", "--duration", type=float, default=30.0, help="seconds of load")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--probe", help="a message that the bot replies to, to time replies")
+    parser.add_argument("--probe-channel", help="where to send the probe (default: first channel)")
+    parser.add_argument("--probe-interval", type=float, default=1.0)
+    parser.add_argument("--flood-burst", type=float, default=10.0)
+    parser.add_argument("--flood-rate", type=float, default=1.0)
+    return parser.parse_args()
+
+
+async def main(args):
+    with open(args.config) as fp:
+        servers = (yaml.safe_load(fp.read()) or {}).get("server") or {}
+    if not servers:
+        raise SystemExit("no servers are configured in " + args.config)
+    name = args.server or next(iter(servers))
+    if name not in servers:
+        raise SystemExit("no server named {} is configured".format(name))
+
+    ircd = Ircd(flood_burst=args.flood_burst, flood_rate=args.flood_rate)
+    await ircd.start()
+    with tempfile.TemporaryDirectory(prefix="omnibot-loadgen-") as data:
+        config = local_server_config(name, servers[name], ircd, data)
+        manager = ServerManager([config])
+        run = asyncio.ensure_future(manager.run())
+        connect = await wait_ready(manager, 60.0)
+
+        channels = sorted(next(iter(manager.servers.values())).wanted_channels())
+        channels += ["#load{}".format(n) for n in range(args.extra_channels)]
+        load = LoadGenerator(
+            ircd,
+            channels,
+            users=args.users,
+            rate=args.rate,
+            seed=args.seed,
+            nick=config.nick,
+            probe=args.probe,
+            probe_channel=args.probe_channel,
+            probe_interval=args.probe_interval,
+        )
+        await load.run(args.duration)
+
+        start = time.perf_counter()
+        await manager.reload([local_server_config(name, servers[name], ircd, data, True)])
+        reload = time.perf_counter() - start
+        ready = await wait_ready(manager, 60.0)
+
+        await manager.shutdown()
+        run.cancel()
+    await ircd.stop()
+
+    latency = load.latency
+    print("connect + join:    {:.3f}s".format(connect))
+    print("reload (all):      {:.3f}s, ready {:.3f}s later".format(reload, ready))
+    print("load:              {} messages from {} users".format(load.sent, args.users))
+    print("lines from bot:    {}".format(ircd.stats["lines"]))
+    print("excess flood:      {}".format(ircd.stats["flood_kills"]))
+    if args.probe:
+        print(
+            "reply latency:     {} replies, {} timeouts; p50 {:.1f}ms p99 {:.1f}ms max {:.1f}ms"
+            .format(
+                latency.count,
+                load.timeouts,
+                (latency.percentile(50) or 0.0) * 1e3,
+                (latency.percentile(99) or 0.0) * 1e3,
+                (latency.max or 0.0) * 1e3,
+            )
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(parse_args()))
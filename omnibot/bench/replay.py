@@ -0,0 +1,200 @@
+import asyncio
+import copy
+import gc
+import logging
+import random
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Iterable, List, Mapping, Sequence
+from irclib.parser import Message as IrcMessage
+from ..config import ServerConfig
+from ..loader import ModuleLoader
+from ..server import Server
+
+
+log = logging.getLogger(__name__)
+
+
+# Flood control that never holds anything back, so sending doesn't throttle the benchmark.
+UNLIMITED_FLOOD = {"burst": 1 << 30, "rate": 1e9}
+
+
+class FakeProtocol:
+    """
+    An in-memory stand-in for asyncirc's IrcProtocol.
+
+    Lines are fed to the registered handlers one at a time, and lines that are sent are counted
+    and thrown away.
+    """
+
+    def __init__(self, loop=None) -> None:
+        self._loop = loop or asyncio.get_event_loop()
+        self._handlers = []
+        self._sent = 0
+        self.quit_future = self._loop.create_future()
+
+    @property
+    def sent(self) -> int:
+        "The number of lines sent."
+        return self._sent
+
+    def register(self, trigger: str, handler) -> None:
+        self._handlers.append((trigger, handler))
+
+    async def connect(self) -> bool:
+        return True
+
+    def drop(self) -> None:
+        pass
+
+    def quit(self, reason: str = None) -> None:
+        if not self.quit_future.done():
+            self.quit_future.set_result(None)
+
+    def send(self, line: str) -> None:
+        self._sent += 1
+
+    async def feed(self, line: bytes) -> None:
+        """
+        Parses a line as if it had been received, and runs the handlers for it to completion.
+        """
+        message = IrcMessage.parse(line)
+        for trigger, handler in self._handlers:
+            if trigger in (message.command, "*"):
+                await handler(self, message)
+
+
+def make_vocabulary(rng: random.Random, size: int = 500) -> List[str]:
+    "Makes up a vocabulary of nonsense words."
+    syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "an", "el", "or", "un"]
+    return ["".join(rng.choice(syllables) for _ in range(rng.randint(1, 4))) for _ in range(size)]
+
+
+def make_sentence(rng: random.Random, vocabulary: Sequence[str]) -> str:
+    return " ".join(rng.choice(vocabulary) for _ in range(rng.randint(1, 15)))
+
+
+def synthetic_lines(
+    count: int, channels: Sequence[str], users: int = 50, seed: int = 0
+) -> List[str]:
+    """
+    Generates a repeatable stream of lines from other users: mostly channel messages, with some
+    joins, parts and kicks.
+    """
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    nicks = ["user{}".format(n) for n in range(users)]
+    lines = []
+    for _ in range(count):
+        nick = rng.choice(nicks)
+        prefix = ":{0}!{0}@bench.example.com".format(nick)
+        channel = rng.choice(channels)
+        roll = rng.random()
+        if roll < 0.90:
+            text = make_sentence(rng, vocabulary)
+            lines.append("{} PRIVMSG {} :{}".format(prefix, channel, text))
+        elif roll < 0.94:
+            lines.append("{} JOIN {}".format(prefix, channel))
+        elif roll < 0.98:
+            lines.append("{} PART {} :bye".format(prefix, channel))
+        else:
+            lines.append("{} KICK {} {} :out".format(prefix, channel, rng.choice(nicks)))
+    return lines
+
+
+def bench_server_config(name: str, obj: Mapping[str, Any], data: str) -> ServerConfig:
+    """
+    Makes a server configuration suitable for benchmarking from a server's configuration object.
+
+    Module data goes in the given directory, flood control is disabled, and module queues block
+    instead of dropping events so that every run handles every event.
+    """
+    obj = copy.deepcopy(dict(obj))
+    obj["data"] = data
+    obj["flood"] = UNLIMITED_FLOOD
+    for module in (obj.get("modules") or {}).values():
+        module["queue_policy"] = "block"
+    return ServerConfig(name=name, **obj)
+
+
+async def replay(
+    loader: ModuleLoader,
+    name: str,
+    obj: Mapping[str, Any],
+    lines: Iterable[str] = None,
+    count: int = 10000,
+    users: int = 50,
+    seed: int = 0,
+    trace_memory: bool = False,
+) -> Mapping[str, Any]:
+    """
+    Runs a Server with the given configuration over a stream of lines, as fast as it will go.
+
+    If no lines are given, ``count`` synthetic lines are generated for the channels that the
+    server's modules are in. If ``trace_memory`` is set, allocations are traced (which is much
+    slower), and the results include the replay's peak memory use and where memory is held.
+    """
+    loop = asyncio.get_event_loop()
+    with tempfile.TemporaryDirectory(prefix="omnibot-bench-") as data:
+        config = bench_server_config(name, obj, data)
+        conn = FakeProtocol(loop)
+        server = Server(loader, config, loop=loop, conn=conn)
+        # every module is loaded before connecting, including those that would load in the
+        # background, so that they're all there for the whole run
+        await server.load_modules()
+        await server.connect()
+        await conn.feed(":bench.example.com 001 {0} :Welcome {0}".format(config.nick).encode())
+        channels = sorted(server.wanted_channels()) or ["#bench"]
+        for channel in channels:
+            join = ":{0}!{0}@bench.example.com JOIN {1}".format(config.nick, channel)
+            await conn.feed(join.encode())
+        if lines is None:
+            lines = synthetic_lines(count, channels, users, seed)
+        raw = [line.encode() for line in lines]
+        for worker in server.workers.values():
+            await worker.join()
+        server.metrics.clear()
+
+        gc.collect()
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        for line in raw:
+            await conn.feed(line)
+        for worker in server.workers.values():
+            await worker.join()
+        elapsed = time.perf_counter() - start
+        memory = None
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            memory = {
+                "current": current,
+                "peak": peak,
+                "sites": [
+                    {"site": str(stat.traceback), "size": stat.size, "count": stat.count}
+                    for stat in snapshot.statistics("lineno")[:10]
+                ],
+            }
+
+        modules = {}
+        for module, stats in server.metrics.by_module().items():
+            modules[module] = {
+                "calls": stats.calls,
+                "errors": stats.errors,
+                "seconds": stats.latency.total,
+                "p50": stats.latency.percentile(50),
+                "p99": stats.latency.percentile(99),
+            }
+        result = {
+            "lines": len(raw),
+            "seconds": elapsed,
+            "rate": len(raw) / elapsed if elapsed else 0.0,
+            "sent": conn.sent,
+            "modules": modules,
+            "memory": memory,
+        }
+        await server.disconnect()
+    return result
@@ -1,7 +1,7 @@
 from enum import Enum
 import logging
 from pathlib import Path
-from typing import Any, Mapping, Iterator, Sequence
+from typing import Any, Mapping, Iterator, Optional, Sequence
 
 
 log = logging.getLogger(__name__)
@@ -13,6 +13,16 @@ class ConfigError(Exception):
     """
 
 
+class QueuePolicy(Enum):
+    """
+    What to do when a module's event queue is full.
+    """
+
+    DROP_OLDEST = "drop-oldest"
+    DROP_NEWEST = "drop-newest"
+    BLOCK = "block"
+
+
 class ModuleConfig:
     def __init__(
         self,
@@ -21,12 +31,31 @@ class ModuleConfig:
         args: Mapping[str, Any] = None,
         always_reload: bool = None,
         data: str = None,
+        queue_size: int = None,
+        queue_policy: str = None,
+        threads: int = None,
+        load_timeout: float = None,
     ):
         self._name = name
         self._channels = set(channels or [])
         self._args = args or {}
         self._always_reload = always_reload or False
         self._data = data or name
+        self._queue_size = 100 if queue_size is None else int(queue_size)
+        if self._queue_size < 1:
+            raise ConfigError("queue size for module {} must be at least 1".format(name))
+        try:
+            self._queue_policy = QueuePolicy(queue_policy or QueuePolicy.DROP_OLDEST.value)
+        except ValueError:
+            raise ConfigError(
+                "invalid queue policy for module {}: {}".format(name, queue_policy)
+            )
+        self._threads = 1 if threads is None else int(threads)
+        if self._threads < 1:
+            raise ConfigError("thread count for module {} must be at least 1".format(name))
+        self._load_timeout = None if load_timeout is None else float(load_timeout)
+        if self._load_timeout is not None and self._load_timeout <= 0:
+            raise ConfigError("load timeout for module {} must be positive".format(name))
 
     @property
     def name(self):
@@ -48,6 +77,26 @@ class ModuleConfig:
     def data(self) -> Path:
         return Path(self._data)
 
+    @property
+    def queue_size(self) -> int:
+        "The maximum number of events that may be waiting to be handled by this module."
+        return self._queue_size
+
+    @property
+    def queue_policy(self) -> QueuePolicy:
+        "What to do with new events when this module's queue is full."
+        return self._queue_policy
+
+    @property
+    def threads(self) -> int:
+        "The number of threads in this module's thread pool."
+        return self._threads
+
+    @property
+    def load_timeout(self) -> Optional[float]:
+        "How many seconds this module may take to load, or None if there is no limit."
+        return self._load_timeout
+
     def __getitem__(self, key: str) -> Any:
         return self.args[key]
 
@@ -58,12 +107,101 @@ class ModuleConfig:
             and self.channels == other.channels
             and self.always_reload == other.always_reload
             and self.args == other.args
+            and self.queue_size == other.queue_size
+            and self.queue_policy == other.queue_policy
+            and self.threads == other.threads
+            and self.load_timeout == other.load_timeout
         )
 
     def __hash__(self) -> int:
         return hash(self.name)
 
 
+class FloodConfig:
+    def __init__(self, burst: int = None, rate: float = None, **kwargs):
+        self._burst = 5 if burst is None else int(burst)
+        self._rate = 0.5 if rate is None else float(rate)
+        if self._burst < 1:
+            raise ConfigError("flood burst must be at least 1")
+        if self._rate <= 0.0:
+            raise ConfigError("flood rate must be greater than 0")
+        for k in kwargs.keys():
+            log.warning("Unused flood config value: %s", k)
+
+    @property
+    def burst(self) -> int:
+        "The number of lines that may be sent back-to-back before being rate limited."
+        return self._burst
+
+    @property
+    def rate(self) -> float:
+        "The sustained number of lines per second that may be sent."
+        return self._rate
+
+    def __eq__(self, other: "FloodConfig") -> bool:
+        return (
+            isinstance(other, FloodConfig)
+            and self.burst == other.burst
+            and self.rate == other.rate
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.burst, self.rate))
+
+
+class KeepaliveConfig:
+    def __init__(
+        self,
+        interval: float = None,
+        timeout: float = None,
+        backoff: float = None,
+        backoff_max: float = None,
+        **kwargs
+    ):
+        self._interval = 30.0 if interval is None else float(interval)
+        self._timeout = 90.0 if timeout is None else float(timeout)
+        self._backoff = 1.0 if backoff is None else float(backoff)
+        self._backoff_max = 300.0 if backoff_max is None else float(backoff_max)
+        if min(self._interval, self._timeout, self._backoff) <= 0:
+            raise ConfigError("keepalive interval, timeout and backoff must be positive")
+        if self._backoff_max < self._backoff:
+            raise ConfigError("keepalive backoff_max must be at least backoff")
+        for k in kwargs.keys():
+            log.warning("Unused keepalive config value: %s", k)
+
+    @property
+    def interval(self) -> float:
+        "How often to ping the server, in seconds."
+        return self._interval
+
+    @property
+    def timeout(self) -> float:
+        "How long to wait for a ping to be answered before reconnecting, in seconds."
+        return self._timeout
+
+    @property
+    def backoff(self) -> float:
+        "How long to wait before reconnecting the first time, in seconds."
+        return self._backoff
+
+    @property
+    def backoff_max(self) -> float:
+        "The longest to wait before reconnecting, in seconds."
+        return self._backoff_max
+
+    def __eq__(self, other: "KeepaliveConfig") -> bool:
+        return (
+            isinstance(other, KeepaliveConfig)
+            and self.interval == other.interval
+            and self.timeout == other.timeout
+            and self.backoff == other.backoff
+            and self.backoff_max == other.backoff_max
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.interval, self.timeout, self.backoff, self.backoff_max))
+
+
 class ServerConfig:
     def __init__(
         self,
@@ -75,6 +213,8 @@ class ServerConfig:
         ssl: bool = None,
         data: str = None,
         modules: Mapping[str, Any] = None,
+        flood: Mapping[str, Any] = None,
+        keepalive: Mapping[str, Any] = None,
         **kwargs
     ):
         self._address = address or name
@@ -89,6 +229,8 @@ class ServerConfig:
         self._modules = {}
         for name, mod in modules.items():
             self._modules[name] = ModuleConfig(name=name, **mod)
+        self._flood = FloodConfig(**(flood or {}))
+        self._keepalive = KeepaliveConfig(**(keepalive or {}))
         for k in kwargs.keys():
             log.warning("Unused config value for server %s: %s", self._address, k)
 
@@ -121,6 +263,16 @@ class ServerConfig:
     def modules(self) -> Mapping[str, ModuleConfig]:
         return self._modules
 
+    @property
+    def flood(self) -> FloodConfig:
+        "Flood control settings for messages sent to the server."
+        return self._flood
+
+    @property
+    def keepalive(self) -> KeepaliveConfig:
+        "Settings for pinging the server, and reconnecting when it stops answering."
+        return self._keepalive
+
     def __eq__(self, other: "ServerConfig") -> bool:
         return (
             isinstance(other, ServerConfig)
@@ -134,12 +286,163 @@ class ServerConfig:
         return hash((self.address, self.port, self.ssl, list(self.modules.keys())))
 
 
+class HttpConfig:
+    def __init__(self, address: str = None, port: int = None, **kwargs):
+        self._address = address or "127.0.0.1"
+        self._port = 9105 if port is None else int(port)
+        for k in kwargs.keys():
+            log.warning("Unused http config value: %s", k)
+
+    @property
+    def address(self) -> str:
+        "The address to listen on."
+        return self._address
+
+    @property
+    def port(self) -> int:
+        "The port to listen on."
+        return self._port
+
+
+class ProfilerConfig:
+    def __init__(
+        self,
+        directory: str = None,
+        duration: float = None,
+        interval: float = None,
+        cprofile: bool = None,
+        **kwargs
+    ):
+        self._directory = Path(directory or "./data/profiles")
+        self._duration = 30.0 if duration is None else float(duration)
+        self._interval = 0.01 if interval is None else float(interval)
+        self._cprofile = True if cprofile is None else bool(cprofile)
+        if self._duration <= 0 or self._interval <= 0:
+            raise ConfigError("profiler duration and interval must be positive")
+        for k in kwargs.keys():
+            log.warning("Unused profiler config value: %s", k)
+
+    @property
+    def directory(self) -> Path:
+        "The directory to write profiles to."
+        return self._directory
+
+    @property
+    def duration(self) -> float:
+        "How long to profile for, in seconds, unless stopped sooner."
+        return self._duration
+
+    @property
+    def interval(self) -> float:
+        "How often to sample stacks, in seconds."
+        return self._interval
+
+    @property
+    def cprofile(self) -> bool:
+        "Whether to trace the event loop thread with cProfile as well as sampling it."
+        return self._cprofile
+
+
+class MemoryConfig:
+    def __init__(
+        self, interval: float = None, limit: int = None, tracemalloc: bool = None, **kwargs
+    ):
+        self._interval = 300.0 if interval is None else float(interval)
+        self._limit = 1000000 if limit is None else int(limit)
+        self._tracemalloc = bool(tracemalloc)
+        if self._interval <= 0 or self._limit <= 0:
+            raise ConfigError("memory sampling interval and limit must be positive")
+        for k in kwargs.keys():
+            log.warning("Unused memory config value: %s", k)
+
+    @property
+    def interval(self) -> float:
+        "How often to measure modules' memory, in seconds."
+        return self._interval
+
+    @property
+    def limit(self) -> int:
+        "The most objects to walk through per module each time."
+        return self._limit
+
+    @property
+    def tracemalloc(self) -> bool:
+        "Whether to trace allocations, to also find what each module's code has allocated."
+        return self._tracemalloc
+
+
+class BotConfig:
+    """
+    The root of a configuration file.
+    """
+
+    def __init__(
+        self,
+        *,
+        server: Mapping[str, Any] = None,
+        shards: int = None,
+        processes: int = None,
+        http: Mapping[str, Any] = None,
+        profiler: Mapping[str, Any] = None,
+        memory: Mapping[str, Any] = None,
+        **kwargs
+    ):
+        server = server or {}
+        self._servers = [ServerConfig(name=name, **c) for name, c in server.items()]
+        self._shards = 1 if shards is None else int(shards)
+        if self._shards < 1:
+            raise ConfigError("shards must be at least 1")
+        self._processes = None if processes is None else int(processes)
+        if self._processes is not None and self._processes < 1:
+            raise ConfigError("processes must be at least 1")
+        self._http = None if http is None else HttpConfig(**http)
+        self._profiler = ProfilerConfig(**(profiler or {}))
+        self._memory = None if memory is None else MemoryConfig(**memory)
+        for k in kwargs.keys():
+            log.warning("Unused config value: %s", k)
+
+    @property
+    def servers(self) -> Sequence[ServerConfig]:
+        return self._servers
+
+    @property
+    def shards(self) -> int:
+        "The number of worker processes to run servers in. 1 runs everything in this process."
+        return self._shards
+
+    @property
+    def processes(self) -> Optional[int]:
+        "The size of the process pool shared by modules; None uses one process per CPU."
+        return self._processes
+
+    @property
+    def http(self) -> Optional[HttpConfig]:
+        "Settings for the metrics HTTP listener, if it is enabled."
+        return self._http
+
+    @property
+    def profiler(self) -> ProfilerConfig:
+        "Settings for the on-demand profiler."
+        return self._profiler
+
+    @property
+    def memory(self) -> Optional[MemoryConfig]:
+        "Settings for measuring modules' memory, if it is enabled."
+        return self._memory
+
+
 def config_from_yaml(text: str):
-    import yaml
-    return config_from_obj(yaml.safe_load(text))
+    return bot_config_from_yaml(text).servers
 
 
 def config_from_obj(obj: Mapping[str, Any]):
-    if not obj:
-        return []
-    return [ServerConfig(name=name, **c) for name, c in obj["server"].items()]
+    return bot_config_from_obj(obj).servers
+
+
+def bot_config_from_yaml(text: str) -> BotConfig:
+    import yaml
+    return bot_config_from_obj(yaml.safe_load(text))
+
+
+def bot_config_from_obj(obj: Mapping[str, Any]) -> BotConfig:
+    return BotConfig(**(obj or {}))
@@ -0,0 +1,76 @@
+import logging
+from typing import Callable
+from asyncirc.protocol import IrcProtocol
+
+
+log = logging.getLogger(__name__)
+
+
+class Connection(IrcProtocol):
+    """
+    An IrcProtocol that leaves keeping the connection alive to its owner.
+
+    asyncirc pings the server itself, and reconnects straight away when the connection is lost
+    or the server lags by a minute, retrying forever with its own backoff. Here, the server pings
+    instead (see Server), connect only tries once, and losing the connection calls ``on_lost``,
+    so that the owner can reconnect when and how it wants to.
+    """
+
+    def __init__(self, *args, on_lost: Callable[[], None] = None, **kwargs) -> None:
+        self._connected_waiter = None
+        super().__init__(*args, **kwargs)
+        self._on_lost = on_lost
+
+    @property
+    def _connected_future(self):
+        return self._connected_waiter
+
+    @_connected_future.setter
+    def _connected_future(self, future) -> None:
+        # asyncirc starts a new future for sends to wait on each time it tries to connect, which
+        # would leave sends already waiting on the last one waiting forever; the pending one is
+        # kept instead, until a connection is made
+        if self._connected_waiter is None or self._connected_waiter.done():
+            self._connected_waiter = future
+
+    @_connected_future.deleter
+    def _connected_future(self) -> None:
+        self._connected_waiter = None
+
+    async def pinger(self) -> None:
+        pass
+
+    async def connect(self) -> bool:
+        "Tries to connect to each server in turn, returning whether one of them worked."
+        for server in self.servers:
+            if await self._connect(server):
+                return True
+        return False
+
+    def drop(self) -> None:
+        "Closes the connection without quitting, as though it had been lost."
+        transport = getattr(self, "_transport", None)
+        if transport is not None:
+            transport.abort()
+
+    def quit(self, reason: str = None) -> None:
+        if self.connected:
+            super().quit(reason)
+        elif not self._quitting:
+            # there's no connection to send QUIT on
+            self._quitting = True
+            if not self.quit_future.done():
+                self.quit_future.set_result(None)
+
+    def connection_lost(self, exc) -> None:
+        self._transport = None
+        self._connected = False
+        if self._quitting:
+            if not self.quit_future.done():
+                self.quit_future.set_result(None)
+            return
+        # lines sent until the next connection wait for it
+        self._connected_future = self.loop.create_future()
+        log.warning("Lost connection to %s (%s)", self.server, exc or "closed")
+        if self._on_lost is not None:
+            self._on_lost()
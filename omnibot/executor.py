@@ -0,0 +1,47 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing
+from typing import Optional
+
+
+log = logging.getLogger(__name__)
+
+
+_process_pool = None
+_process_pool_size = None
+
+
+def configure_process_pool(size: Optional[int]) -> None:
+    """
+    Sets the number of worker processes in the shared process pool.
+
+    None uses one process per CPU. This takes effect the next time the pool is created.
+    """
+    global _process_pool_size
+    _process_pool_size = size
+
+
+def process_pool() -> ProcessPoolExecutor:
+    """
+    Gets the process pool shared by every module in this process, creating it if necessary.
+    """
+    global _process_pool
+    if _process_pool is None:
+        log.debug("Starting shared process pool (size: %s)", _process_pool_size or "auto")
+        # worker processes are spawned rather than forked, since forking a process that is
+        # running threads (e.g. module thread pools) is unsafe
+        _process_pool = ProcessPoolExecutor(
+            max_workers=_process_pool_size, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _process_pool
+
+
+def shutdown_process_pool(wait: bool = True) -> None:
+    """
+    Shuts down the shared process pool, if it was started.
+    """
+    global _process_pool
+    if _process_pool is not None:
+        log.debug("Stopping shared process pool")
+        _process_pool.shutdown(wait=wait)
+        _process_pool = None
@@ -1,9 +1,10 @@
+import hashlib
 import importlib
 import importlib.util as importutil
 import logging
-import gc
+import sys
 from pathlib import Path
-from typing import Optional, Sequence
+from typing import Optional, Sequence, Tuple
 from .module import Module
 
 
@@ -19,10 +20,28 @@ class InvalidModuleException(Exception):
         super().__init__(message)
 
 
+class _CachedModule:
+    __slots__ = ("stats", "digest", "clazz")
+
+    def __init__(self, stats: Tuple, digest: str, clazz: type) -> None:
+        self.stats = stats
+        self.digest = digest
+        self.clazz = clazz
+
+
 class ModuleLoader:
+    """
+    Loads module classes from source files, caching them by path.
+
+    A cached class is used for as long as the module's source is unchanged, so loading a module
+    again (e.g. when reloading configuration, or for another server) only executes it again if
+    one of its source files has changed. Changes are found by checking the modification times and
+    sizes of the module's files, and then comparing a hash of their contents.
+    """
+
     def __init__(self, search_paths: Sequence[Path]) -> None:
         self._search_paths = list(map(Path, search_paths))
-        self._loaded_modules = dict()
+        self._cache = dict()
 
     @property
     def search_paths(self) -> Sequence[Path]:
@@ -40,21 +59,72 @@ class ModuleLoader:
                 return initpath
         return None
 
+    def source_path(self, name: str) -> Optional[Path]:
+        """
+        Gets the path holding a module's source: its file, or its directory if it is a package.
+        """
+        path = self.find_module(name)
+        if path is not None and path.name == "__init__.py":
+            path = path.parent
+        return path
+
+    @staticmethod
+    def _sources(path: Path) -> Sequence[Path]:
+        "Every source file of the module at the given path."
+        if path.name == "__init__.py":
+            return sorted(path.parent.rglob("*.py"))
+        return [path]
+
+    @staticmethod
+    def _stat(sources: Sequence[Path]) -> Tuple:
+        stats = []
+        for source in sources:
+            st = source.stat()
+            stats.append((str(source), st.st_mtime_ns, st.st_size))
+        return tuple(stats)
+
+    @staticmethod
+    def _digest(sources: Sequence[Path]) -> str:
+        digest = hashlib.sha256()
+        for source in sources:
+            digest.update(str(source).encode() + b"\0")
+            digest.update(source.read_bytes())
+        return digest.hexdigest()
+
     def load_module(self, name: str) -> Optional[Module]:
         """
         Searches for a module with the given name, and attempts to load it.
 
-        If the module is already loaded then it is returned.
+        If the module is already loaded and its source hasn't changed, the loaded class is
+        returned.
         """
-        importlib.invalidate_caches()
-        if name in self._loaded_modules:
-            return self._loaded_modules[name]
-
         path = self.find_module(name)
         if path is None:
             raise InvalidModuleException(name, "module not found")
+        key = str(path.resolve())
+        sources = self._sources(path)
+        stats = self._stat(sources)
+        cached = self._cache.get(key)
+        if cached is not None and cached.stats == stats:
+            return cached.clazz
+        digest = self._digest(sources)
+        if cached is not None and cached.digest == digest:
+            # touched, but not changed
+            cached.stats = stats
+            return cached.clazz
+
+        clazz = self._execute(name, path)
+        self._cache[key] = _CachedModule(stats, digest, clazz)
+        return clazz
+
+    def _execute(self, name: str, path: Path) -> Module:
         if str(path).endswith(".py"):
             module_name = str(path)[:-3].replace("/", ".")
+        package = module_name[: -len(".__init__")] if path.name == "__init__.py" else module_name
+        # forget the old copy of the module's submodules, so that they are executed again too
+        for loaded in [m for m in sys.modules if m == package or m.startswith(package + ".")]:
+            del sys.modules[loaded]
+        importlib.invalidate_caches()
         log.debug("Loading module %s from path %s", name, path)
         spec = importutil.spec_from_file_location(module_name, path)
         module = importutil.module_from_spec(spec)
@@ -71,15 +141,5 @@ class ModuleLoader:
             raise InvalidModuleException(
                 name, "ModuleClass type must be an instance of " "omnibot.module.Module"
             )
-        self._loaded_modules[name] = module.ModuleClass
         log.info("Loaded module %s", name)
-        return self._loaded_modules[name]
-
-    def unload_module(self, name: str):
-        """
-        Unloads a module with the given name, if it has been added by this loader.
-        """
-        self._loaded_modules.pop(name, None)
-        log.debug("Running garbage collector")
-        # collect generation 0 objects, including the module
-        gc.collect(0)
+        return module.ModuleClass
@@ -0,0 +1,221 @@
+import asyncio
+from concurrent.futures import Executor
+import gc
+import logging
+import os
+import sys
+import time
+import tracemalloc
+import types
+from typing import Any, Dict, Iterable, Mapping, Optional, Tuple
+from .config import MemoryConfig
+from .module import Module
+
+
+log = logging.getLogger(__name__)
+
+
+# Objects that are shared with the rest of the process rather than held by one module, so that a
+# walk stops at them instead of counting (say) the whole server through a module's reference.
+SHARED_TYPES = (
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.BuiltinFunctionType,
+    types.MethodType,
+    types.CodeType,
+    types.FrameType,
+    Module,
+    asyncio.AbstractEventLoop,
+    asyncio.Future,
+    Executor,
+    logging.Logger,
+)
+
+# How many objects to walk before letting the event loop run.
+WALK_CHUNK = 10000
+
+
+class SizeWalk:
+    """
+    Adds up the sizes of objects and everything they refer to, counting each object once.
+
+    Objects of SHARED_TYPES, and any objects passed in ``exclude``, are neither counted nor
+    walked through. At most ``limit`` objects are counted; if a walk reaches the limit, it stops
+    and ``truncated`` is set, so that the sizes it gives are lower bounds.
+    """
+
+    def __init__(self, exclude: Iterable[Any] = (), limit: Optional[int] = None) -> None:
+        self._seen = {id(obj) for obj in exclude}
+        self._limit = limit
+        self._count = 0
+        self._truncated = False
+
+    @property
+    def count(self) -> int:
+        "The number of objects counted so far."
+        return self._count
+
+    @property
+    def truncated(self) -> bool:
+        "Whether the walk stopped early because it reached its limit."
+        return self._truncated
+
+    def _objects(self, root: Any):
+        pending = [root]
+        seen = self._seen
+        while pending:
+            obj = pending.pop()
+            if id(obj) in seen or isinstance(obj, SHARED_TYPES):
+                continue
+            if self._limit is not None and self._count >= self._limit:
+                self._truncated = True
+                return
+            seen.add(id(obj))
+            self._count += 1
+            yield obj
+            pending.extend(gc.get_referents(obj))
+
+    def size(self, root: Any) -> int:
+        "The size of an object and everything it refers to that hasn't been counted yet."
+        return sum(map(sys.getsizeof, self._objects(root)))
+
+    async def size_async(self, root: Any, chunk: int = WALK_CHUNK) -> int:
+        """
+        Like size, but lets the event loop run every ``chunk`` objects. Objects that change while
+        they're being walked may be counted before or after the change.
+        """
+        total = 0
+        for n, obj in enumerate(self._objects(root), 1):
+            total += sys.getsizeof(obj)
+            if n % chunk == 0:
+                await asyncio.sleep(0)
+        return total
+
+
+def deep_size(obj: Any, exclude: Iterable[Any] = (), limit: Optional[int] = None) -> int:
+    "The size of an object and everything it refers to, in bytes. See SizeWalk."
+    return SizeWalk(exclude, limit).size(obj)
+
+
+def traced_size(snapshot: tracemalloc.Snapshot, path: str) -> int:
+    """
+    The memory still held that was allocated by code in a source file, or in any file under a
+    directory, according to a tracemalloc snapshot.
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        path = os.path.join(path, "*")
+    traces = snapshot.filter_traces([tracemalloc.Filter(True, path)])
+    return sum(stat.size for stat in traces.statistics("filename"))
+
+
+class MemorySampler:
+    """
+    Periodically measures how much memory each loaded module holds.
+
+    Every module on every server is walked from the objects its memory_breakdown gives, giving
+    a size per (server, module, channel); channel is None for memory that isn't tied to a
+    channel. Objects reachable from more than one channel of a module are counted in the first
+    channel they're reached from, so a module's channels add up to its total.
+
+    Objects that a module shares with other instances (see Module.memory_shared) are left out of
+    its channels, and measured once per sample instead, under the name of the first module they're
+    reached from.
+
+    If tracemalloc is enabled, the memory allocated by each module's source and still held is
+    recorded too, by module name. This is per module's code rather than per instance, since every
+    server runs the same code.
+    """
+
+    def __init__(self, manager: "ServerManager", config: MemoryConfig, loop=None) -> None:
+        self._manager = manager
+        self._config = config
+        self._loop = loop or asyncio.get_event_loop()
+        self._task = None
+        self._started_tracing = False
+        self._sizes = {}
+        self._traced = {}
+        self._shared = {}
+        self._duration = None
+
+    @property
+    def sizes(self) -> Mapping[Tuple[str, str, Optional[str]], int]:
+        "The size of each module's memory in the last sample, by (server, module, channel)."
+        return self._sizes
+
+    @property
+    def shared(self) -> Mapping[str, int]:
+        "The size of the memory that instances of each module share, by module name."
+        return self._shared
+
+    @property
+    def traced(self) -> Mapping[str, int]:
+        "Memory held that was allocated by each module's code, by module name, if it's traced."
+        return self._traced
+
+    @property
+    def duration(self) -> Optional[float]:
+        "How long the last sample took, in seconds."
+        return self._duration
+
+    def start(self) -> None:
+        if self._config.tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._task = self._loop.create_task(self._sample_periodically())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    async def _sample_periodically(self) -> None:
+        while True:
+            try:
+                await self.sample()
+            except Exception:
+                log.exception("Could not measure module memory")
+            await asyncio.sleep(self._config.interval)
+
+    async def sample(self) -> None:
+        "Measures every loaded module."
+        start = time.perf_counter()
+        sizes = {}
+        traced = {}
+        shared = {}
+        shared_walk = SizeWalk(limit=self._config.limit)
+        snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        for address, server in list(self._manager.servers.items()):
+            for name, module in list(server.modules.items()):
+                sizes.update(await self.measure(address, server, name, module))
+                for obj in module.memory_shared():
+                    shared[name] = shared.get(name, 0) + await shared_walk.size_async(obj)
+                if snapshot is not None and name not in traced:
+                    path = server.loader.source_path(name)
+                    if path is not None:
+                        traced[name] = traced_size(snapshot, str(path))
+        self._sizes = sizes
+        self._traced = traced
+        self._shared = shared
+        self._duration = time.perf_counter() - start
+        log.debug("Measured module memory in %.3fs", self._duration)
+
+    async def measure(
+        self, address: str, server: "Server", name: str, module: Module
+    ) -> Dict[Tuple[str, str, Optional[str]], int]:
+        exclude = (server, server.loop, module.config, *module.memory_shared())
+        walk = SizeWalk(exclude=exclude, limit=self._config.limit)
+        sizes = {}
+        for channel, obj in module.memory_breakdown().items():
+            size = await walk.size_async(obj)
+            key = (address, name, channel)
+            sizes[key] = sizes.get(key, 0) + size
+        if walk.truncated:
+            log.warning(
+                "Stopped measuring module %s on %s after %s objects", name, address, walk.count
+            )
+        return sizes
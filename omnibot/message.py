@@ -1,22 +1,57 @@
+import re
+from string import punctuation
+from typing import Any, Callable, Optional, Sequence
+
+
+URL_RE = re.compile(r"\S+://\S+")
+
+
 class Message:
     """
     An adapter for messages from multiple possible servers.
+
+    A message is built once per line and shared by every module that handles it, so views of its
+    text (words, tokens, URLs and so on) are computed the first time they are asked for and
+    cached from then on. Modules should treat messages as read-only.
     """
 
+    __slots__ = (
+        "_server",
+        "_sender",
+        "_target",
+        "_message",
+        "_channel",
+        "_words",
+        "_tokens",
+        "_urls",
+        "_views",
+    )
+
     def __init__(
-        self, server: "Server", sender: str, target: str, message: str
+        self,
+        server: "Server",
+        sender: Optional[str],
+        target: str,
+        message: str,
+        channel: Optional[str] = None,
     ) -> None:
         self._server = server
         self._sender = sender
         self._target = target
         self._message = message
+        self._channel = channel
+        self._words = None
+        self._tokens = None
+        self._urls = None
+        self._views = None
 
     @property
     def server(self):
         return self._server
 
     @property
-    def sender(self) -> str:
+    def sender(self) -> Optional[str]:
+        "The nick that sent this message, or None if it was the bot."
         return self._sender
 
     @property
@@ -26,3 +61,49 @@ class Message:
     @property
     def message(self) -> str:
         return self._message
+
+    @property
+    def channel(self) -> Optional[str]:
+        "The channel this message was sent to, or None if it was sent privately."
+        return self._channel
+
+    @property
+    def words(self) -> Sequence[str]:
+        "The message split on whitespace."
+        if self._words is None:
+            self._words = tuple(self._message.split())
+        return self._words
+
+    @property
+    def command(self) -> Optional[str]:
+        "The first word of the message (e.g. '!markov'), if there is one."
+        words = self.words
+        return words[0] if words else None
+
+    @property
+    def tokens(self) -> Sequence[str]:
+        "The words of the message, lowercased and stripped of surrounding punctuation."
+        if self._tokens is None:
+            tokens = (word.strip(punctuation).lower() for word in self.words)
+            self._tokens = tuple(token for token in tokens if token)
+        return self._tokens
+
+    @property
+    def urls(self) -> Sequence[str]:
+        "Everything in the message that looks like a URL."
+        if self._urls is None:
+            self._urls = tuple(URL_RE.findall(self._message))
+        return self._urls
+
+    def view(self, parse: Callable[[str], Any]) -> Any:
+        """
+        Gets ``parse(message)``, calling it only the first time it is asked for.
+
+        This lets modules share views of the text that are specific to them, e.g. when a module
+        is loaded more than once on a server.
+        """
+        if self._views is None:
+            self._views = {}
+        if parse not in self._views:
+            self._views[parse] = parse(self._message)
+        return self._views[parse]
@@ -0,0 +1,251 @@
+import asyncio
+from collections import defaultdict, deque
+import time
+from typing import Any, Awaitable, Iterator, Mapping, Optional, Tuple
+
+
+# Values are bucketed with SUB_BUCKET_HALF (2 ** (SUB_BUCKET_BITS - 1), i.e. 64) buckets for every
+# power of two, so every bucket is within 1/64th (about 1.6%) of the values recorded in it.
+SUB_BUCKET_BITS = 7
+SUB_BUCKET_HALF = 1 << (SUB_BUCKET_BITS - 1)
+
+
+def _bucket(value: int) -> int:
+    if value < (1 << SUB_BUCKET_BITS):
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return (shift << (SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+
+def _bucket_range(bucket: int) -> Tuple[int, int]:
+    "The lowest and highest values that fall into a bucket."
+    if bucket < (1 << SUB_BUCKET_BITS):
+        return bucket, bucket
+    shift = bucket // SUB_BUCKET_HALF - 1
+    top = SUB_BUCKET_HALF + bucket % SUB_BUCKET_HALF
+    return top << shift, ((top + 1) << shift) - 1
+
+
+class Histogram:
+    """
+    A log-linear histogram of durations, in the style of HdrHistogram.
+
+    Durations are recorded in whole microseconds into sparse buckets, so a histogram costs memory
+    in proportion to the spread of values recorded rather than their number.
+    """
+
+    __slots__ = ("_buckets", "_count", "_total", "_min", "_max")
+
+    def __init__(self) -> None:
+        self._buckets = defaultdict(int)
+        self._count = 0
+        self._total = 0
+        self._min = None
+        self._max = None
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def min(self) -> Optional[float]:
+        "The shortest duration recorded, in seconds."
+        return None if self._min is None else self._min / 1e6
+
+    @property
+    def max(self) -> Optional[float]:
+        "The longest duration recorded, in seconds."
+        return None if self._max is None else self._max / 1e6
+
+    @property
+    def mean(self) -> Optional[float]:
+        "The mean duration recorded, in seconds."
+        return None if not self._count else self._total / self._count / 1e6
+
+    @property
+    def total(self) -> float:
+        "The sum of every duration recorded, in seconds."
+        return self._total / 1e6
+
+    def record(self, seconds: float) -> None:
+        value = max(0, int(seconds * 1e6))
+        self._buckets[_bucket(value)] += 1
+        self._count += 1
+        self._total += value
+        if self._min is None or value < self._min:
+            self._min = value
+        if self._max is None or value > self._max:
+            self._max = value
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """
+        Gets the duration (in seconds) that the given percentage of recorded durations are at or
+        below, to within the histogram's precision.
+        """
+        if not self._count:
+            return None
+        target = max(1, self._count * percent / 100.0)
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= target:
+                return min(_bucket_range(bucket)[1], self._max) / 1e6
+        return self._max / 1e6
+
+    def merge(self, other: "Histogram") -> None:
+        for bucket, count in other._buckets.items():
+            self._buckets[bucket] += count
+        self._count += other._count
+        self._total += other._total
+        for value in (other._min, other._max):
+            if value is None:
+                continue
+            if self._min is None or value < self._min:
+                self._min = value
+            if self._max is None or value > self._max:
+                self._max = value
+
+
+class RateMeter:
+    """
+    Counts events, and how many happened per second on average over a sliding window.
+    """
+
+    __slots__ = ("_window", "_seconds", "_count")
+
+    def __init__(self, window: int = 60) -> None:
+        self._window = window
+        # (second, count) pairs, oldest first
+        self._seconds = deque()
+        self._count = 0
+
+    @property
+    def count(self) -> int:
+        "The total number of events."
+        return self._count
+
+    def mark(self, count: int = 1) -> None:
+        now = int(time.monotonic())
+        if self._seconds and self._seconds[-1][0] == now:
+            self._seconds[-1][1] += count
+        else:
+            self._seconds.append([now, count])
+            self._expire(now)
+        self._count += count
+
+    def rate(self) -> float:
+        "The average number of events per second over the window."
+        self._expire(int(time.monotonic()))
+        return sum(count for _, count in self._seconds) / self._window
+
+    def _expire(self, now: int) -> None:
+        while self._seconds and self._seconds[0][0] <= now - self._window:
+            self._seconds.popleft()
+
+
+class HandlerStats:
+    """
+    Call counts and timings for one module handler.
+    """
+
+    __slots__ = ("calls", "errors", "cancelled", "latency")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.latency = Histogram()
+
+    def merge(self, other: "HandlerStats") -> None:
+        self.calls += other.calls
+        self.errors += other.errors
+        self.cancelled += other.cancelled
+        self.latency.merge(other.latency)
+
+
+# (module, hook, channel)
+HandlerKey = Tuple[str, str, Optional[str]]
+
+
+class HandlerMetrics:
+    """
+    Records how long each module's handlers take to run, per module, hook and channel.
+    """
+
+    def __init__(self) -> None:
+        self._stats = defaultdict(HandlerStats)
+
+    async def call(
+        self, module: str, hook: str, channel: Optional[str], handler: Awaitable
+    ) -> Any:
+        """
+        Awaits a handler, recording its duration and outcome.
+        """
+        stats = self._stats[(module, hook, channel)]
+        stats.calls += 1
+        start = time.perf_counter()
+        try:
+            return await handler
+        except asyncio.CancelledError:
+            stats.cancelled += 1
+            raise
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.latency.record(time.perf_counter() - start)
+
+    def items(self) -> Iterator[Tuple[HandlerKey, HandlerStats]]:
+        return iter(self._stats.items())
+
+    def stats(
+        self, module: str = None, hook: str = None, channel: str = None
+    ) -> HandlerStats:
+        """
+        Gets the combined stats for every handler matching the given module, hook and channel.
+        Arguments that aren't given match anything.
+        """
+        combined = HandlerStats()
+        for (m, h, c), stats in self._stats.items():
+            if module not in (None, m) or hook not in (None, h) or channel not in (None, c):
+                continue
+            combined.merge(stats)
+        return combined
+
+    def by_module(self) -> Mapping[str, HandlerStats]:
+        modules = defaultdict(HandlerStats)
+        for (module, _, _), stats in self._stats.items():
+            modules[module].merge(stats)
+        return modules
+
+    def clear(self) -> None:
+        self._stats.clear()
+
+    def dump(self) -> str:
+        """
+        Formats these metrics as a table, slowest handlers (by total time) first.
+        """
+        header = "{:<16} {:<12} {:<20} {:>8} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10}".format(
+            "module", "hook", "channel", "calls", "errors", "cancel", "p50 ms", "p99 ms",
+            "max ms", "total s"
+        )
+        lines = [header]
+        ordered = sorted(self._stats.items(), key=lambda item: -item[1].latency.total)
+        for (module, hook, channel), stats in ordered:
+            latency = stats.latency
+            lines += [
+                "{:<16} {:<12} {:<20} {:>8} {:>6} {:>6} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}"
+                .format(
+                    module,
+                    hook,
+                    channel or "-",
+                    stats.calls,
+                    stats.errors,
+                    stats.cancelled,
+                    (latency.percentile(50) or 0.0) * 1e3,
+                    (latency.percentile(99) or 0.0) * 1e3,
+                    (latency.max or 0.0) * 1e3,
+                    latency.total,
+                )
+            ]
+        return "\n".join(lines)
@@ -1,6 +1,10 @@
 from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
+import functools
 from pathlib import Path
-from typing import Any, Mapping, Optional, Sequence
+from typing import Any, Callable, Iterable, Mapping, Optional, Sequence
+from . import executor
+from .message import Message
 
 
 class ModuleError(Exception):
@@ -16,6 +20,19 @@ class Module:
 
     default_args = {}
 
+    # The version of the state that export_state returns. Bump this when its shape changes, and
+    # convert older versions in migrate_state.
+    state_version = 1
+
+    # Whether this module must be loaded before the server connects. Modules that aren't needed
+    # for registration (e.g. ones with a lot of data to read) can set this to False to finish
+    # loading while the server connects; they join their channels once they're loaded.
+    preload = True
+
+    # The names of the hooks this module handles (e.g. {"on_join", "handle_message"}). If this is
+    # None, they are worked out from which hooks the class overrides.
+    hooks = None
+
     def __init__(
         self, config: "ModuleConfig", server: "Server", commands: Sequence[str] = None
     ) -> None:
@@ -24,6 +41,9 @@ class Module:
         self.__commands = commands or []
         clazz = self.__class__
         self.__args = ChainMap(self.__config.args, clazz.default_args)
+        self.__thread_pool = None
+        self.__state_adopted = False
+        self.__state_exported = False
 
     @property
     def name(self) -> str:
@@ -69,6 +89,131 @@ class Module:
                               self.name, data_dir, str(ex))
         return data_dir
 
+    def thread_pool(self) -> ThreadPoolExecutor:
+        "Gets this module's thread pool, creating it if necessary."
+        if self.__thread_pool is None:
+            self.__thread_pool = ThreadPoolExecutor(
+                max_workers=self.config.threads, thread_name_prefix="omnibot-" + self.name
+            )
+        return self.__thread_pool
+
+    async def run_in_thread(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Runs a blocking callable (e.g. file or database I/O) on this module's thread pool, and
+        returns its result.
+
+        With the default of one thread per module, calls run one at a time in the order they were
+        made.
+        """
+        call = functools.partial(func, *args, **kwargs)
+        return await self.loop.run_in_executor(self.thread_pool(), call)
+
+    async def run_in_process(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Runs a CPU-bound callable on the process pool shared by all modules, and returns its
+        result.
+
+        The callable, its arguments and its result must all be picklable, and the callable must be
+        importable by name from a fresh interpreter.
+        """
+        call = functools.partial(func, *args, **kwargs)
+        return await self.loop.run_in_executor(executor.process_pool(), call)
+
+    async def shutdown_executors(self) -> None:
+        """
+        Waits for work running on this module's thread pool to finish, and shuts it down.
+
+        This is called by the server after on_unload.
+        """
+        pool = self.__thread_pool
+        if pool is None:
+            return
+        self.__thread_pool = None
+        await self.loop.run_in_executor(None, functools.partial(pool.shutdown, wait=True))
+
+    @property
+    def state_adopted(self) -> bool:
+        """
+        Whether this instance adopted the state of the instance it replaced, in which case on_load
+        doesn't need to load it again.
+        """
+        return self.__state_adopted
+
+    @property
+    def state_exported(self) -> bool:
+        """
+        Whether the state this instance exported was adopted by the instance replacing it, in
+        which case on_unload doesn't need to persist it.
+        """
+        return self.__state_exported
+
+    @state_exported.setter
+    def state_exported(self, exported: bool) -> None:
+        self.__state_exported = exported
+
+    def stats(self) -> Mapping[str, float]:
+        """
+        Gets counters or measurements specific to this module (e.g. cache hits), by name, to be
+        served as metrics.
+        """
+        return {}
+
+    def memory_breakdown(self) -> Mapping[Optional[str], Any]:
+        """
+        Gets the objects holding this module's state, by the channel they belong to (None for
+        state that doesn't belong to a channel), for measuring how much memory it uses.
+
+        By default, this is everything set on the module instance, not broken down by channel.
+        """
+        return {None: vars(self)}
+
+    def memory_shared(self) -> Iterable[Any]:
+        """
+        Gets objects that this module's state refers to but that are shared with other instances
+        (e.g. on other servers). They're left out of its breakdown, and measured once between
+        every instance instead.
+        """
+        return ()
+
+    async def export_state(self) -> Any:
+        """
+        Gets this module's live state, to hand to the instance that replaces it when it's
+        reloaded.
+
+        This is called after the module has stopped handling events, and before on_unload. Return
+        None (the default) to not hand anything over.
+        """
+        return None
+
+    async def import_state(self, state: Any):
+        """
+        Takes over the state exported by the instance this one is replacing, once it has been
+        migrated to this class's state_version. This is called before on_load.
+        """
+
+    def migrate_state(self, state: Any, version: int) -> Any:
+        """
+        Converts state exported by an instance with a different state_version into this class's
+        version.
+
+        Returning None (the default) discards the state, so this instance loads it some other way
+        (e.g. from disk) instead.
+        """
+        return None
+
+    async def adopt_state(self, state: Any, version: int) -> bool:
+        """
+        Called by the server on a new instance to take over the state exported by the instance it
+        is replacing. Returns whether the state was adopted.
+        """
+        if version != self.state_version:
+            state = self.migrate_state(state, version)
+            if state is None:
+                return False
+        await self.import_state(state)
+        self.__state_adopted = True
+        return True
+
     async def on_unload(self):
         """
         Callback for when a module is unloaded.
@@ -105,6 +250,22 @@ class Module:
         If the bot is the one who is leaving, 'who' is None.
         """
 
+    async def handle_message(self, message: Message):
+        """
+        Callback for when a message is received, which the server calls with a Message that is
+        shared between every module handling it.
+
+        By default, this calls on_message, or for modules that don't override on_message, runs
+        any command at the start of the message.
+        """
+        if type(self).on_message is not Module.on_message:
+            await self.on_message(message.channel, message.sender, message.message)
+        elif message.sender is not None and message.command in self.commands:
+            call = self.on_command(
+                message.command, message.channel, message.sender, message.message
+            )
+            await self.server.metrics.call(self.name, "on_command", message.channel, call)
+
     async def on_message(self, channel: Optional[str], who: Optional[str], text: str):
         """
         Callback for when a message is received.
@@ -115,7 +276,8 @@ class Module:
         if not parts:
             return
         if parts[0] in self.commands:
-            await self.on_command(parts[0], channel, who, text)
+            call = self.on_command(parts[0], channel, who, text)
+            await self.server.metrics.call(self.name, "on_command", channel, call)
 
     async def on_command(
         self, command: str, channel: Optional[str], who: Optional[str], text: str
@@ -124,11 +286,53 @@ class Module:
         Callback for when a message is prefixed with a known command.
         """
 
+    def handles(self, hook: str) -> bool:
+        """
+        Checks whether this module handles a hook, so that the server only queues events for the
+        modules that do something with them.
+
+        Modules handle messages if they handle either handle_message or on_message, or have
+        commands.
+        """
+        if hook in ("handle_message", "on_message"):
+            return (
+                bool(self.commands)
+                or self._handles("handle_message")
+                or self._handles("on_message")
+            )
+        return self._handles(hook)
+
+    def _handles(self, hook: str) -> bool:
+        clazz = type(self)
+        if clazz.hooks is not None:
+            return hook in clazz.hooks
+        return getattr(clazz, hook) is not getattr(Module, hook)
+
+    def route_channels(self) -> Iterable[str]:
+        """
+        The channels whose PRIVMSGs the server should route to this module.
+
+        By default, these are the channels in this module's configuration.
+        """
+        return self.config.channels
+
+    def route_nicks(self) -> Iterable[str]:
+        """
+        The nicks whose messages (of any command) the server should route to this module.
+
+        By default, no nicks are routed.
+        """
+        return ()
+
     def should_handle(self, msg) -> bool:
         """
         Checks if this message should be handled by this bot.
 
         If True, the message will be passed on to the on_message handler; otherwise, false.
+
+        The server only calls this for modules that override it; all other modules are selected
+        through the routing table built from route_channels and route_nicks. Modules that override
+        this without overriding either of those are offered every message.
         """
         return (
             bool(msg.parameters)
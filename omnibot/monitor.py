@@ -0,0 +1,283 @@
+import asyncio
+import logging
+import os
+from typing import Any, Mapping, Optional
+from aiohttp import web
+from .config import HttpConfig
+from .memory import MemorySampler
+
+
+log = logging.getLogger(__name__)
+
+
+# How often to check how late the event loop is running, in seconds.
+LOOP_LAG_INTERVAL = 1.0
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def resident_memory() -> Optional[int]:
+    """
+    Gets the resident set size of this process, in bytes, if it can be determined.
+    """
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # not the current size, but the best that's available; this is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Exposition:
+    """
+    Builds a page of metrics in the Prometheus text format.
+    """
+
+    def __init__(self) -> None:
+        self._lines = []
+
+    def family(self, name: str, kind: str, help: str) -> None:
+        self._lines += ["# HELP {} {}".format(name, help), "# TYPE {} {}".format(name, kind)]
+
+    def sample(self, name: str, value: Any, **labels: Any) -> None:
+        if value is None:
+            return
+        if labels:
+            name += "{" + ",".join(
+                '{}="{}"'.format(k, _escape(str(v))) for k, v in sorted(labels.items())
+            ) + "}"
+        self._lines += ["{} {}".format(name, float(value))]
+
+    def render(self) -> str:
+        return "\n".join(self._lines) + "\n"
+
+
+class Monitor:
+    """
+    Serves metrics about a ServerManager's servers over HTTP.
+
+    * ``/metrics`` gives metrics in the Prometheus text format.
+    * ``/ready`` is 200 once every server is registered and in all of its channels, else 503.
+    """
+
+    def __init__(
+        self,
+        manager: "ServerManager",
+        config: HttpConfig,
+        loop=None,
+        memory: Optional[MemorySampler] = None,
+    ) -> None:
+        self._manager = manager
+        self._config = config
+        self._memory = memory
+        self._loop = loop or asyncio.get_event_loop()
+        self._runner = None
+        self._lag_task = None
+        self._loop_lag = 0.0
+
+    @property
+    def loop_lag(self) -> float:
+        "How late, in seconds, the event loop last ran a timer."
+        return self._loop_lag
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+        app.router.add_get("/ready", self._handle_ready)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self._config.address, self._config.port)
+        await site.start()
+        self._lag_task = self._loop.create_task(self._measure_loop_lag())
+        log.info("Serving metrics on http://%s:%s/", self._config.address, self._config.port)
+
+    async def stop(self) -> None:
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _measure_loop_lag(self) -> None:
+        while True:
+            start = self._loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self._loop_lag = max(0.0, self._loop.time() - start - LOOP_LAG_INTERVAL)
+
+    def ready(self) -> bool:
+        return all(server.ready for server in self._manager.servers.values())
+
+    async def _handle_ready(self, request) -> web.Response:
+        if self.ready():
+            return web.Response(text="ready\n")
+        return web.Response(status=503, text="not ready\n")
+
+    async def _handle_metrics(self, request) -> web.Response:
+        return web.Response(
+            body=self.render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    def render(self) -> str:
+        page = Exposition()
+        servers = self._manager.servers
+
+        page.family("omnibot_servers", "gauge", "Configured servers.")
+        page.sample("omnibot_servers", len(servers))
+        page.family("omnibot_ready", "gauge", "Whether every server is registered and joined.")
+        page.sample("omnibot_ready", int(self.ready()))
+        page.family("omnibot_event_loop_lag_seconds", "gauge", "How late the event loop runs timers.")
+        page.sample("omnibot_event_loop_lag_seconds", self._loop_lag)
+        page.family("process_resident_memory_bytes", "gauge", "Resident memory size in bytes.")
+        page.sample("process_resident_memory_bytes", resident_memory())
+
+        per_server = [
+            ("omnibot_connected", "gauge", "Whether the server has registered the bot.",
+             lambda s: int(s.connected)),
+            ("omnibot_reconnects_total", "counter", "Times the bot has registered again.",
+             lambda s: s.reconnects),
+            ("omnibot_server_lag_seconds", "gauge", "Round-trip time of pings to the server.",
+             lambda s: s.lag),
+            ("omnibot_channels_wanted", "gauge", "Channels that loaded modules want to be in.",
+             lambda s: len(s.wanted_channels())),
+            ("omnibot_channels_active", "gauge", "Channels the bot is in.",
+             lambda s: len(s.active_channels)),
+            ("omnibot_modules", "gauge", "Loaded modules.",
+             lambda s: len(s.modules)),
+            ("omnibot_messages_received_total", "counter", "Lines received from the server.",
+             lambda s: s.received.count),
+            ("omnibot_messages_received_per_second", "gauge",
+             "Lines received per second, averaged over the last minute.",
+             lambda s: s.received.rate()),
+            ("omnibot_messages_sent_total", "counter", "Lines sent to the server.",
+             lambda s: s.outbound.sent),
+            ("omnibot_messages_sent_per_second", "gauge",
+             "Lines sent per second, averaged over the last minute.",
+             lambda s: s.outbound.send_rate),
+            ("omnibot_outbound_queue_depth", "gauge", "Lines waiting to be sent.",
+             lambda s: s.outbound.depth),
+            ("omnibot_outbound_queue_wait_seconds", "gauge",
+             "How long the oldest unsent line has been waiting.",
+             lambda s: s.outbound.wait_time),
+        ]
+        for name, kind, help, value in per_server:
+            page.family(name, kind, help)
+            for address, server in servers.items():
+                page.sample(name, value(server), server=address)
+
+        page.family("omnibot_module_queue_depth", "gauge", "Events waiting for a module.")
+        for address, server in servers.items():
+            for name, worker in server.workers.items():
+                page.sample("omnibot_module_queue_depth", worker.depth, server=address, module=name)
+        page.family(
+            "omnibot_module_events_dropped_total", "counter", "Events dropped by full module queues."
+        )
+        for address, server in servers.items():
+            for name, worker in server.workers.items():
+                page.sample(
+                    "omnibot_module_events_dropped_total", worker.dropped, server=address, module=name
+                )
+
+        handler_counts = [
+            ("omnibot_handler_calls_total", "Module handler calls.", lambda s: s.calls),
+            ("omnibot_handler_errors_total", "Module handler calls that raised.", lambda s: s.errors),
+            ("omnibot_handler_cancelled_total", "Module handler calls that were cancelled.",
+             lambda s: s.cancelled),
+        ]
+        handler_stats = [
+            (address, self._handler_stats(server)) for address, server in servers.items()
+        ]
+        for name, help, value in handler_counts:
+            page.family(name, "counter", help)
+            for address, stats in handler_stats:
+                for (module, hook), stat in stats.items():
+                    page.sample(name, value(stat), server=address, module=module, hook=hook)
+        page.family("omnibot_handler_seconds", "summary", "Module handler latency.")
+        for address, stats in handler_stats:
+            for (module, hook), stat in stats.items():
+                labels = dict(server=address, module=module, hook=hook)
+                for quantile in (0.5, 0.9, 0.99):
+                    page.sample(
+                        "omnibot_handler_seconds",
+                        stat.latency.percentile(quantile * 100),
+                        quantile=quantile,
+                        **labels
+                    )
+                page.sample("omnibot_handler_seconds_sum", stat.latency.total, **labels)
+                page.sample("omnibot_handler_seconds_count", stat.latency.count, **labels)
+
+        page.family(
+            "omnibot_module_stat", "gauge", "Values that modules report about themselves."
+        )
+        for address, server in servers.items():
+            for module_name, module in server.modules.items():
+                try:
+                    stats = module.stats()
+                except Exception:
+                    log.exception("Could not get stats from module %s", module_name)
+                    continue
+                for stat, value in sorted(stats.items()):
+                    page.sample(
+                        "omnibot_module_stat",
+                        value,
+                        server=address,
+                        module=module_name,
+                        stat=stat,
+                    )
+
+        if self._memory is not None:
+            self._render_memory(page, self._memory)
+        return page.render()
+
+    @staticmethod
+    def _render_memory(page: Exposition, memory: MemorySampler) -> None:
+        page.family(
+            "omnibot_module_memory_bytes", "gauge", "Memory held by a module, by channel."
+        )
+        for (address, module, channel), size in sorted(
+            memory.sizes.items(), key=lambda item: (item[0][0], item[0][1], item[0][2] or "")
+        ):
+            page.sample(
+                "omnibot_module_memory_bytes",
+                size,
+                server=address,
+                module=module,
+                channel=channel or "",
+            )
+        page.family(
+            "omnibot_module_shared_memory_bytes",
+            "gauge",
+            "Memory shared by every instance of a module, counted once.",
+        )
+        for module, size in sorted(memory.shared.items()):
+            page.sample("omnibot_module_shared_memory_bytes", size, module=module)
+        page.family(
+            "omnibot_module_traced_memory_bytes",
+            "gauge",
+            "Memory held that was allocated by a module's code, if allocations are traced.",
+        )
+        for module, size in sorted(memory.traced.items()):
+            page.sample("omnibot_module_traced_memory_bytes", size, module=module)
+        page.family(
+            "omnibot_memory_sample_seconds", "gauge", "How long measuring modules' memory took."
+        )
+        page.sample("omnibot_memory_sample_seconds", memory.duration)
+
+    @staticmethod
+    def _handler_stats(server: "Server") -> Mapping:
+        # channels are left out, since there could be a great many of them
+        stats = {}
+        for (module, hook, _), stat in server.metrics.items():
+            key = (module, hook)
+            if key not in stats:
+                stats[key] = stat.__class__()
+            stats[key].merge(stat)
+        return stats
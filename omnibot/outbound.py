@@ -0,0 +1,209 @@
+import asyncio
+from collections import deque, OrderedDict
+import logging
+from typing import Callable, List
+from .config import FloodConfig
+from .metrics import RateMeter
+
+
+log = logging.getLogger(__name__)
+
+
+# The maximum length of an IRC line, including the trailing CRLF.
+MAX_LINE_BYTES = 512
+# Room left for the ":nick!user@host " prefix that the server adds when relaying a message. Users
+# are at most 10 characters, and hosts at most 63.
+HOSTMASK_RESERVE = len(":!@ ") + 10 + 63
+
+
+def split_text(text: str, limit: int) -> List[str]:
+    """
+    Splits text into pieces that are at most `limit` bytes long when encoded as UTF-8.
+
+    Newlines always start a new piece. Otherwise, pieces are broken on the last space that fits,
+    or on the last whole character if there is no space.
+    """
+    assert limit >= 4, "split limit must fit any UTF-8 character"
+    pieces = []
+    for line in text.splitlines():
+        encoded = line.encode()
+        while len(encoded) > limit:
+            cut = limit
+            # don't split a multi-byte character
+            while cut > 0 and (encoded[cut] & 0xC0) == 0x80:
+                cut -= 1
+            space = encoded.rfind(b" ", 0, cut + 1)
+            if space > 0:
+                cut = space
+            pieces += [encoded[:cut].decode()]
+            encoded = encoded[cut:].lstrip(b" ")
+        if encoded:
+            pieces += [encoded.decode()]
+    return pieces
+
+
+class OutboundQueue:
+    """
+    Paces lines sent to a server with a token bucket so that the bot is not disconnected for
+    flooding.
+
+    Protocol lines (JOIN, PART, etc.) are always sent before chat lines. Chat lines are queued per
+    target and sent round-robin, so one busy channel can't starve the others.
+    """
+
+    def __init__(self, send: Callable[[str], None], flood: FloodConfig, nick: str, loop=None):
+        self._send = send
+        self._loop = loop or asyncio.get_event_loop()
+        self._flood = flood
+        self._nick = nick
+        self._protocol = deque()
+        self._targets = OrderedDict()
+        self._depth = 0
+        self._tokens = float(flood.burst)
+        self._updated = self._loop.time()
+        self._ready = asyncio.Event()
+        self._paused = True
+        self._task = None
+        self._sent = RateMeter()
+        self._total_wait = 0.0
+
+    @property
+    def flood(self) -> FloodConfig:
+        return self._flood
+
+    @flood.setter
+    def flood(self, flood: FloodConfig):
+        self._refill()
+        self._flood = flood
+        self._tokens = min(self._tokens, float(flood.burst))
+
+    @property
+    def depth(self) -> int:
+        "The number of lines waiting to be sent."
+        return self._depth
+
+    @property
+    def wait_time(self) -> float:
+        "How long, in seconds, the oldest line that has not been sent yet has been waiting."
+        oldest = [self._protocol[0][0]] if self._protocol else []
+        oldest += [lines[0][0] for lines in self._targets.values()]
+        if not oldest:
+            return 0.0
+        return self._loop.time() - min(oldest)
+
+    @property
+    def sent(self) -> int:
+        "The number of lines sent through this queue."
+        return self._sent.count
+
+    @property
+    def send_rate(self) -> float:
+        "The number of lines sent per second, averaged over the last minute."
+        return self._sent.rate()
+
+    @property
+    def average_wait(self) -> float:
+        "The average time, in seconds, that sent lines spent waiting in this queue."
+        if self.sent == 0:
+            return 0.0
+        return self._total_wait / self.sent
+
+    @property
+    def paused(self) -> bool:
+        return self._paused
+
+    def pause(self) -> None:
+        "Stops sending lines (e.g. while disconnected); they remain queued."
+        self._paused = True
+
+    def resume(self) -> None:
+        "Starts sending queued lines again."
+        self._paused = False
+        self._wake()
+
+    def push(self, line: str) -> None:
+        """
+        Queues a protocol line, which is sent ahead of any chat lines.
+        """
+        self._protocol.append((self._loop.time(), line))
+        self._depth += 1
+        self._wake()
+
+    def push_message(self, target: str, text: str, command: str = "PRIVMSG") -> None:
+        """
+        Queues a chat message to a target, splitting it across as many lines as it takes to fit.
+        """
+        head = "{} {} :".format(command, target)
+        limit = MAX_LINE_BYTES - len("\r\n") - HOSTMASK_RESERVE - len(self._nick.encode())
+        pieces = split_text(text, limit - len(head.encode()))
+        if not pieces:
+            return
+        now = self._loop.time()
+        lines = self._targets.setdefault(target, deque())
+        lines.extend((now, head + piece) for piece in pieces)
+        self._depth += len(pieces)
+        self._wake()
+
+    def charge(self, lines: int = 1) -> None:
+        """
+        Accounts for lines that were sent without going through this queue (e.g. PONG replies).
+        """
+        self._refill()
+        self._tokens -= lines
+
+    def clear(self) -> None:
+        "Drops every queued line."
+        self._protocol.clear()
+        self._targets.clear()
+        self._depth = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = self._loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def _wake(self) -> None:
+        if self._depth and not self._paused:
+            self._ready.set()
+
+    def _refill(self) -> None:
+        now = self._loop.time()
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(float(self.flood.burst), self._tokens + elapsed * self.flood.rate)
+
+    def _pop(self):
+        if self._protocol:
+            return self._protocol.popleft()
+        target, lines = self._targets.popitem(last=False)
+        item = lines.popleft()
+        if lines:
+            # back of the line for this target
+            self._targets[target] = lines
+        return item
+
+    async def _run(self) -> None:
+        while True:
+            await self._ready.wait()
+            if self._paused or not self._depth:
+                self._ready.clear()
+                continue
+            self._refill()
+            if self._tokens < 1.0:
+                await asyncio.sleep((1.0 - self._tokens) / self.flood.rate)
+                continue
+            queued_at, line = self._pop()
+            self._depth -= 1
+            self._tokens -= 1.0
+            self._sent.mark()
+            self._total_wait += self._loop.time() - queued_at
+            self._send(line)
@@ -0,0 +1,212 @@
+import asyncio
+from collections import Counter
+import cProfile
+import io
+import logging
+import pstats
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Mapping, Optional, Sequence
+from .config import ProfilerConfig
+
+
+log = logging.getLogger(__name__)
+
+
+# How many functions to list in each section of a profile summary.
+SUMMARY_LINES = 25
+
+
+def collapse_stack(frame, root: str) -> str:
+    """
+    Formats a stack as a line of a collapsed-stack file (outermost frame first), as read by
+    flamegraph.pl and speedscope.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{} ({})".format(code.co_name, code.co_filename).replace(";", ":"))
+        frame = frame.f_back
+    names.append(root)
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """
+    Samples the stacks of every thread in this process from a background thread.
+
+    This is cheap enough to run against a live bot: sampled threads aren't traced, and are only
+    held up while the interpreter switches to the sampling thread.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self._interval = interval
+        self._stacks = Counter()
+        self._samples = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def stacks(self) -> Mapping[str, int]:
+        "The number of times each collapsed stack was sampled."
+        return self._stacks
+
+    @property
+    def samples(self) -> int:
+        return self._samples
+
+    def start(self) -> None:
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="omnibot-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def sample(self) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        me = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident != me:
+                self._stacks[collapse_stack(frame, names.get(ident, str(ident)))] += 1
+        self._samples += 1
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self._interval):
+            self.sample()
+
+    def write(self, path: Path) -> None:
+        with open(str(path), "w") as fp:
+            for stack, count in sorted(self._stacks.items()):
+                fp.write("{} {}\n".format(stack, count))
+
+
+class Profiler:
+    """
+    Profiles this process for a while on request, writing the results to the configured directory.
+
+    Each run writes:
+
+    * ``<name>.folded``: collapsed stacks sampled from every thread, for flame graphs.
+    * ``<name>.pstats``: cProfile data for the event loop thread, if enabled.
+    * ``<name>.txt``: a cProfile summary for the whole process, and for each loaded module.
+    """
+
+    def __init__(
+        self, config: ProfilerConfig, manager: "ServerManager", name: str = None, loop=None
+    ) -> None:
+        self._config = config
+        self._manager = manager
+        self._name = name
+        self._loop = loop or asyncio.get_event_loop()
+        self._sampler = None
+        self._profile = None
+        self._started = None
+        self._timer = None
+
+    @property
+    def config(self) -> ProfilerConfig:
+        return self._config
+
+    @property
+    def running(self) -> bool:
+        return self._sampler is not None
+
+    def toggle(self) -> None:
+        """
+        Starts profiling, or stops early if a profile is already being taken.
+        """
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        log.info(
+            "Profiling for %.0fs (sampling every %.3fs, cProfile %s)",
+            self._config.duration,
+            self._config.interval,
+            "on" if self._config.cprofile else "off",
+        )
+        self._started = time.localtime()
+        self._sampler = StackSampler(self._config.interval)
+        self._sampler.start()
+        if self._config.cprofile:
+            # cProfile only traces the thread that enables it, so this must run on the loop thread
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._timer = self._loop.call_later(self._config.duration, self.stop)
+
+    def stop(self) -> None:
+        if not self.running:
+            return
+        self._timer.cancel()
+        if self._profile is not None:
+            self._profile.disable()
+        self._sampler.stop()
+        sampler, profile = self._sampler, self._profile
+        self._sampler = self._profile = None
+        name = time.strftime("profile-%Y%m%d-%H%M%S", self._started)
+        if self._name:
+            name += "-" + self._name
+        modules = self._module_paths()
+        self._loop.run_in_executor(None, self._write, name, sampler, profile, modules)
+
+    def _module_paths(self) -> Sequence:
+        "(server address, module name, source path) for every loaded module."
+        paths = []
+        for address, server in self._manager.servers.items():
+            for name, module in server.modules.items():
+                path = server.loader.source_path(module.config.name)
+                if path is not None:
+                    paths.append((address, name, path))
+        return paths
+
+    def _write(
+        self,
+        name: str,
+        sampler: StackSampler,
+        profile: Optional[cProfile.Profile],
+        modules: Sequence,
+    ) -> None:
+        directory = self._config.directory
+        try:
+            directory.mkdir(parents=True, exist_ok=True)
+            sampler.write(directory / (name + ".folded"))
+            if profile is not None:
+                profile.dump_stats(str(directory / (name + ".pstats")))
+                with open(str(directory / (name + ".txt")), "w") as fp:
+                    fp.write(self.summarize(profile, modules))
+        except Exception:
+            log.exception("Could not write profile %s", name)
+            return
+        log.info("Wrote profile %s to %s (%s samples)", name, directory, sampler.samples)
+
+    @staticmethod
+    def summarize(profile: cProfile.Profile, modules: Sequence) -> str:
+        """
+        Summarizes the functions that took the most time, for the whole process and then for
+        the functions defined in each module's source.
+        """
+        sections = [("all", None)]
+        sections += [
+            ("{} on {}".format(name, address), re.escape(str(path)))
+            for address, name, path in modules
+        ]
+        out = io.StringIO()
+        for title, restriction in sections:
+            out.write("==== {} ====\n".format(title))
+            stats = pstats.Stats(profile, stream=out).sort_stats("cumulative")
+            if restriction is None:
+                stats.print_stats(SUMMARY_LINES)
+            else:
+                stats.print_stats(restriction, SUMMARY_LINES)
+        return out.getvalue()
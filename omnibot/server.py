@@ -1,31 +1,72 @@
 import abc
 import asyncio
 import logging
-from typing import Sequence, Optional
+import random
+from typing import Any, List, Mapping, Sequence, Set, Optional
 from asyncirc.server import Server as IrcServer
 from asyncirc.protocol import IrcProtocol
+from .connection import Connection
 from .loader import ModuleLoader
 from .message import Message
-from .config import ServerConfig
+from .metrics import HandlerMetrics, RateMeter
+from .module import Module
+from .config import ModuleConfig, ServerConfig
+from .outbound import OutboundQueue
+from .worker import ModuleWorker
 
 
 log = logging.getLogger(__name__)
 
 
+# Hooks that are called on every module that handles them, rather than being routed.
+LIFECYCLE_HOOKS = ("on_connect", "on_join", "on_part", "on_kick")
+
+
 class Server:
-    def __init__(self, loader: ModuleLoader, config: ServerConfig, loop=None) -> None:
+    def __init__(
+        self, loader: ModuleLoader, config: ServerConfig, loop=None, conn: IrcProtocol = None
+    ) -> None:
+        """
+        Sets up a server. ``conn`` replaces the connection to the IRC server, e.g. for
+        benchmarking; it must provide the parts of IrcProtocol's interface that are used here.
+        """
         self._config = config
         self._modules = {}
+        self._workers = {}
+        # modules that are still loading after the server started connecting, by name
+        self._loading = {}
+        self._metrics = HandlerMetrics()
         self._loader = loader
         self._loop = loop or asyncio.get_event_loop()
-        self._conn = IrcProtocol(
-            [IrcServer(config.address, config.port, config.ssl)],
-            config.nick,
-            loop=self._loop,
-        )
+        if conn is None:
+            conn = Connection(
+                [IrcServer(config.address, config.port, config.ssl)],
+                config.nick,
+                loop=self._loop,
+                on_lost=self._connection_lost,
+            )
+        self._conn = conn
         self._conn.register("*", self.on_server_message)
+        self._outbound = OutboundQueue(self._conn.send, config.flood, config.nick, loop=self._loop)
         self._active_channels = set()
         self._connected = False
+        self._registrations = 0
+        self._received = RateMeter()
+        # keepalive: the unanswered ping's token, when it was sent, and when it times out
+        self._pings = 0
+        self._ping = None
+        self._ping_sent = None
+        self._ping_timeout = None
+        self._lag = None
+        self._keepalive_task = None
+        self._reconnect_task = None
+        self._reconnect_attempts = 0
+        # routing tables, rebuilt whenever the set of loaded modules or channels changes
+        self._channel_routes = {}
+        self._nick_routes = {}
+        self._unrouted = []
+        # the loaded modules that handle each lifecycle hook
+        self._subscribers = {hook: [] for hook in LIFECYCLE_HOOKS}
 
     @property
     def config(self) -> ServerConfig:
@@ -47,16 +88,169 @@ class Server:
     def loop(self):
         return self._loop
 
+    @property
+    def connected(self) -> bool:
+        "Whether this server has registered the bot's connection (i.e. sent 001)."
+        return self._connected
+
+    @property
+    def active_channels(self) -> Set[str]:
+        "The channels the bot is currently in."
+        return self._active_channels
+
+    @property
+    def modules(self) -> Mapping[str, Module]:
+        "The loaded modules, by name."
+        return self._modules
+
+    @property
+    def received(self) -> RateMeter:
+        "Lines received from this server."
+        return self._received
+
+    @property
+    def reconnects(self) -> int:
+        "The number of times the connection has been registered again after the first time."
+        return max(0, self._registrations - 1)
+
+    @property
+    def lag(self) -> Optional[float]:
+        """
+        The round-trip time to the server, in seconds: how long the last ping took to be
+        answered, or how long the current one has been waiting if that's longer. None until a
+        ping has been answered.
+        """
+        if self._ping_sent is not None:
+            return max(self._lag or 0.0, self.loop.time() - self._ping_sent)
+        return self._lag
+
+    @property
+    def ready(self) -> bool:
+        """
+        Whether this server is registered, every module has finished loading, and it's in every
+        channel its modules want.
+        """
+        return (
+            self._connected
+            and not self._loading
+            and self.wanted_channels() <= self._active_channels
+        )
+
+    @property
+    def loader(self) -> ModuleLoader:
+        "The loader that this server's modules come from."
+        return self._loader
+
+    @property
+    def metrics(self) -> HandlerMetrics:
+        "Timings and error counts for the handlers of this server's modules."
+        return self._metrics
+
+    @property
+    def outbound(self) -> OutboundQueue:
+        "The queue of lines waiting to be sent to this server."
+        return self._outbound
+
     async def connect(self) -> None:
-        await self.load_modules()
-        await self._conn.connect()
+        await self.load_modules(defer=True)
+        self._outbound.start()
+        self._keepalive_task = self.loop.create_task(self._keepalive())
+        if not await self._conn.connect():
+            self._schedule_reconnect()
 
     async def disconnect(self) -> None:
         log.debug("Disconnecting from %s", self.address)
+        for task in (self._keepalive_task, self._reconnect_task):
+            if task is not None:
+                task.cancel()
+        self._keepalive_task = self._reconnect_task = None
+        self._clear_ping()
         await self.unload_modules()
         self._connected = False
+        await self._outbound.stop()
         self._conn.quit()
 
+    async def _keepalive(self) -> None:
+        """
+        Pings the server every so often, to measure the lag and to notice when the connection
+        has stalled.
+        """
+        while True:
+            await asyncio.sleep(self.config.keepalive.interval)
+            if self._connected and self._ping is None:
+                self._send_ping()
+
+    def _send_ping(self) -> None:
+        self._pings += 1
+        self._ping = "omnibot{}".format(self._pings)
+        self._ping_sent = self.loop.time()
+        self._ping_timeout = self.loop.call_later(
+            self.config.keepalive.timeout, self._ping_timed_out
+        )
+        # pings are sent straight away, rather than queued, so that they measure the connection
+        # and not the outbound queue
+        self._outbound.charge()
+        self._conn.send("PING :" + self._ping)
+
+    def _clear_ping(self) -> None:
+        if self._ping_timeout is not None:
+            self._ping_timeout.cancel()
+        self._ping = self._ping_sent = self._ping_timeout = None
+
+    def _on_pong(self, msg) -> bool:
+        "Records the lag if a PONG answers our ping, returning whether it did."
+        if self._ping is None or not msg.parameters or msg.parameters[-1] != self._ping:
+            return False
+        self._lag = self.loop.time() - self._ping_sent
+        self._clear_ping()
+        return True
+
+    def _ping_timed_out(self) -> None:
+        log.warning(
+            "%s has not answered a ping for %ss, reconnecting",
+            self.address,
+            self.config.keepalive.timeout,
+        )
+        self._ping_timeout = None
+        self._conn.drop()
+
+    def _connection_lost(self) -> None:
+        """
+        Called when the connection is lost without quitting. Modules stay loaded, and the server
+        reconnects after a while.
+        """
+        self._connected = False
+        self._active_channels.clear()
+        self._outbound.pause()
+        self._clear_ping()
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self) -> None:
+        if self._reconnect_task is None:
+            self._reconnect_task = self.loop.create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        """
+        Tries to connect again until it works, waiting twice as long after each failure. The
+        wait starts over once the server registers the bot.
+        """
+        try:
+            while True:
+                keepalive = self.config.keepalive
+                delay = min(
+                    keepalive.backoff_max, keepalive.backoff * 2 ** self._reconnect_attempts
+                )
+                # half of the delay is random, so that servers that lost their connections at the
+                # same time don't all reconnect at the same time
+                delay = delay / 2 + random.uniform(0, delay / 2)
+                self._reconnect_attempts += 1
+                log.info("Reconnecting to %s in %.1fs", self.address, delay)
+                await asyncio.sleep(delay)
+                if await self._conn.connect():
+                    return
+        finally:
+            self._reconnect_task = None
+
     async def reload(self, config: ServerConfig) -> None:
         """
         Reloads a server based on a new configuration.
@@ -67,14 +261,22 @@ class Server:
             and self.config.ssl == config.ssl
         ), "changing a connection must be done through the server manager"
         self._config = config
+        self._outbound.flood = config.flood
         await self.reload_modules()
 
     async def reload_modules(self) -> None:
         """
-        Unloads, and then reloads all modules for this server.
+        Reloads modules whose configuration changed (or that are always reloaded), unloads
+        modules that were removed from the configuration, and loads new ones.
+
+        Reloaded modules are replaced one pair at a time: the new instance adopts the old
+        instance's exported state before the old instance is unloaded. If the new instance fails
+        to load, the old instance is unloaded as though nothing was handed over, so that it can
+        persist its state itself.
         """
         log.debug("Reloading modules")
         unload = []
+        replace = []
         for module in self._modules.values():
             if module.name in self.config.modules:
                 if (
@@ -82,75 +284,264 @@ class Server:
                     or module.config.always_reload
                 ):
                     log.debug("Scheduling %s for reload", module.name)
-                    unload += [module.name]
+                    replace += [module.name]
             else:
                 unload += [module.name]
+        # modules that are still loading are started again if their configuration changed
+        await self._cancel_loading(
+            [
+                name
+                for name, (config, _) in self._loading.items()
+                if self.config.modules.get(name) != config
+            ]
+        )
 
         await self.unload_modules(unload)
+        await asyncio.gather(*[self._replace_module(name) for name in replace])
         await self.load_modules()
         self.match_channels()
 
-    async def load_modules(self) -> None:
+    async def _replace_module(self, name: str) -> None:
+        old = self._modules.pop(name)
+        worker = self._workers.pop(name)
+        self.rebuild_routes()
+        await worker.stop()
+        state = None
+        try:
+            state = await old.export_state()
+        except Exception:
+            log.exception("Could not export state from module %s", name)
+        loaded = None
+        config = self.config.modules[name]
+        ctor = self._module_class(config)
+        if ctor is not None:
+            loaded = await self._load_module(config, ctor, state, old.state_version)
+        self.rebuild_routes()
+        old.state_exported = loaded is not None and loaded.state_adopted
+        await self._unload_module(old, worker)
+
+    async def load_modules(self, defer: bool = False) -> None:
         """
-        Loads all modules that have not yet been loaded for this server.
+        Loads all modules that have not yet been loaded for this server, all at the same time.
+
+        With ``defer``, this only waits for the modules that have to be loaded before the server
+        connects (see Module.preload). The others carry on loading in the background, and their
+        channels are joined once they're loaded.
         """
         log.debug("Loading modules")
+        waiting = []
         for config in self.config.modules.values():
-            if config.name in self._modules:
+            if config.name in self._modules or config.name in self._loading:
                 continue
-            on_load = None
-            try:
-                ctor = self._loader.load_module(config.name)
-                loaded = ctor(config, self)
-                on_load = self.loop.create_task(loaded.on_load())
-                await on_load
-                if self._connected:
-                    await loaded.on_connect()
-                self._modules[config.name] = loaded
-            except KeyboardInterrupt:
-                if on_load is not None:
-                    on_load.cancel()
-                raise
-            except:
-                log.exception("Could not load module %s", config.name)
+            ctor = self._module_class(config)
+            if ctor is None:
                 continue
+            if defer and not ctor.preload:
+                log.debug("Loading %s in the background", config.name)
+                task = self.loop.create_task(self._load_deferred(config, ctor))
+                self._loading[config.name] = (config, task)
+            else:
+                waiting += [self._load_module(config, ctor)]
+        tasks = asyncio.gather(*waiting)
+        try:
+            await tasks
+        except KeyboardInterrupt:
+            tasks.cancel()
+            raise
+        self.rebuild_routes()
+
+    def _module_class(self, config: ModuleConfig) -> Optional[type]:
+        "Gets the class of a module from the loader, or None if it can't be loaded."
+        try:
+            return self._loader.load_module(config.name)
+        except Exception:
+            log.exception("Could not load module %s", config.name)
+            return None
+
+    async def _load_deferred(self, config: ModuleConfig, ctor: type) -> None:
+        try:
+            loaded = await self._load_module(config, ctor)
+        finally:
+            self._loading.pop(config.name, None)
+        if loaded is None:
+            return
+        log.info("Module %s finished loading", config.name)
+        self.rebuild_routes()
+        if self._connected:
+            # the bot won't join channels that other modules already joined again, so the module
+            # is told that it's in them as though it had just joined
+            for channel in config.channels:
+                if channel in self._active_channels:
+                    await self.dispatch([loaded], "on_join", channel, None)
+            self.match_channels()
+
+    async def _cancel_loading(self, names: Sequence[str]) -> None:
+        "Stops loading the given modules, if they're still loading in the background."
+        tasks = [self._loading.pop(name)[1] for name in names if name in self._loading]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _load_module(
+        self, config: ModuleConfig, ctor: type, state: Any = None, version: int = None
+    ) -> Optional[Module]:
+        """
+        Loads a module, optionally handing it state exported by the instance it replaces.
+        Returns the module, or None if it could not be loaded.
+        """
+        on_load = None
+        loaded = None
+        try:
+            loaded = ctor(config, self)
+            if state is not None:
+                try:
+                    if not await loaded.adopt_state(state, version):
+                        log.info("Module %s did not adopt its previous state", config.name)
+                except Exception:
+                    log.exception("Module %s could not adopt its previous state", config.name)
+            on_load = self.loop.create_task(loaded.on_load())
+            await asyncio.wait_for(on_load, config.load_timeout)
+            if self._connected:
+                await loaded.on_connect()
+            worker = ModuleWorker(loaded, config.queue_size, config.queue_policy, self._metrics)
+            worker.start()
+            self._modules[config.name] = loaded
+            self._workers[config.name] = worker
+            return loaded
+        except KeyboardInterrupt:
+            if on_load is not None:
+                on_load.cancel()
+            raise
+        except asyncio.CancelledError:
+            if loaded is not None:
+                await loaded.shutdown_executors()
+            raise
+        except asyncio.TimeoutError:
+            log.error("Module %s took more than %ss to load", config.name, config.load_timeout)
+        except:
+            log.exception("Could not load module %s", config.name)
+        if loaded is not None:
+            await loaded.shutdown_executors()
+        return None
 
     async def unload_modules(self, which: Optional[Sequence[str]] = None) -> None:
         """
         Loads specified modules for this server.
 
-        If nothing is specified, all modules are unloaded.
+        If nothing is specified, all modules are unloaded, and modules that are still loading
+        are stopped.
 
         If explicitly zero modules are specified (i.e. an empty set), no modules are unloaded.
         """
         log.debug("Unloading modules")
         if which is None:
+            await self._cancel_loading(list(self._loading))
             which = set(self._modules.keys())
         unloaded = []
         for module_name in which:
-            self._loader.unload_module(module_name)
-            unloaded += [self._modules.pop(module_name).on_unload()]
+            module = self._modules.pop(module_name)
+            worker = self._workers.pop(module_name)
+            unloaded += [self._unload_module(module, worker)]
+        self.rebuild_routes()
 
         await asyncio.gather(*unloaded)
 
-    def match_channels(self):
-        need = {
-            chan for module in self._modules.values() for chan in module.config.channels
+    async def _unload_module(self, module: Module, worker: ModuleWorker) -> None:
+        await worker.stop()
+        try:
+            await module.on_unload()
+        finally:
+            await module.shutdown_executors()
+
+    @property
+    def workers(self) -> Mapping[str, ModuleWorker]:
+        "The event queue workers for each loaded module, by module name."
+        return self._workers
+
+    def rebuild_routes(self) -> None:
+        """
+        Rebuilds the channel and nick routing tables, and the lists of which modules handle each
+        lifecycle hook, from the currently loaded modules.
+
+        Modules that override should_handle are still asked whether they want each message routed
+        to them; modules that override should_handle without declaring any routes are offered
+        every message. Modules that don't handle messages are never routed any.
+        """
+        channel_routes = {}
+        nick_routes = {}
+        unrouted = []
+        self._subscribers = {
+            hook: [module for module in self._modules.values() if module.handles(hook)]
+            for hook in LIFECYCLE_HOOKS
         }
+        for module in self._modules.values():
+            if not module.handles("handle_message"):
+                continue
+            clazz = type(module)
+            filtered = clazz.should_handle is not Module.should_handle
+            if filtered and (
+                clazz.route_channels is Module.route_channels
+                and clazz.route_nicks is Module.route_nicks
+            ):
+                unrouted += [module]
+                continue
+            route = (module, filtered)
+            for channel in module.route_channels():
+                channel_routes.setdefault(channel, []).append(route)
+            for nick in module.route_nicks():
+                nick_routes.setdefault(nick.lower(), []).append(route)
+        self._channel_routes = channel_routes
+        self._nick_routes = nick_routes
+        self._unrouted = unrouted
+
+    def route(self, msg) -> List[Module]:
+        """
+        Gets the modules that a message should be dispatched to, in load order.
+        """
+        routes = ()
+        if msg.command == "PRIVMSG" and msg.parameters:
+            routes = self._channel_routes.get(msg.parameters[0], ())
+        if self._nick_routes and msg.prefix is not None and msg.prefix.nick:
+            by_nick = self._nick_routes.get(msg.prefix.nick.lower())
+            if by_nick:
+                routes = [*routes, *(r for r in by_nick if r not in routes)]
+        modules = [
+            module for module, filtered in routes if not filtered or module.should_handle(msg)
+        ]
+        if self._unrouted:
+            modules += [module for module in self._unrouted if module.should_handle(msg)]
+        return modules
+
+    def wanted_channels(self) -> Set[str]:
+        "The channels that loaded modules want the bot to be in."
+        return {chan for module in self._modules.values() for chan in module.config.channels}
+
+    def match_channels(self):
+        need = self.wanted_channels()
         to_join = need - self._active_channels
         to_leave = self._active_channels - need
         for chan in to_join:
-            self._conn.send("JOIN " + chan)
+            self._outbound.push("JOIN " + chan)
         for chan in to_leave:
-            self._conn.send("PART " + chan)
+            self._outbound.push("PART " + chan)
 
     async def on_server_message(self, conn, msg) -> None:
         """
         Callback that is called whenever a message is received.
         """
         # log.debug("%s", msg)
-        if msg.command == "001":
+        self._received.mark()
+        if msg.command == "PING":
+            # the connection answers pings itself, but the reply still counts against the flood
+            # limit
+            self._outbound.charge()
+        elif msg.command == "PONG" and self._on_pong(msg):
+            pass
+        elif msg.command == "001":
             self._connected = True
+            self._registrations += 1
+            self._reconnect_attempts = 0
+            self._outbound.resume()
             await self.on_connect()
         elif msg.command == "KICK":
             await self.on_kick(msg)
@@ -166,8 +557,8 @@ class Server:
         Callback that is run when this server connects.
         """
         self.match_channels()
-        futures = [module.on_connect() for module in self._modules.values()]
-        tasks = asyncio.gather(*futures, loop=self.loop)
+        futures = [module.on_connect() for module in self._subscribers["on_connect"]]
+        tasks = asyncio.gather(*futures)
         try:
             await tasks
         except KeyboardInterrupt:
@@ -183,15 +574,7 @@ class Server:
         if who == self.config.nick:
             who = None
             self._active_channels.remove(channel)
-        futures = [module.on_kick(channel, who) for module in self._modules.values()]
-        tasks = asyncio.gather(*futures, loop=self.loop)
-        try:
-            await tasks
-        except KeyboardInterrupt:
-            tasks.cancel()
-            raise
-        except:
-            log.exception("Error while handling kick callback")
+        await self.dispatch(self._subscribers["on_kick"], "on_kick", channel, who)
 
         if who is None:
             self.loop.call_later(3.0, self.match_channels)
@@ -205,15 +588,7 @@ class Server:
         if who == self.config.nick:
             who = None
             self._active_channels.remove(channel)
-        futures = [module.on_part(channel, who) for module in self._modules.values()]
-        tasks = asyncio.gather(*futures, loop=self.loop)
-        try:
-            await tasks
-        except KeyboardInterrupt:
-            tasks.cancel()
-            raise
-        except:
-            log.exception("Error while handling part callback")
+        await self.dispatch(self._subscribers["on_part"], "on_part", channel, who)
 
         if who is None:
             self.loop.call_later(3.0, self.match_channels)
@@ -227,15 +602,7 @@ class Server:
         if who == self.config.nick:
             who = None
             self._active_channels.add(channel)
-        futures = [module.on_join(channel, who) for module in self._modules.values()]
-        tasks = asyncio.gather(*futures, loop=self.loop)
-        try:
-            await tasks
-        except KeyboardInterrupt:
-            tasks.cancel()
-            raise
-        except:
-            log.exception("Error while handling join callback")
+        await self.dispatch(self._subscribers["on_join"], "on_join", channel, who)
 
         if who is None:
             self.loop.call_later(3.0, self.match_channels)
@@ -244,35 +611,40 @@ class Server:
         """
         Callback that is run when a PRIVMSG (i.e. a channel or private message) is received.
         """
-        channel = msg.parameters[0]
+        if msg.prefix is None:
+            return
+        modules = self.route(msg)
+        if not modules:
+            return
+        channel = msg.parameters[0] if msg.parameters else None
         if channel not in self._active_channels:
             # private message to us
             channel = None
-        if msg.prefix is None:
-            return
         who = msg.prefix.nick
         if who == self.config.nick:
             who = None
+        target = msg.parameters[0] if msg.parameters else None
         text = " ".join(msg.parameters[1:])
-        futures = [
-            module.on_message(channel, who, text)
-            for module in self._modules.values()
-            if module.should_handle(msg)
-        ]
-        tasks = asyncio.gather(*futures, loop=self.loop)
-        try:
-            await tasks
-        except KeyboardInterrupt:
-            tasks.cancel()
-            raise
-        except:
-            log.exception("Error handling channel message")
+        message = Message(self, who, target, text, channel)
+        await self.dispatch(modules, "handle_message", message)
+
+    async def dispatch(self, modules: Sequence[Module], hook: str, *args) -> None:
+        """
+        Queues a call to the given hook on each module, to be run by that module's worker.
+        """
+        for module in modules:
+            worker = self._workers.get(module.name)
+            # the module may have been unloaded while we were waiting for room in a queue
+            if worker is not None and worker.module is module:
+                await worker.submit(getattr(module, hook), *args)
 
     def send_message(self, target: str, message: str) -> None:
         """
-        Sends a message to the server.
+        Queues a message to be sent to the server.
+
+        Long messages are split over multiple lines.
         """
-        self._conn.send("PRIVMSG {} {}".format(target, message))
+        self._outbound.push_message(target, message)
 
 
 class ServerManager:
@@ -280,9 +652,10 @@ class ServerManager:
         self._loop = loop or asyncio.get_event_loop()
         # set up all servers from their configs
         self._server_configs = {s.address: s for s in server_configs}
+        # every server shares one loader, so each module is only executed once
+        self._loader = ModuleLoader(["modules"])
         self._servers = {
-            address: Server(ModuleLoader(["modules"]), cfg)
-            for address, cfg in self._server_configs.items()
+            address: Server(self._loader, cfg) for address, cfg in self._server_configs.items()
         }
         self._servers_lock = asyncio.Lock()
         self._active = {}
@@ -316,7 +689,7 @@ class ServerManager:
                 self._servers[address] = server
                 futures += [connect_one(server)]
             self._reconnect_servers.clear()
-        tasks = asyncio.gather(*futures, loop=self._loop)
+        tasks = asyncio.gather(*futures)
         try:
             await tasks
         except KeyboardInterrupt:
@@ -336,7 +709,7 @@ class ServerManager:
                 server = self._active.pop(address)
             futures += [server.close_future]
             futures += [server.disconnect()]
-        await asyncio.gather(*futures, loop=self._loop)
+        await asyncio.gather(*futures)
 
     async def _server_futures(self):
         async with self._servers_lock:
@@ -346,12 +719,24 @@ class ServerManager:
         while True:
             await self._disconnect()
             await self._connect()
-            futures = await self._server_futures() + [self._reload_signal.wait()]
-            await asyncio.wait(
-                futures, loop=self._loop, return_when=asyncio.FIRST_COMPLETED
-            )
+            reload = asyncio.ensure_future(self._reload_signal.wait())
+            futures = await self._server_futures() + [reload]
+            await asyncio.wait(futures, return_when=asyncio.FIRST_COMPLETED)
+            reload.cancel()
             self._reload_signal.clear()
 
+    @property
+    def servers(self) -> Mapping[str, Server]:
+        "The servers being managed, by address."
+        return self._servers
+
+    def dump_metrics(self) -> None:
+        """
+        Logs the handler metrics for every server.
+        """
+        for address, server in self._servers.items():
+            log.info("Handler metrics for %s:\n%s", address, server.metrics.dump())
+
     async def shutdown(self):
         log.info("Stopping omnibot")
         async with self._servers_lock:
@@ -370,9 +755,7 @@ class ServerManager:
             changed = current & new
             for address in added:
                 log.debug("Added server %s", address)
-                self._servers[address] = Server(
-                    ModuleLoader(["modules"]), server_configs[address]
-                )
+                self._servers[address] = Server(self._loader, server_configs[address])
             for address in removed:
                 log.debug("Removed server %s", address)
                 self._servers.pop(address)
@@ -387,13 +770,11 @@ class ServerManager:
                 ):
                     log.debug("Reconnecting to server %s", newest.address)
                     self._servers.pop(prev.address)
-                    self._reconnect_servers[newest.address] = Server(
-                        ModuleLoader(["modules"]), newest
-                    )
+                    self._reconnect_servers[newest.address] = Server(self._loader, newest)
                 else:
                     log.debug("Reconfiguring server %s", newest.address)
                     reload_futures += [self._servers[address].reload(server_configs[address])]
-            await asyncio.gather(*reload_futures, loop=self._loop)
+            await asyncio.gather(*reload_futures)
             self._server_configs = server_configs
         self._reload_signal.set()
         log.info("Finished reloading server configurations")
@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+from typing import Mapping, MutableMapping, Optional, Sequence
+from . import executor
+from .config import HttpConfig, MemoryConfig, ProfilerConfig, ServerConfig
+from .memory import MemorySampler
+from .monitor import Monitor
+from .profiler import Profiler
+from .server import ServerManager
+
+
+log = logging.getLogger(__name__)
+
+
+# Don't restart a crashed shard any sooner than this, in seconds; doubles for every crash in a row.
+RESTART_DELAY = 1.0
+RESTART_DELAY_MAX = 60.0
+# Shards that stay up for this long, in seconds, are no longer considered to be crashing in a row.
+RESTART_RESET = 300.0
+
+
+def assign_shards(
+    addresses: Sequence[str], shards: int, previous: Mapping[str, int] = None
+) -> MutableMapping[str, int]:
+    """
+    Assigns each server address to a shard index.
+
+    Servers that already have a shard keep it, so that reloading doesn't move connections between
+    processes. New servers go to whichever shard has the fewest servers.
+    """
+    previous = previous or {}
+    assignment = {}
+    counts = [0] * shards
+    for address in addresses:
+        shard = previous.get(address)
+        if shard is not None and shard < shards:
+            assignment[address] = shard
+            counts[shard] += 1
+    for address in sorted(addresses):
+        if address in assignment:
+            continue
+        shard = counts.index(min(counts))
+        assignment[address] = shard
+        counts[shard] += 1
+    return assignment
+
+
+def _run_shard(
+    index: int,
+    server_configs: Sequence[ServerConfig],
+    processes: Optional[int],
+    http: Optional[HttpConfig],
+    profiler_config: ProfilerConfig,
+    memory_config: Optional[MemoryConfig],
+    conn,
+) -> None:
+    """
+    Entry point for a shard's process.
+
+    Runs a ServerManager for this shard's servers, taking reload and shutdown commands from the
+    supervisor over a pipe. If metrics are served over HTTP, each shard serves its own servers' on
+    the configured port plus its index.
+    """
+    logging.basicConfig(level=logging.DEBUG)
+    # the supervisor decides when shards reload and exit
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    signal.signal(signal.SIGQUIT, signal.SIG_IGN)
+    executor.configure_process_pool(processes)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    manager = ServerManager(server_configs, loop=loop)
+    memory = None
+    if memory_config is not None:
+        memory = MemorySampler(manager, memory_config, loop)
+    monitor = None
+    if http is not None:
+        monitor = Monitor(
+            manager, HttpConfig(address=http.address, port=http.port + index), loop, memory
+        )
+    profiler = Profiler(profiler_config, manager, "shard{}".format(index), loop)
+    stopped = asyncio.Event()
+
+    def on_command():
+        try:
+            command, *args = conn.recv()
+        except EOFError:
+            log.error("Shard %s lost its supervisor, shutting down", index)
+            command = "shutdown"
+        if command == "reload":
+            loop.create_task(manager.reload(*args))
+        elif command == "dump_metrics":
+            manager.dump_metrics()
+        elif command == "toggle_profiler":
+            profiler.toggle()
+        elif command == "shutdown":
+            loop.remove_reader(conn.fileno())
+            stopped.set()
+        else:
+            log.error("Shard %s got an unknown command: %s", index, command)
+
+    async def main():
+        loop.add_reader(conn.fileno(), on_command)
+        if monitor is not None:
+            await monitor.start()
+        if memory is not None:
+            memory.start()
+        run = loop.create_task(manager.run())
+        await stopped.wait()
+        profiler.stop()
+        if memory is not None:
+            memory.stop()
+        run.cancel()
+        await manager.shutdown()
+        if monitor is not None:
+            await monitor.stop()
+
+    log.info("Starting shard %s", index)
+    try:
+        loop.run_until_complete(main())
+    finally:
+        executor.shutdown_process_pool()
+        loop.close()
+        conn.close()
+
+
+class Shard:
+    """
+    A worker process that runs a subset of the configured servers.
+    """
+
+    def __init__(
+        self,
+        index: int,
+        server_configs: Sequence[ServerConfig],
+        processes: Optional[int],
+        http: Optional[HttpConfig] = None,
+        profiler: ProfilerConfig = None,
+        memory: Optional[MemoryConfig] = None,
+    ) -> None:
+        self.index = index
+        self.server_configs = list(server_configs)
+        self.processes = processes
+        self.http = http
+        self.profiler = profiler or ProfilerConfig()
+        self.memory = memory
+        self.process = None
+        self.conn = None
+        self.started = None
+        self.crashes = 0
+
+    def start(self, context, loop) -> None:
+        self.conn, child = context.Pipe()
+        self.process = context.Process(
+            target=_run_shard,
+            args=(
+                self.index,
+                self.server_configs,
+                self.processes,
+                self.http,
+                self.profiler,
+                self.memory,
+                child,
+            ),
+            name="omnibot-shard-{}".format(self.index),
+        )
+        self.process.start()
+        child.close()
+        self.started = loop.time()
+
+    def send(self, *command) -> None:
+        try:
+            self.conn.send(command)
+        except (BrokenPipeError, OSError):
+            log.warning("Could not send %s to shard %s", command[0], self.index)
+
+
+class ShardSupervisor:
+    """
+    Runs servers across several worker processes, restarting any that crash.
+
+    This has the same interface as ServerManager: configuration reloads are forwarded to each
+    shard's own ServerManager, along with the server configurations that shard is responsible for.
+    """
+
+    def __init__(
+        self,
+        server_configs: Sequence[ServerConfig],
+        shards: int,
+        processes: Optional[int] = None,
+        http: Optional[HttpConfig] = None,
+        profiler: ProfilerConfig = None,
+        memory: Optional[MemoryConfig] = None,
+        loop=None,
+    ) -> None:
+        self._loop = loop or asyncio.get_event_loop()
+        # processes are spawned rather than forked so they don't inherit the running event loop
+        self._context = multiprocessing.get_context("spawn")
+        self._server_configs = {s.address: s for s in server_configs}
+        self._assignment = assign_shards(list(self._server_configs.keys()), shards)
+        self._shards = [
+            Shard(i, self._configs_for(i), processes, http, profiler, memory)
+            for i in range(shards)
+        ]
+        self._stopping = False
+        self._stopped = asyncio.Event()
+
+    @property
+    def shards(self) -> Sequence[Shard]:
+        return self._shards
+
+    def _configs_for(self, index: int) -> Sequence[ServerConfig]:
+        return [
+            config
+            for address, config in self._server_configs.items()
+            if self._assignment[address] == index
+        ]
+
+    def _start(self, shard: Shard) -> None:
+        log.info(
+            "Starting shard %s with servers: %s",
+            shard.index,
+            ", ".join(c.address for c in shard.server_configs) or "(none)",
+        )
+        shard.start(self._context, self._loop)
+        self._loop.add_reader(shard.process.sentinel, self._on_exit, shard)
+
+    def _on_exit(self, shard: Shard) -> None:
+        self._loop.remove_reader(shard.process.sentinel)
+        shard.process.join()
+        if self._stopping:
+            log.info("Shard %s exited", shard.index)
+            return
+        if self._loop.time() - shard.started > RESTART_RESET:
+            shard.crashes = 0
+        delay = min(RESTART_DELAY * 2 ** shard.crashes, RESTART_DELAY_MAX)
+        shard.crashes += 1
+        log.error(
+            "Shard %s exited with code %s, restarting in %.1fs",
+            shard.index,
+            shard.process.exitcode,
+            delay,
+        )
+        self._loop.call_later(delay, self._restart, shard)
+
+    def _restart(self, shard: Shard) -> None:
+        if not self._stopping:
+            self._start(shard)
+
+    async def run(self):
+        for shard in self._shards:
+            self._start(shard)
+        await self._stopped.wait()
+
+    async def shutdown(self, timeout: float = 30.0):
+        log.info("Stopping omnibot shards")
+        self._stopping = True
+        for shard in self._shards:
+            if shard.process is not None and shard.process.is_alive():
+                shard.send("shutdown")
+        deadline = self._loop.time() + timeout
+        for shard in self._shards:
+            if shard.process is None:
+                continue
+            while shard.process.is_alive() and self._loop.time() < deadline:
+                await asyncio.sleep(0.1)
+            if shard.process.is_alive():
+                log.warning("Shard %s did not exit in time, terminating it", shard.index)
+                shard.process.terminate()
+            shard.process.join()
+        self._stopped.set()
+
+    def dump_metrics(self) -> None:
+        """
+        Asks every shard to log the handler metrics for its servers.
+        """
+        for shard in self._shards:
+            if shard.process is not None and shard.process.is_alive():
+                shard.send("dump_metrics")
+
+    def toggle_profiler(self) -> None:
+        """
+        Asks every shard to start profiling itself, or to stop early if it already is.
+        """
+        for shard in self._shards:
+            if shard.process is not None and shard.process.is_alive():
+                shard.send("toggle_profiler")
+
+    async def reload(self, server_configs: Sequence[ServerConfig]):
+        log.info("Reloading shard configurations")
+        self._server_configs = {s.address: s for s in server_configs}
+        self._assignment = assign_shards(
+            list(self._server_configs.keys()), len(self._shards), self._assignment
+        )
+        for shard in self._shards:
+            shard.server_configs = self._configs_for(shard.index)
+            # a crashed shard picks up its new configuration when it's restarted
+            if shard.process is not None and shard.process.is_alive():
+                shard.send("reload", shard.server_configs)
+        log.info("Finished forwarding server configurations to shards")
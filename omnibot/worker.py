@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from .config import QueuePolicy
+from .message import Message
+from .metrics import HandlerMetrics
+
+
+log = logging.getLogger(__name__)
+
+
+class ModuleWorker:
+    """
+    Runs a module's event handlers one at a time, in the order they were submitted, from a bounded
+    queue.
+
+    This keeps a slow module from holding up event delivery to every other module.
+    """
+
+    def __init__(
+        self,
+        module: "Module",
+        size: int,
+        policy: QueuePolicy,
+        metrics: HandlerMetrics = None,
+    ) -> None:
+        self._module = module
+        self._policy = policy
+        self._metrics = metrics
+        self._queue = asyncio.Queue(maxsize=size)
+        self._task = None
+        self._dropped = 0
+
+    @property
+    def module(self) -> "Module":
+        return self._module
+
+    @property
+    def depth(self) -> int:
+        "The number of events waiting to be handled."
+        return self._queue.qsize()
+
+    @property
+    def dropped(self) -> int:
+        "The number of events that have been dropped because the queue was full."
+        return self._dropped
+
+    def start(self) -> None:
+        assert self._task is None, "worker for module {} already started".format(
+            self.module.name
+        )
+        self._task = self.module.loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops handling events, cancelling the handler that is currently running (if any).
+
+        Events still in the queue are discarded.
+        """
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # release anybody blocked on a full queue
+        while not self._queue.empty():
+            self._queue.get_nowait()
+            self._queue.task_done()
+
+    async def join(self) -> None:
+        """
+        Waits until every queued event has been handled.
+        """
+        await self._queue.join()
+
+    async def submit(self, handler, *args) -> bool:
+        """
+        Queues a handler to be called with the given arguments.
+
+        Returns whether the event was queued; if the queue is full, the configured policy decides
+        which event is dropped (or whether to wait for room).
+        """
+        item = (handler, args)
+        if self._policy is QueuePolicy.BLOCK:
+            await self._queue.put(item)
+            return True
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            pass
+        self._dropped += 1
+        if self._policy is QueuePolicy.DROP_NEWEST:
+            log.debug("Queue for module %s is full, dropping newest event", self.module.name)
+            return False
+        log.debug("Queue for module %s is full, dropping oldest event", self.module.name)
+        self._queue.get_nowait()
+        self._queue.task_done()
+        self._queue.put_nowait(item)
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            handler, args = await self._queue.get()
+            try:
+                call = handler(*args)
+                if self._metrics is not None:
+                    # every hook takes the channel (or a message sent to it) as its first argument
+                    channel = args[0] if args else None
+                    if isinstance(channel, Message):
+                        channel = channel.channel
+                    call = self._metrics.call(self.module.name, handler.__name__, channel, call)
+                await call
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception(
+                    "Error in %s handler for module %s", handler.__name__, self.module.name
+                )
+            finally:
+                self._queue.task_done()
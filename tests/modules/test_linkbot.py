@@ -0,0 +1,348 @@
+import asyncio
+from aiohttp import web
+from omnibot import Message
+from modules import linkbot
+from tests.test_server import make_server
+
+
+async def serve(routes):
+    "Serves the given {path: handler} routes locally, returning the runner and its base URL."
+    app = web.Application()
+    for path, handler in routes.items():
+        app.router.add_route("*", path, handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, "http://127.0.0.1:{}".format(port)
+
+
+def make_linkbot(**args):
+    server = make_server(linkbot={"args": args})
+    return linkbot.Linkbot(server.config.modules["linkbot"], server)
+
+
+def test_session_is_reused():
+    peers = set()
+
+    async def page(request):
+        peers.add(request.transport.get_extra_info("peername"))
+        return web.Response(text="<html><title> Hello </title></html>", content_type="text/html")
+
+    async def test():
+        runner, base = await serve({"/": page})
+        bot = make_linkbot()
+        await bot.on_load()
+        try:
+            assert await bot.get_title(base + "/") == "Hello"
+            assert await bot.get_title(base + "/") == "Hello"
+        finally:
+            await bot.on_unload()
+            await runner.cleanup()
+        assert bot.session is None
+
+    asyncio.run(test())
+    # every request went over the same connection
+    assert len(peers) == 1
+
+
+async def chunked(data, size, read=None):
+    for i in range(0, len(data), size):
+        if read is not None:
+            read.append(i)
+        yield data[i:i + size]
+
+
+def test_read_title_stops_early():
+    page = b"<html><head><title>A split title</title></head>" + b"<p>filler</p>" * 10000
+    read = []
+    title = asyncio.run(linkbot.read_title(chunked(page, 8, read), "utf-8"))
+    assert title == "A split title"
+    assert len(read) < 10
+
+    # no title within the limit
+    title = asyncio.run(linkbot.read_title(chunked(page, 8), "utf-8", max_bytes=20))
+    assert title is None
+
+
+def test_read_title_charset():
+    page = '<meta charset="koi8-r"><title>Привет</title>'.encode("koi8-r")
+    assert asyncio.run(linkbot.read_title(chunked(page, 5))) == "Привет"
+    # the headers win over the page
+    page = '<meta charset="utf-8"><title>café</title>'.encode("latin-1")
+    assert asyncio.run(linkbot.read_title(chunked(page, 5), "latin-1")) == "café"
+    # unknown charsets are ignored
+    page = '<title>café</title>'.encode("utf-8")
+    assert asyncio.run(linkbot.read_title(chunked(page, 5), "no-such-charset")) == "café"
+
+
+def test_normalize_url():
+    assert linkbot.normalize_url("HTTP://Example.COM") == "http://example.com/"
+    assert linkbot.normalize_url("https://example.com:443/a?b=c#d") == "https://example.com/a?b=c"
+    assert linkbot.normalize_url("http://example.com:8080/A") == "http://example.com:8080/A"
+    assert linkbot.normalize_url("http://[::1]:80/") == "http://[::1]/"
+
+
+def test_title_cache():
+    now = [0.0]
+    cache = linkbot.TitleCache(2, ttl=10, negative_ttl=1, clock=lambda: now[0])
+    cache.put("a", "A")
+    cache.put("b", None)
+    assert cache.get("a") == (True, "A")
+    assert cache.get("b") == (True, None)
+    now[0] = 2
+    # failures expire sooner
+    assert cache.get("b") == (False, None)
+    cache.put("b", "B")
+    cache.get("a")
+    cache.put("c", "C")
+    # b was used least recently
+    assert cache.get("b") == (False, None)
+    assert (cache.hits, cache.misses) == (3, 2)
+
+    copy = linkbot.TitleCache(2, ttl=10, negative_ttl=1, clock=lambda: now[0])
+    copy.update(cache.items())
+    assert copy.get("a") == (True, "A")
+    now[0] = 20
+    assert copy.get("c") == (False, None)
+    assert copy.items() == []
+
+
+def test_titles_are_cached():
+    fetches = []
+
+    async def page(request):
+        fetches.append(request.path)
+        return web.Response(text="<title>Cached</title>", content_type="text/html")
+
+    async def test():
+        runner, base = await serve({"/": page})
+        bot = make_linkbot(follow_local_urls=True)
+        await bot.on_load()
+        try:
+            assert await bot.cached_title(base + "/") == "Cached"
+            assert await bot.cached_title(base + "#again") == "Cached"
+        finally:
+            await bot.on_unload()
+            await runner.cleanup()
+        return bot
+
+    bot = asyncio.run(test())
+    assert fetches == ["/"]
+    assert bot.stats() == {"cache_hits": 1, "cache_misses": 1, "cache_entries": 1}
+
+
+def test_cache_is_shared():
+    fetches = []
+
+    async def page(request):
+        fetches.append(request.path)
+        return web.Response(text="<title>Cached</title>", content_type="text/html")
+
+    async def test():
+        runner, base = await serve({"/": page})
+        # e.g. on two networks
+        bots = [make_linkbot(follow_local_urls=True) for _ in range(2)]
+        titles = []
+        try:
+            for bot in bots:
+                await bot.on_load()
+                titles.append(await bot.cached_title(base + "/"))
+        finally:
+            for bot in bots:
+                await bot.on_unload()
+            await runner.cleanup()
+        return titles
+
+    assert asyncio.run(test()) == ["Cached", "Cached"]
+    assert fetches == ["/"]
+
+
+def test_cached_titles_follow_the_rules():
+    fetches = []
+
+    async def page(request):
+        fetches.append(request.path)
+        return web.Response(text="<title>Cached</title>", content_type="text/html")
+
+    async def test():
+        runner, base = await serve({"/": page})
+        bot = make_linkbot(follow_local_urls=True)
+        await bot.on_load()
+        try:
+            assert await bot.cached_title(base + "/") == "Cached"
+            state = await bot.export_state()
+        finally:
+            await bot.on_unload()
+            await runner.cleanup()
+        # the cache is handed to instances with other rules, which don't post what they
+        # wouldn't have fetched
+        rules = [
+            {"follow_local_urls": True},
+            {"follow_local_urls": True, "blacklist": ["127.0.0.1"]},
+            {},
+        ]
+        titles = []
+        for args in rules:
+            bot = make_linkbot(**args)
+            await bot.import_state(state)
+            titles.append(await bot.cached_title(base + "/"))
+        return titles
+
+    assert asyncio.run(test()) == ["Cached", None, None]
+    assert fetches == ["/"]
+
+
+def test_host_resolver():
+    lookups = []
+    now = [0.0]
+
+    async def lookup(host):
+        lookups.append(host)
+        await asyncio.sleep(0.01)
+        if host == "nowhere.example":
+            raise OSError("no such host")
+        return [("93.184.216.34", 60), ("2606:2800:220:1::", None)]
+
+    async def test():
+        resolver = linkbot.HostResolver(lookup, ttl=300, negative_ttl=5, clock=lambda: now[0])
+        first, second = await asyncio.gather(
+            resolver.resolve("Example.com"), resolver.resolve("example.com")
+        )
+        assert first == second == ["93.184.216.34", "2606:2800:220:1::"]
+        assert await resolver.resolve("127.0.0.1") == ["127.0.0.1"]
+        for _ in range(2):
+            try:
+                await resolver.resolve("nowhere.example")
+            except OSError:
+                pass
+            else:
+                raise AssertionError("resolved a host that doesn't exist")
+        assert lookups == ["example.com", "nowhere.example"]
+        # the shortest TTL wins
+        now[0] = 61
+        await resolver.resolve("example.com")
+        assert lookups[-1] == "example.com" and len(lookups) == 3
+
+    asyncio.run(test())
+
+
+def test_every_address_is_checked():
+    async def lookup(host):
+        return {
+            "public.example": [("93.184.216.34", None), ("2606:2800:220:1::", None)],
+            "mixed.example": [("93.184.216.34", None), ("::ffff:10.0.0.1", None)],
+        }[host]
+
+    async def test():
+        bot = make_linkbot()
+        bot.resolver = linkbot.HostResolver(lookup)
+        assert await bot.is_valid_url("http://public.example/")
+        assert not await bot.is_valid_url("http://mixed.example/")
+        assert not await bot.is_valid_url("http://[::1]:8080/")
+
+        safe = linkbot.SafeResolver(bot.resolver, bot.is_allowed_address)
+        results = await safe.resolve("mixed.example", 80, 0)
+        assert [result["host"] for result in results] == ["93.184.216.34"]
+
+    asyncio.run(test())
+
+
+def test_links_are_fetched_together():
+    fetches = []
+
+    async def page(request):
+        fetches.append(request.path)
+        # the first link is the slowest
+        await asyncio.sleep(0.2 if request.path == "/1" else 0.05)
+        return web.Response(
+            text="<title>Page {}</title>".format(request.path[1:]), content_type="text/html"
+        )
+
+    async def test():
+        runner, base = await serve({"/{n}": page})
+        # the third bot has different rules, so it doesn't share the others' fetches
+        bots = [make_linkbot(follow_local_urls=True, max_urls=3) for _ in range(2)]
+        bots += [make_linkbot(follow_local_urls=True, max_urls=3, blacklist=["10.0.0.1"])]
+        sent = [[], [], []]
+        for bot, posted in zip(bots, sent):
+            bot.server.send_message = lambda target, text, posted=posted: posted.append(text)
+            await bot.on_load()
+        text = " ".join(base + "/{}".format(n) for n in (1, 2, 1))
+        start = asyncio.get_event_loop().time()
+        try:
+            await asyncio.gather(
+                *[bot.handle_message(Message(bot.server, "who", "#a", text, "#a")) for bot in bots]
+            )
+        finally:
+            for bot in bots:
+                await bot.on_unload()
+            await runner.cleanup()
+        return sent, asyncio.get_event_loop().time() - start
+
+    sent, elapsed = asyncio.run(test())
+    assert sent == [["Page 1", "Page 2", "Page 1"]] * 3
+    # bots with the same rules shared each fetch, and the pages were fetched at the same time
+    assert sorted(fetches) == ["/1", "/1", "/2", "/2"]
+    assert elapsed < 0.3
+
+
+def test_first_title_is_posted():
+    fetches = []
+
+    async def page(request):
+        fetches.append(request.path)
+        await asyncio.sleep(0.2)
+        if request.path == "/missing":
+            raise web.HTTPNotFound()
+        return web.Response(text="<title>{}</title>".format(request.path), content_type="text/html")
+
+    async def test():
+        runner, base = await serve({"/{name}": page})
+        bot = make_linkbot(follow_local_urls=True)
+        sent = []
+        bot.server.send_message = lambda target, text: sent.append(text)
+        await bot.on_load()
+        text = " ".join(base + path for path in ("/missing", "/one", "/two"))
+        start = asyncio.get_event_loop().time()
+        try:
+            await bot.handle_message(Message(bot.server, "who", "#a", text, "#a"))
+        finally:
+            await bot.on_unload()
+            await runner.cleanup()
+        return sent, asyncio.get_event_loop().time() - start
+
+    sent, elapsed = asyncio.run(test())
+    # with the default max_urls of 1, only the first title is posted, but every link was fetched
+    # at once rather than one after another
+    assert sent == ["/one"]
+    assert sorted(fetches) == ["/missing", "/one", "/two"]
+    assert elapsed < 0.35
+
+
+def test_shared_fetch_outlives_its_bot():
+    async def page(request):
+        await asyncio.sleep(0.2)
+        return web.Response(text="<title>Slow</title>", content_type="text/html")
+
+    async def test():
+        runner, base = await serve({"/": page})
+        first, second = [make_linkbot(follow_local_urls=True) for _ in range(2)]
+        await first.on_load()
+        await second.on_load()
+        try:
+            fetching = asyncio.ensure_future(first.cached_title(base + "/"))
+            await asyncio.sleep(0.05)
+            waiting = asyncio.ensure_future(second.cached_title(base + "/"))
+            await asyncio.sleep(0.05)
+            # the fetch both are waiting for is cancelled with the bot that made it, and the
+            # other bot fetches the page itself
+            await first.on_unload()
+            assert await waiting == "Slow"
+            await asyncio.gather(fetching, return_exceptions=True)
+        finally:
+            await second.on_unload()
+            await runner.cleanup()
+
+    asyncio.run(test())
@@ -0,0 +1,126 @@
+import asyncio
+import pickle
+import random
+from modules import markov
+from modules.markov.chain import MarkovChain, MergedChain, Vocabulary, VOCABULARY, ngram_words
+from omnibot import Message
+from omnibot.memory import deep_size
+from tests.test_server import make_server
+
+
+def dict_links(lines, order):
+    "Trains chains the way they were stored before words were interned."
+    links = {}
+    for line in lines:
+        words = list(ngram_words(line))
+        words += [None] * (order + 1 - len(words))
+        for i in range(len(words) - order):
+            weights = links.setdefault(tuple(words[i : i + order]), {})
+            weights[words[i + order]] = weights.get(words[i + order], 0) + 1
+    return links
+
+
+def test_train():
+    lines = ["the cat sat on the mat.", "the cat ran", "hi", "the cat sat, then ran!"]
+    chain = MarkovChain()
+    for line in lines:
+        chain.train(line, 2)
+    assert chain.links == dict_links(lines, 2)
+    assert chain.total_weight() == 12
+    assert chain.choose_word(("the", "cat")) in ("sat", "ran")
+    assert chain.choose_word(("the", "dog")) is None
+    assert chain.choose_word(("never", "seen")) is None
+
+    chain = MarkovChain()
+    chain.train("the cat sat on the mat.", 2)
+    for _ in range(10):
+        assert "the cat sat on the mat.".endswith(chain.make_sentence())
+    assert MarkovChain().make_sentence() is None
+
+
+def test_sentence_starts():
+    chain = MarkovChain(vocabulary=Vocabulary())
+    chain.train("the cat sat. a dog ran. and then", 2)
+    chain.train("the cat ran", 2)
+    assert chain.choose_ngram() in chain.links
+    merged = MarkovChain()
+    merged.merge(chain)
+    for copy in (chain, pickle.loads(pickle.dumps(chain)), merged):
+        sentences = {copy.make_sentence() for _ in range(50)}
+        assert sentences <= {"the cat sat.", "the cat ran", "a dog ran.", "and then"}
+        assert "the cat sat." in sentences
+
+
+def test_merge():
+    a = MarkovChain()
+    a.train("one two three", 2)
+    # chains from another vocabulary are translated into this one
+    b = MarkovChain(vocabulary=Vocabulary())
+    b.train("one two four", 2)
+    b.train("one two four", 2)
+    b.train("five six seven", 2)
+    a.merge(b)
+    assert a.links == dict_links(["one two three"] + ["one two four"] * 2 + ["five six seven"], 2)
+    assert b.links == dict_links(["one two four"] * 2 + ["five six seven"], 2)
+
+    c = MarkovChain(links=a.links, chance=0.5)
+    assert c.links == a.links and c.chance == 0.5
+
+
+def test_pickle():
+    chain = MarkovChain(chance=0.25, listen=False, vocabulary=Vocabulary())
+    chain.train("a b c a b d", 2)
+    copy = pickle.loads(pickle.dumps(chain))
+    assert copy.vocabulary is VOCABULARY
+    assert copy.links == chain.links
+    assert (copy.chance, copy.listen) == (0.25, False)
+
+    # chains pickled before words were interned
+    old = MarkovChain.__new__(MarkovChain)
+    old.__setstate__({"_links": dict(chain.links), "_chance": None, "_listen": None})
+    assert old.links == chain.links and old.listen
+
+
+def test_memory():
+    random.seed(1)
+    words = ["w{}".format(i) for i in range(1000)]
+    lines = [" ".join(random.choice(words) for _ in range(10)) for _ in range(2000)]
+    chain = MarkovChain()
+    for line in lines:
+        chain.train(line, 2)
+    links = dict_links(lines, 2)
+    assert chain.links == links
+    assert deep_size(chain, exclude=[VOCABULARY]) * 2 < deep_size(links)
+
+
+def test_merged_chain():
+    chains = {"a": MarkovChain(), "b": MarkovChain(), "c": MarkovChain()}
+    chains["a"].train("the cat sat.", 2)
+    chains["b"].train("the cat ran.", 2)
+    merged = MergedChain(chains)
+    assert merged.total_weight() == 4
+    sentences = {merged.make_sentence() for _ in range(50)}
+    assert sentences == {"the cat sat.", "the cat ran."}
+    # the view follows the chains as they're trained
+    chains["c"].train("a dog", 2)
+    assert merged.total_weight() == 5
+    assert MergedChain({"a": MarkovChain()}).make_sentence() is None
+
+
+def test_channel_commands(tmp_path):
+    async def test():
+        server = make_server(markov={"data": str(tmp_path), "args": {"reply_chance": 0.0}})
+        bot = markov.Markov(server.config.modules["markov"], server)
+        sent = []
+        server.send_message = lambda target, text: sent.append((target, text))
+        await bot.on_load()
+        for who, text in [("alice", "the cat sat."), ("bob", "the cat ran."), ("bob", "hi")]:
+            await bot.handle_message(Message(server, who, "#c", text, "#c"))
+        await bot.handle_message(Message(server, "alice", "#c", "!markov all", "#c"))
+        assert sent[-1][1] in ("alice: the cat sat.", "alice: the cat ran.", "alice: hi")
+        await bot.handle_message(Message(server, "bob", "#c", "!markov status", "#c"))
+        assert sent[-1] == ("#c", "bob: you are worth 60.0000% of the channel")
+        await bot.on_unload()
+        assert (tmp_path / "markov.pickle").exists()
+
+    asyncio.run(test())
@@ -0,0 +1,73 @@
+import asyncio
+from omnibot.bench.replay import replay, synthetic_lines
+from omnibot.loader import ModuleLoader
+
+
+ECHO = '''
+from omnibot import Module
+
+class Echo(Module):
+    async def on_message(self, channel, who, text):
+        self.server.send_message(channel, text)
+
+ModuleClass = Echo
+'''
+
+SLOW = '''
+import asyncio
+from omnibot import Module
+
+class Slow(Module):
+    preload = False
+
+    async def on_load(self):
+        await asyncio.sleep(0.1)
+
+    async def on_message(self, channel, who, text):
+        pass
+
+ModuleClass = Slow
+'''
+
+
+def test_synthetic_lines():
+    lines = synthetic_lines(500, ["#a", "#b"], seed=1)
+    assert len(lines) == 500
+    assert lines == synthetic_lines(500, ["#a", "#b"], seed=1)
+    assert lines != synthetic_lines(500, ["#a", "#b"], seed=2)
+    assert sum(" PRIVMSG " in line for line in lines) > 400
+
+
+def test_replay(tmp_path):
+    (tmp_path / "echo.py").write_text(ECHO)
+    server = {"nick": "bench", "modules": {"echo": {"channels": ["#a"]}}}
+
+    async def test():
+        lines = [
+            ":x!x@h PRIVMSG #a :one",
+            ":x!x@h PRIVMSG #b :not routed",
+            ":x!x@h JOIN #a",
+            ":x!x@h PRIVMSG #a :two",
+        ]
+        return await replay(
+            ModuleLoader([str(tmp_path)]), "irc.example.com", server, lines, trace_memory=True
+        )
+
+    result = asyncio.run(test())
+    assert result["lines"] == 4
+    # the module doesn't handle joins, so it is only sent the two messages for its channel
+    assert result["modules"]["echo"]["calls"] == 2
+    assert result["modules"]["echo"]["errors"] == 0
+    assert result["memory"]["peak"] > 0
+
+
+def test_replay_waits_for_background_modules(tmp_path):
+    (tmp_path / "slow.py").write_text(SLOW)
+    server = {"nick": "bench", "modules": {"slow": {"channels": ["#a"]}}}
+    lines = [":x!x@h PRIVMSG #a :one", ":x!x@h PRIVMSG #a :two"]
+
+    async def test():
+        return await replay(ModuleLoader([str(tmp_path)]), "irc.example.com", server, lines)
+
+    result = asyncio.run(test())
+    assert result["modules"]["slow"]["calls"] == 2
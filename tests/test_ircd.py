@@ -0,0 +1,184 @@
+import asyncio
+from asyncirc.server import Server as IrcServer
+from omnibot import Server
+from omnibot.bench.ircd import Ircd
+from omnibot.bench.loadgen import LoadGenerator
+from omnibot.config import ServerConfig
+from omnibot.connection import Connection
+from omnibot.loader import ModuleLoader
+
+
+PONG = '''
+from omnibot import Module
+
+class Pong(Module):
+    async def on_message(self, channel, who, text):
+        if text == "!ping":
+            self.server.send_message(channel, "pong")
+
+ModuleClass = Pong
+'''
+
+
+def test_excess_flood():
+    async def test():
+        ircd = Ircd(flood_burst=5, flood_rate=1.0)
+        await ircd.start()
+        reader, writer = await asyncio.open_connection(ircd.host, ircd.port)
+        writer.write(b"NICK flooder\r\nUSER flooder 0 * :flooder\r\n")
+        writer.write(b"PRIVMSG nobody :hi\r\n" * 10)
+        lines = (await reader.read()).decode().splitlines()
+        writer.close()
+        await ircd.stop()
+        return ircd, lines
+
+    ircd, lines = asyncio.run(test())
+    assert " 001 flooder " in lines[0]
+    assert lines[-1].startswith("ERROR ") and "Excess Flood" in lines[-1]
+    assert ircd.stats["flood_kills"] == 1
+
+
+def test_simulated_user_quits():
+    async def test():
+        ircd = Ircd()
+        await ircd.start()
+        reader, writer = await asyncio.open_connection(ircd.host, ircd.port)
+        writer.write(b"NICK watcher\r\nUSER watcher 0 * :watcher\r\nJOIN #a\r\n")
+        while "watcher" not in {member.nick for member in ircd.members("#a")}:
+            await asyncio.sleep(0.01)
+        user = ircd.add_user("sim")
+        ircd.act(user, "JOIN #a")
+        ircd.act(user, "QUIT :bye")
+        lines = []
+        while not any(" QUIT " in line for line in lines):
+            line = await asyncio.wait_for(reader.readline(), 5)
+            lines.append(line.decode())
+        members = {member.nick for member in ircd.members("#a")}
+        writer.close()
+        await ircd.stop()
+        return lines, members
+
+    lines, members = asyncio.run(test())
+    # its peers see it quit, and it leaves its channels
+    assert lines[-1].startswith(":sim!") and "QUIT :Quit: bye" in lines[-1]
+    assert members == {"watcher"}
+
+
+def test_end_to_end(tmp_path):
+    (tmp_path / "pong.py").write_text(PONG)
+
+    async def test():
+        ircd = Ircd()
+        await ircd.start()
+        config = ServerConfig(
+            name="local",
+            address=ircd.host,
+            port=ircd.port,
+            nick="bot",
+            data=str(tmp_path / "data"),
+            modules={"pong": {"channels": ["#a", "#b"]}},
+        )
+        server = Server(ModuleLoader([str(tmp_path)]), config)
+        await server.connect()
+        for _ in range(500):
+            if server.ready:
+                break
+            await asyncio.sleep(0.01)
+        assert server.ready
+        assert {member.nick for member in ircd.members("#a")} == {"bot"}
+
+        load = LoadGenerator(
+            ircd,
+            ["#a", "#b", "#c"],
+            users=200,
+            rate=200.0,
+            nick="bot",
+            probe="!ping",
+            probe_interval=0.2,
+        )
+        await load.run(1.0)
+        await server.disconnect()
+        await ircd.stop()
+        return ircd, load, server
+
+    ircd, load, server = asyncio.run(test())
+    assert load.sent > 100
+    assert load.latency.count >= 3
+    assert load.timeouts == 0
+    assert ircd.stats["flood_kills"] == 0
+    assert server.received.count > 50
+
+
+def test_reconnects_when_pings_stall(tmp_path):
+    (tmp_path / "pong.py").write_text(PONG)
+
+    async def wait_ready(server):
+        for _ in range(500):
+            if server.ready:
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError("server was not ready")
+
+    async def test():
+        ircd = Ircd()
+        await ircd.start()
+        config = ServerConfig(
+            name="local",
+            address=ircd.host,
+            port=ircd.port,
+            nick="bot",
+            data=str(tmp_path / "data"),
+            modules={"pong": {"channels": ["#a"]}},
+            keepalive={"interval": 0.05, "timeout": 0.2, "backoff": 0.05},
+        )
+        server = Server(ModuleLoader([str(tmp_path)]), config)
+        await server.connect()
+        await wait_ready(server)
+        module = server.modules["pong"]
+        while server.lag is None:
+            await asyncio.sleep(0.01)
+        assert server.lag < 0.2
+
+        ircd.answer_pings = False
+        while server.connected:
+            await asyncio.sleep(0.01)
+        assert not server.active_channels
+        ircd.answer_pings = True
+        await wait_ready(server)
+        # modules were kept through the reconnect
+        assert server.modules["pong"] is module
+        assert {member.nick for member in ircd.members("#a")} == {"bot"}
+        await server.disconnect()
+        await ircd.stop()
+        return server
+
+    server = asyncio.run(test())
+    assert server.reconnects == 1
+
+
+def test_sends_wait_for_reconnect():
+    async def test():
+        ircd = Ircd()
+        await ircd.start()
+        lines = []
+        ircd.add_listener(lambda client, msg: lines.append(msg.command))
+        conn = Connection([IrcServer(ircd.host, ircd.port, False)], "bot")
+        assert await conn.connect()
+        while not ircd.stats["lines"]:
+            await asyncio.sleep(0.01)
+        conn.drop()
+        while conn.connected:
+            await asyncio.sleep(0.01)
+        # sent while disconnected, so it waits until the connection is made again
+        conn.send("PRIVMSG #a :hello")
+        await asyncio.sleep(0.05)
+        assert await conn.connect()
+        for _ in range(100):
+            if "PRIVMSG" in lines:
+                break
+            await asyncio.sleep(0.01)
+        conn.quit()
+        await ircd.stop()
+        return lines
+
+    assert "PRIVMSG" in asyncio.run(test())
@@ -0,0 +1,44 @@
+import os
+from omnibot.loader import ModuleLoader
+
+
+SOURCE = '''
+from omnibot import Module
+
+class Counted(Module):
+    version = {}
+
+ModuleClass = Counted
+'''
+
+
+def test_load_is_cached_until_source_changes(tmp_path):
+    path = tmp_path / "counted.py"
+    path.write_text(SOURCE.format(1))
+    loader = ModuleLoader([str(tmp_path)])
+    first = loader.load_module("counted")
+    assert loader.load_module("counted") is first
+
+    # touched, but with the same content
+    stat = path.stat()
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert loader.load_module("counted") is first
+
+    path.write_text(SOURCE.format(2) + "\n# changed\n")
+    second = loader.load_module("counted")
+    assert second is not first
+    assert loader.load_module("counted") is second
+
+
+def test_package_submodule_changes(tmp_path):
+    package = tmp_path / "pkg"
+    package.mkdir()
+    (package / "__init__.py").write_text(SOURCE)
+    helper = package / "helper.py"
+    helper.write_text("VALUE = 1\n")
+    loader = ModuleLoader([str(tmp_path)])
+    first = loader.load_module("pkg")
+    assert loader.load_module("pkg") is first
+
+    helper.write_text("VALUE = 22\n")
+    assert loader.load_module("pkg") is not first
@@ -0,0 +1,91 @@
+import asyncio
+import sys
+from omnibot import Module
+from omnibot.config import HttpConfig, MemoryConfig
+from omnibot.memory import MemorySampler, SizeWalk, deep_size
+from omnibot.monitor import Monitor
+from tests.test_monitor import Manager
+from tests.test_server import load, make_server
+
+
+def test_deep_size():
+    shared = "x" * 1000
+    items = [shared, shared, [shared]]
+    size = deep_size(items)
+    assert size >= sys.getsizeof(items) + sys.getsizeof(shared)
+    # shared objects are counted once
+    assert size < sys.getsizeof(items) + 2 * sys.getsizeof(shared)
+    assert deep_size(items, exclude=[shared]) < sys.getsizeof(shared)
+    # walks stop at code and modules
+    assert deep_size([sys, deep_size]) == sys.getsizeof([sys, deep_size])
+
+    walk = SizeWalk(limit=2)
+    walk.size(list(range(1000, 1010)))
+    assert walk.truncated and walk.count == 2
+
+
+def test_sampler():
+    class Channels(Module):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.seen = {"#a": ["a" * 1000], "#b": []}
+
+        def memory_breakdown(self):
+            return self.seen
+
+    async def test():
+        server = make_server(c={}, whole={})
+        load(server, "c", Channels)
+        load(server, "whole", Module)
+        sampler = MemorySampler(Manager(server), MemoryConfig())
+        await sampler.sample()
+        sizes = sampler.sizes
+        assert sizes[("irc.example.com", "c", "#a")] > sizes[("irc.example.com", "c", "#b")] > 0
+        # the server isn't counted as part of a module
+        assert sizes[("irc.example.com", "whole", None)] < deep_size(server.config) + 10000
+
+        lines = Monitor(Manager(server), HttpConfig(), memory=sampler).render().splitlines()
+        assert any(
+            line.startswith(
+                'omnibot_module_memory_bytes{channel="#a",module="c",server="irc.example.com"}'
+            )
+            for line in lines
+        )
+        for worker in server.workers.values():
+            await worker.stop()
+
+    asyncio.run(test())
+
+
+def test_shared_memory():
+    shared = ["x" * 100000]
+
+    class Sharing(Module):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.seen = {"#a": [shared]}
+
+        def memory_breakdown(self):
+            return self.seen
+
+        def memory_shared(self):
+            return (shared,)
+
+    async def test():
+        server = make_server(a={}, b={})
+        load(server, "a", Sharing)
+        load(server, "b", Sharing)
+        sampler = MemorySampler(Manager(server), MemoryConfig())
+        await sampler.sample()
+        # the shared object is counted once, apart from the modules' channels
+        assert all(size < 100000 for size in sampler.sizes.values())
+        assert sampler.shared == {"a": deep_size(shared), "b": 0}
+
+        lines = Monitor(Manager(server), HttpConfig(), memory=sampler).render().splitlines()
+        assert any(
+            line.startswith('omnibot_module_shared_memory_bytes{module="a"}') for line in lines
+        )
+        for worker in server.workers.values():
+            await worker.stop()
+
+    asyncio.run(test())
@@ -0,0 +1,24 @@
+from omnibot import Message
+
+
+def test_views():
+    message = Message(None, "x", "#a", "!Cmd  Hello, World! see https://example.com/a?b", "#a")
+    assert message.words == ("!Cmd", "Hello,", "World!", "see", "https://example.com/a?b")
+    assert message.words is message.words
+    assert message.command == "!Cmd"
+    assert message.tokens == ("cmd", "hello", "world", "see", "https://example.com/a?b")
+    assert message.urls == ("https://example.com/a?b",)
+    assert Message(None, "x", "#a", "   ").command is None
+
+
+def test_view_is_computed_once():
+    calls = []
+
+    def parse(text):
+        calls.append(text)
+        return text.upper()
+
+    message = Message(None, "x", "#a", "hi")
+    assert message.view(parse) == "HI"
+    assert message.view(parse) == "HI"
+    assert calls == ["hi"]
@@ -0,0 +1,64 @@
+import asyncio
+import pytest
+from omnibot.metrics import Histogram, HandlerMetrics
+
+
+def test_histogram():
+    histogram = Histogram()
+    assert histogram.percentile(50) is None
+    for ms in range(1, 1001):
+        histogram.record(ms / 1000.0)
+    assert histogram.count == 1000
+    assert histogram.min == pytest.approx(0.001)
+    assert histogram.max == pytest.approx(1.0)
+    assert histogram.mean == pytest.approx(0.5005)
+    # buckets are accurate to within 1/64th
+    assert histogram.percentile(50) == pytest.approx(0.5, rel=1 / 64)
+    assert histogram.percentile(99) == pytest.approx(0.99, rel=1 / 64)
+    assert histogram.percentile(100) == pytest.approx(1.0)
+
+
+def test_histogram_merge():
+    a = Histogram()
+    b = Histogram()
+    a.record(0.001)
+    b.record(0.003)
+    b.record(0.002)
+    a.merge(b)
+    assert a.count == 3
+    assert a.min == pytest.approx(0.001)
+    assert a.max == pytest.approx(0.003)
+    assert a.percentile(50) == pytest.approx(0.002, rel=1 / 64)
+
+
+def test_handler_metrics():
+    async def ok():
+        return 1
+
+    async def broken():
+        raise ValueError()
+
+    async def slow():
+        await asyncio.sleep(10)
+
+    async def test():
+        metrics = HandlerMetrics()
+        assert await metrics.call("a", "on_message", "#chan", ok()) == 1
+        with pytest.raises(ValueError):
+            await metrics.call("a", "on_message", "#other", broken())
+        task = asyncio.ensure_future(metrics.call("b", "on_join", "#chan", slow()))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return metrics
+
+    metrics = asyncio.run(test())
+    a = metrics.stats(module="a")
+    assert (a.calls, a.errors, a.cancelled) == (2, 1, 0)
+    assert metrics.stats(channel="#chan").calls == 2
+    b = metrics.stats(module="b", hook="on_join")
+    assert (b.calls, b.errors, b.cancelled) == (1, 0, 1)
+    assert b.latency.count == 1
+    assert set(metrics.by_module().keys()) == {"a", "b"}
+    assert len(metrics.dump().splitlines()) == 4
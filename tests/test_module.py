@@ -0,0 +1,49 @@
+import asyncio
+import os
+import threading
+from omnibot import Module, executor
+from omnibot.config import ModuleConfig
+
+
+class Stub(Module):
+    def __init__(self, config):
+        super().__init__(config, server=None)
+
+    @property
+    def loop(self):
+        return asyncio.get_event_loop()
+
+
+def test_run_in_thread():
+    async def test():
+        module = Stub(ModuleConfig("stub"))
+        name = await module.run_in_thread(lambda: threading.current_thread().name)
+        assert name.startswith("omnibot-stub")
+        assert await module.run_in_thread(sorted, [3, 1, 2], reverse=True) == [3, 2, 1]
+        pool = module.thread_pool()
+        await module.shutdown_executors()
+        assert pool._shutdown
+        # a new pool is created if the module is used again
+        assert module.thread_pool() is not pool
+        await module.shutdown_executors()
+
+    asyncio.run(test())
+
+
+def test_run_in_process():
+    async def test():
+        module = Stub(ModuleConfig("stub"))
+        executor.configure_process_pool(1)
+        try:
+            assert await module.run_in_process(sorted, [3, 1, 2], reverse=True) == [3, 2, 1]
+            assert await module.run_in_process(os.getpid) != os.getpid()
+            pool = executor.process_pool()
+        finally:
+            executor.shutdown_process_pool()
+            executor.configure_process_pool(None)
+        assert pool._shutdown_thread
+        # a new pool is started if it's used again
+        assert executor.process_pool() is not pool
+        executor.shutdown_process_pool()
+
+    asyncio.run(test())
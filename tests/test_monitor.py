@@ -0,0 +1,56 @@
+import asyncio
+from omnibot.config import HttpConfig
+from omnibot.monitor import Monitor
+from tests.test_server import Recorder, load, make_server
+
+
+class Manager:
+    def __init__(self, *servers):
+        self.servers = {server.address: server for server in servers}
+
+
+def test_render():
+    async def test():
+        server = make_server(a={"channels": ['#a "quoted"']})
+        load(server, "a", Recorder)
+
+        async def handler():
+            pass
+
+        await server.metrics.call("a", "on_message", "#a", handler())
+        monitor = Monitor(Manager(server), HttpConfig())
+        lines = monitor.render().splitlines()
+        assert 'omnibot_connected{server="irc.example.com"} 0.0' in lines
+        assert 'omnibot_channels_wanted{server="irc.example.com"} 1.0' in lines
+        assert 'omnibot_modules{server="irc.example.com"} 1.0' in lines
+        assert (
+            'omnibot_handler_calls_total{hook="on_message",module="a",server="irc.example.com"} 1.0'
+            in lines
+        )
+        assert "# TYPE omnibot_handler_seconds summary" in lines
+        assert not monitor.ready()
+        assert "omnibot_ready 0.0" in lines
+
+        server._connected = True
+        server._active_channels.add('#a "quoted"')
+        assert monitor.ready()
+        for worker in server.workers.values():
+            await worker.stop()
+
+    asyncio.run(test())
+
+
+def test_module_stats():
+    class Counting(Recorder):
+        def stats(self):
+            return {"hits": 3}
+
+    async def test():
+        server = make_server(a={})
+        load(server, "a", Counting)
+        lines = Monitor(Manager(server), HttpConfig()).render().splitlines()
+        assert 'omnibot_module_stat{module="a",server="irc.example.com",stat="hits"} 3.0' in lines
+        for worker in server.workers.values():
+            await worker.stop()
+
+    asyncio.run(test())
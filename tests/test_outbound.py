@@ -0,0 +1,100 @@
+import asyncio
+from omnibot.config import FloodConfig
+from omnibot.outbound import OutboundQueue, split_text
+
+
+def test_split_text():
+    assert split_text("hello world", 100) == ["hello world"]
+    assert split_text("hello world", 8) == ["hello", "world"]
+    assert split_text("abcdefghij", 4) == ["abcd", "efgh", "ij"]
+    assert split_text("one\ntwo\r\n\nthree", 100) == ["one", "two", "three"]
+    assert split_text("", 100) == []
+
+
+def test_split_text_multibyte():
+    text = "ﾀ━━━━━━(ﾟ∀ﾟ)━━━━━━ !!!!"
+    pieces = split_text(text, 10)
+    assert all(len(piece.encode()) <= 10 for piece in pieces)
+    assert "".join(pieces).replace(" ", "") == text.replace(" ", "")
+
+
+def test_queue_order():
+    async def test():
+        sent = []
+        queue = OutboundQueue(sent.append, FloodConfig(burst=100, rate=100.0), "omnibot")
+        queue.push_message("#busy", "1")
+        queue.push_message("#busy", "2")
+        queue.push_message("#busy", "3")
+        queue.push_message("#quiet", "a")
+        queue.push("JOIN #new")
+        assert queue.depth == 5
+        queue.start()
+        queue.resume()
+        while queue.depth:
+            await asyncio.sleep(0)
+        await queue.stop()
+        assert sent == [
+            "JOIN #new",
+            "PRIVMSG #busy :1",
+            "PRIVMSG #quiet :a",
+            "PRIVMSG #busy :2",
+            "PRIVMSG #busy :3",
+        ]
+        assert queue.sent == 5
+
+    asyncio.run(test())
+
+
+def test_queue_line_length():
+    async def test():
+        sent = []
+        queue = OutboundQueue(sent.append, FloodConfig(burst=100, rate=100.0), "omnibot")
+        queue.push_message("#chan", "word " * 200)
+        queue.start()
+        queue.resume()
+        while queue.depth:
+            await asyncio.sleep(0)
+        await queue.stop()
+        assert len(sent) > 1
+        for line in sent:
+            assert line.startswith("PRIVMSG #chan :word")
+            assert len(":omnibot!0123456789@{} {}\r\n".format("h" * 63, line).encode()) <= 512
+
+    asyncio.run(test())
+
+
+def test_queue_rate_limit():
+    async def test():
+        sent = []
+        queue = OutboundQueue(sent.append, FloodConfig(burst=2, rate=20.0), "omnibot")
+        for i in range(4):
+            queue.push_message("#chan", str(i))
+        queue.start()
+        queue.resume()
+        await asyncio.sleep(0.01)
+        # only the burst has gone out so far
+        assert len(sent) == 2
+        assert queue.depth == 2
+        assert queue.wait_time > 0.0
+        await asyncio.sleep(0.15)
+        assert len(sent) == 4
+        assert queue.wait_time == 0.0
+        await queue.stop()
+
+    asyncio.run(test())
+
+
+def test_queue_paused():
+    async def test():
+        sent = []
+        queue = OutboundQueue(sent.append, FloodConfig(), "omnibot")
+        queue.start()
+        queue.push("JOIN #chan")
+        await asyncio.sleep(0.01)
+        assert sent == []
+        queue.resume()
+        await asyncio.sleep(0.01)
+        assert sent == ["JOIN #chan"]
+        await queue.stop()
+
+    asyncio.run(test())
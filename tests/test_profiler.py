@@ -0,0 +1,34 @@
+import cProfile
+import threading
+from pathlib import Path
+from omnibot.profiler import Profiler, StackSampler
+
+
+def busy(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+def test_sampler():
+    stop = threading.Event()
+    thread = threading.Thread(target=busy, args=(stop,), name="busy")
+    thread.start()
+    sampler = StackSampler(0.001)
+    for _ in range(10):
+        sampler.sample()
+    stop.set()
+    thread.join()
+    assert sampler.samples == 10
+    busy_stacks = [s for s in sampler.stacks if s.startswith("busy;")]
+    assert busy_stacks
+    assert all("busy ({})".format(__file__) in s for s in busy_stacks)
+
+
+def test_summarize():
+    profile = cProfile.Profile()
+    profile.enable()
+    sorted(range(1000), key=str)
+    profile.disable()
+    summary = Profiler.summarize(profile, [("irc.example.com", "test", Path(__file__))])
+    assert "==== all ====" in summary
+    assert "==== test on irc.example.com ====" in summary
@@ -0,0 +1,299 @@
+import asyncio
+from irclib.parser import Message as IrcMessage
+from omnibot import Module, Server, module_commands
+from omnibot.bench.replay import FakeProtocol
+from omnibot.config import ServerConfig
+from omnibot.loader import ModuleLoader
+from omnibot.worker import ModuleWorker
+
+
+class Recorder(Module):
+    async def on_message(self, channel, who, text):
+        self.server.seen += [(self.name, channel, who, text)]
+
+
+class NickRecorder(Recorder):
+    def route_nicks(self):
+        return ("NickServ",)
+
+
+def make_server(**modules):
+    config = ServerConfig(name="irc.example.com", nick="omnibot", modules=modules)
+    server = Server(ModuleLoader([]), config)
+    server.seen = []
+    return server
+
+
+def load(server, name, clazz):
+    config = server.config.modules[name]
+    module = clazz(config, server)
+    worker = ModuleWorker(module, config.queue_size, config.queue_policy)
+    worker.start()
+    server._modules[name] = module
+    server._workers[name] = worker
+
+
+def test_channel_routes():
+    async def test():
+        server = make_server(a={"channels": ["#a", "#b"]}, b={"channels": ["#b"]})
+        load(server, "a", Recorder)
+        load(server, "b", Recorder)
+        server.rebuild_routes()
+
+        assert server.route(IrcMessage.parse(":x!u@h PRIVMSG #a :hi")) == [server._modules["a"]]
+        assert server.route(IrcMessage.parse(":x!u@h PRIVMSG #b :hi")) == [
+            server._modules["a"],
+            server._modules["b"],
+        ]
+        assert server.route(IrcMessage.parse(":x!u@h PRIVMSG #c :hi")) == []
+        assert server.route(IrcMessage.parse(":x!u@h NOTICE #a :hi")) == []
+
+        await server.on_message(IrcMessage.parse(":x!u@h PRIVMSG #b :hello world"))
+        for worker in server.workers.values():
+            await worker.join()
+        assert sorted(server.seen) == [
+            ("a", None, "x", "hello world"),
+            ("b", None, "x", "hello world"),
+        ]
+
+    asyncio.run(test())
+
+
+def test_nick_routes():
+    async def test():
+        server = make_server(nickserv={}, other={"channels": ["#a"]})
+        load(server, "nickserv", NickRecorder)
+        load(server, "other", Recorder)
+        server.rebuild_routes()
+
+        notice = IrcMessage.parse(":nickserv!s@services NOTICE omnibot :This nickname is registered")
+        assert server.route(notice) == [server._modules["nickserv"]]
+        assert server.route(IrcMessage.parse(":x!u@h NOTICE omnibot :hi")) == []
+
+    asyncio.run(test())
+
+
+def test_should_handle_fallback():
+    class Everything(Recorder):
+        def should_handle(self, msg):
+            return msg.command == "NOTICE"
+
+    async def test():
+        server = make_server(everything={})
+        load(server, "everything", Everything)
+        server.rebuild_routes()
+
+        assert server.route(IrcMessage.parse(":x!u@h NOTICE #z :hi")) == [
+            server._modules["everything"]
+        ]
+        assert server.route(IrcMessage.parse(":x!u@h PRIVMSG #z :hi")) == []
+
+    asyncio.run(test())
+
+
+def test_commands_from_message():
+    @module_commands("!go")
+    class Commands(Module):
+        async def on_command(self, command, channel, who, text):
+            self.server.seen += [(command, channel, who, text)]
+
+    async def test():
+        server = make_server(c={"channels": ["#a"]})
+        load(server, "c", Commands)
+        server._active_channels.add("#a")
+        server.rebuild_routes()
+        await server.on_message(IrcMessage.parse(":x!u@h PRIVMSG #a :!go now"))
+        await server.on_message(IrcMessage.parse(":x!u@h PRIVMSG #a :go now"))
+        for worker in server.workers.values():
+            await worker.join()
+        assert server.seen == [("!go", "#a", "x", "!go now")]
+
+    asyncio.run(test())
+
+
+def test_hook_subscribers():
+    class Joins(Module):
+        async def on_join(self, channel, who):
+            self.server.seen += [(self.name, "join", channel, who)]
+
+    class Declared(Joins):
+        hooks = {"on_part"}
+
+        async def on_part(self, channel, who):
+            self.server.seen += [(self.name, "part", channel, who)]
+
+    async def test():
+        server = make_server(
+            r={"channels": ["#a"]}, j={"channels": ["#a"]}, d={"channels": ["#a"]}
+        )
+        load(server, "r", Recorder)
+        load(server, "j", Joins)
+        load(server, "d", Declared)
+        server.rebuild_routes()
+
+        assert server.route(IrcMessage.parse(":x!u@h PRIVMSG #a :hi")) == [server._modules["r"]]
+        await server.on_join(IrcMessage.parse(":x!u@h JOIN #a"))
+        await server.on_part(IrcMessage.parse(":x!u@h PART #a"))
+        for worker in server.workers.values():
+            await worker.join()
+        assert server.seen == [("j", "join", "#a", "x"), ("d", "part", "#a", "x")]
+
+    asyncio.run(test())
+
+
+STATEFUL = '''
+from omnibot import Module
+
+class Stateful(Module):
+    state_version = {version}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.count = 0
+
+    async def export_state(self):
+        return self.count
+
+    async def import_state(self, state):
+        self.count = state
+
+    def migrate_state(self, state, version):
+        return state * 10
+
+    async def on_load(self):
+        {on_load}
+
+    async def on_unload(self):
+        self.server.seen += [("unload", self.count, self.state_exported)]
+
+ModuleClass = Stateful
+'''
+
+
+def test_reload_hands_state_over(tmp_path):
+    source = tmp_path / "stateful.py"
+    source.write_text(STATEFUL.format(version=1, on_load="pass"))
+
+    def config(n):
+        modules = {"stateful": {"args": {"n": n}}}
+        return ServerConfig(name="irc.example.com", nick="omnibot", modules=modules)
+
+    async def test():
+        server = Server(ModuleLoader([str(tmp_path)]), config(1))
+        server.seen = []
+        await server.load_modules()
+        old = server.modules["stateful"]
+        old.count = 3
+
+        # same version: the state is imported as is
+        await server.reload(config(2))
+        new = server.modules["stateful"]
+        assert new is not old and new.state_adopted and new.count == 3
+        assert server.seen == [("unload", 3, True)]
+
+        # a new version migrates it
+        source.write_text(STATEFUL.format(version=2, on_load="pass"))
+        await server.reload(config(3))
+        assert server.modules["stateful"].count == 30
+
+        # if the new instance can't load, the old one keeps its state to itself
+        source.write_text(STATEFUL.format(version=2, on_load="raise RuntimeError()"))
+        server.seen = []
+        await server.reload(config(4))
+        assert "stateful" not in server.modules
+        assert server.seen == [("unload", 30, False)]
+        await server.unload_modules()
+
+    asyncio.run(test())
+
+
+class Classes:
+    "A loader for module classes that are defined in the tests."
+
+    def __init__(self, **classes):
+        self.classes = classes
+
+    def load_module(self, name):
+        return self.classes[name]
+
+
+def test_modules_load_concurrently():
+    class Slow(Module):
+        async def on_load(self):
+            await asyncio.sleep(0.2)
+
+    async def test():
+        modules = {"a": {}, "b": {}, "late": {"load_timeout": 0.05}}
+        config = ServerConfig(name="irc.example.com", nick="omnibot", modules=modules)
+        server = Server(Classes(a=Slow, b=Slow, late=Slow), config)
+        start = asyncio.get_event_loop().time()
+        await server.load_modules()
+        assert asyncio.get_event_loop().time() - start < 0.35
+        assert set(server.modules) == {"a", "b"}
+        await server.unload_modules()
+
+    asyncio.run(test())
+
+
+def test_deferred_modules_join_once_loaded():
+    class Deferred(Module):
+        preload = False
+
+        async def on_load(self):
+            await self.server.release.wait()
+
+    async def test():
+        modules = {"r": {"channels": ["#a"]}, "d": {"channels": ["#d"]}}
+        config = ServerConfig(name="irc.example.com", nick="omnibot", modules=modules)
+        conn = FakeProtocol()
+        server = Server(Classes(r=Recorder, d=Deferred), config, conn=conn)
+        server.release = asyncio.Event()
+        await server.connect()
+        assert set(server.modules) == {"r"}
+        await conn.feed(b":irc.example.com 001 omnibot :Welcome")
+        await conn.feed(b":omnibot!u@h JOIN #a")
+        assert server.wanted_channels() == {"#a"}
+        assert not server.ready
+
+        server.release.set()
+        while "d" not in server.modules:
+            await asyncio.sleep(0.01)
+        assert server.wanted_channels() == {"#a", "#d"}
+        await conn.feed(b":omnibot!u@h JOIN #d")
+        assert server.ready
+        await server.disconnect()
+
+    asyncio.run(test())
+
+
+def test_deferred_modules_join_shared_channels():
+    class Deferred(Module):
+        preload = False
+
+        async def on_load(self):
+            self.joins = []
+            await self.server.release.wait()
+
+        async def on_join(self, channel, who):
+            self.joins += [(channel, who)]
+
+    async def test():
+        modules = {"r": {"channels": ["#a"]}, "d": {"channels": ["#a", "#d"]}}
+        config = ServerConfig(name="irc.example.com", nick="omnibot", modules=modules)
+        conn = FakeProtocol()
+        server = Server(Classes(r=Recorder, d=Deferred), config, conn=conn)
+        server.release = asyncio.Event()
+        await server.connect()
+        await conn.feed(b":irc.example.com 001 omnibot :Welcome")
+        await conn.feed(b":omnibot!u@h JOIN #a")
+
+        server.release.set()
+        while "d" not in server.modules:
+            await asyncio.sleep(0.01)
+        await conn.feed(b":omnibot!u@h JOIN #d")
+        await server.workers["d"].join()
+        # #a was joined before the module loaded, and #d after
+        assert server.modules["d"].joins == [("#a", None), ("#d", None)]
+        await server.disconnect()
+
+    asyncio.run(test())
@@ -0,0 +1,73 @@
+import asyncio
+from omnibot import shard as shard_module
+from omnibot.bench.ircd import Ircd
+from omnibot.config import ServerConfig
+from omnibot.shard import ShardSupervisor, assign_shards
+
+
+def test_assign_shards_balanced():
+    assignment = assign_shards(["a", "b", "c", "d", "e"], 2)
+    assert set(assignment.keys()) == {"a", "b", "c", "d", "e"}
+    counts = [list(assignment.values()).count(i) for i in range(2)]
+    assert sorted(counts) == [2, 3]
+
+
+def test_assign_shards_sticky():
+    previous = assign_shards(["a", "b", "c"], 3)
+    assignment = assign_shards(["c", "d", "a"], 3, previous)
+    assert assignment["a"] == previous["a"]
+    assert assignment["c"] == previous["c"]
+    # the new server takes the shard that was left empty
+    assert assignment["d"] == previous["b"]
+
+
+def test_assign_shards_shrunk():
+    previous = {"a": 0, "b": 3}
+    assignment = assign_shards(["a", "b"], 2, previous)
+    assert assignment == {"a": 0, "b": 1}
+
+
+def test_supervisor_restarts_and_reloads_shards(tmp_path, monkeypatch):
+    monkeypatch.setattr(shard_module, "RESTART_DELAY", 0.05)
+
+    async def wait_for(condition, timeout=30.0):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while not condition():
+            assert loop.time() < deadline
+            await asyncio.sleep(0.05)
+
+    async def test():
+        ircd = Ircd()
+        await ircd.start()
+        nicks = set()
+        ircd.add_listener(lambda client, msg: nicks.add(client.nick))
+        supervisor = ShardSupervisor([], 1)
+        run = asyncio.ensure_future(supervisor.run())
+        shard = supervisor.shards[0]
+        try:
+            await wait_for(lambda: shard.process is not None and shard.process.is_alive())
+            crashed = shard.process
+            crashed.kill()
+            await wait_for(lambda: shard.process is not crashed and shard.process.is_alive())
+            assert shard.crashes == 1
+
+            # the restarted shard is sent the new configuration, and connects to the new server
+            config = ServerConfig(
+                name="local",
+                address=ircd.host,
+                port=ircd.port,
+                nick="shardbot",
+                data=str(tmp_path),
+                modules={},
+            )
+            await supervisor.reload([config])
+            assert shard.server_configs == [config]
+            await wait_for(lambda: "shardbot" in nicks)
+        finally:
+            await supervisor.shutdown(timeout=10.0)
+            await run
+            await ircd.stop()
+        assert not shard.process.is_alive()
+
+    asyncio.run(test())
@@ -0,0 +1,96 @@
+import asyncio
+import pytest
+from omnibot import Module
+from omnibot.config import ModuleConfig, ConfigError, QueuePolicy
+from omnibot.worker import ModuleWorker
+
+
+class Stub(Module):
+    def __init__(self, config):
+        super().__init__(config, server=None)
+        self.seen = []
+
+    @property
+    def loop(self):
+        return asyncio.get_event_loop()
+
+    async def on_message(self, channel, who, text):
+        self.seen += [text]
+
+
+def fill(policy):
+    """
+    Queues five messages on a stopped worker with room for two, then handles whatever is left.
+    """
+    async def test():
+        module = Stub(ModuleConfig("stub"))
+        worker = ModuleWorker(module, 2, policy)
+        queued = []
+        for i in range(5):
+            queued += [await worker.submit(module.on_message, None, None, str(i))]
+        worker.start()
+        await worker.join()
+        await worker.stop()
+        return module.seen, queued, worker.dropped
+
+    return asyncio.run(test())
+
+
+def test_drop_oldest():
+    seen, queued, dropped = fill(QueuePolicy.DROP_OLDEST)
+    assert seen == ["3", "4"]
+    assert queued == [True] * 5
+    assert dropped == 3
+
+
+def test_drop_newest():
+    seen, queued, dropped = fill(QueuePolicy.DROP_NEWEST)
+    assert seen == ["0", "1"]
+    assert queued == [True, True, False, False, False]
+    assert dropped == 3
+
+
+def test_block():
+    async def test():
+        module = Stub(ModuleConfig("stub"))
+        worker = ModuleWorker(module, 1, QueuePolicy.BLOCK)
+        await worker.submit(module.on_message, None, None, "0")
+        blocked = asyncio.ensure_future(worker.submit(module.on_message, None, None, "1"))
+        await asyncio.sleep(0)
+        assert not blocked.done()
+        worker.start()
+        await blocked
+        await worker.join()
+        await worker.stop()
+        assert module.seen == ["0", "1"]
+
+    asyncio.run(test())
+
+
+def test_handler_errors_are_contained():
+    class Broken(Stub):
+        async def on_message(self, channel, who, text):
+            if text == "bad":
+                raise ValueError(text)
+            await super().on_message(channel, who, text)
+
+    async def test():
+        module = Broken(ModuleConfig("broken"))
+        worker = ModuleWorker(module, 10, QueuePolicy.BLOCK)
+        worker.start()
+        for text in ("a", "bad", "b"):
+            await worker.submit(module.on_message, None, None, text)
+        await worker.join()
+        await worker.stop()
+        assert module.seen == ["a", "b"]
+
+    asyncio.run(test())
+
+
+def test_queue_config():
+    assert ModuleConfig("m").queue_policy is QueuePolicy.DROP_OLDEST
+    assert ModuleConfig("m", queue_policy="block").queue_policy is QueuePolicy.BLOCK
+    with pytest.raises(ConfigError):
+        ModuleConfig("m", queue_policy="sometimes")
+    with pytest.raises(ConfigError):
+        ModuleConfig("m", queue_size=0)